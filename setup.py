@@ -41,7 +41,11 @@ setup(name='xbtarbiter',
         entry_points={
                 'console_scripts': [
                     'xbtarbiter= xbtarbiter:main',
-                ]
+                ],
+                'xbtarbiter.plugins': [
+                    'bitstamp = xbtarbiter.bitstamp:create_plugin',
+                    'kraken = xbtarbiter.kraken:create_plugin',
+                ],
             }
     )
 
@@ -0,0 +1,139 @@
+import time
+import unittest
+from decimal import Decimal
+
+from xbtarbiter.account import AccountState
+
+
+class _Order(object):
+    def __init__(self, oid, otype, volume, price):
+        self.oid = oid
+        self.otype = otype
+        self.volume = Decimal(volume)
+        self.price = Decimal(price)
+
+
+def _balances(xbt='10', fiat='1000', avail_xbt=None, avail_fiat=None, fee='0'):
+    return {
+            'balance_xbt': Decimal(xbt),
+            'balance_fiat': Decimal(fiat),
+            'avail_xbt': Decimal(avail_xbt or xbt),
+            'avail_fiat': Decimal(avail_fiat or fiat),
+            'fee': Decimal(fee),
+        }
+
+
+class AccountStateTest(unittest.TestCase):
+    def test_order_submitted_during_fetch_stays_reserved(self):
+        snapshots = [_balances()]
+        account = AccountState(lambda: snapshots.pop(0))
+        order = _Order(1, 'bid', '1', '100')
+
+        def fetch():
+            # The order reaches the exchange after it took the snapshot
+            account.order_submitted(order)
+            return _balances()
+        account._fetch_balances = fetch
+        account.reconcile()
+        self.assertEqual(account.avail_fiat, Decimal('900'))
+
+        account.order_filled(order)
+        self.assertEqual(account.balance_xbt, Decimal('11'))
+        self.assertEqual(account.balance_fiat, Decimal('900'))
+
+    def test_orders_known_before_fetch_are_left_to_exchange(self):
+        account = AccountState(lambda: _balances())
+        account.order_submitted(_Order(1, 'ask', '2', '100'))
+        account._fetch_balances = lambda: _balances(avail_xbt='8')
+        account.reconcile()
+        self.assertEqual(account.avail_xbt, Decimal('8'))
+
+    def test_open_orders_stay_reserved_without_exchange_reservations(self):
+        account = AccountState(lambda: _balances(), reserves_orders=False,
+                reconcile_interval=1.0, fetch_open_orders=lambda: [1])
+        order = _Order(1, 'ask', '2', '100')
+        account.order_submitted(order)
+        # Forced reconciliation with the order still open
+        account.reconciled_at = time.time() - 10
+        self.assertTrue(account.maybe_reconcile())
+        self.assertEqual(account.avail_xbt, Decimal('8'))
+
+        account.order_cancelled(order)
+        self.assertEqual(account.avail_xbt, Decimal('10'))
+
+    def test_fill_in_balances_is_not_applied_again(self):
+        open_orders = []
+        account = AccountState(lambda: _balances(xbt='0'),
+                reserves_orders=False, fetch_open_orders=lambda: open_orders)
+        order = _Order(1, 'bid', '1', '100')
+        account.order_submitted(order)
+        # The order filled, the exchange's balances include it
+        account._fetch_balances = lambda: _balances(xbt='1', fiat='900')
+        account.reconcile()
+        account.order_filled(order)
+        self.assertEqual(account.balance_xbt, Decimal('1'))
+        self.assertEqual(account.avail_xbt, Decimal('1'))
+        self.assertEqual(account.balance_fiat, Decimal('900'))
+        self.assertEqual(account.avail_fiat, Decimal('900'))
+
+    def test_fee_without_fetcher_is_kept(self):
+        account = AccountState(lambda: _balances(fee='0.25'), fee_ttl=0.0)
+        account._fee_fetched_at -= 10
+        self.assertEqual(account.trade_fee, Decimal('0.25'))
+
+    def test_expired_fee_is_refreshed_in_the_background(self):
+        fees = [Decimal('0.26'), Decimal('0.24')]
+        balances = _balances()
+        del balances['fee']
+        account = AccountState(lambda: balances, lambda: fees.pop(0),
+                fee_ttl=60.0)
+        self.assertEqual(account.trade_fee, Decimal('0.26'))
+        account._fee_fetched_at -= 120
+        # Reading the fee doesn't make a request
+        self.assertEqual(account.trade_fee, Decimal('0.26'))
+        self.assertEqual(fees, [Decimal('0.24')])
+        self.assertTrue(account.maybe_refresh_fee())
+        self.assertEqual(account.trade_fee, Decimal('0.24'))
+        self.assertFalse(account.maybe_refresh_fee())
+
+
+class LocalBalancesTest(unittest.TestCase):
+    def setUp(self):
+        self.account = AccountState(lambda: _balances(fee='0.5'))
+
+    def _state(self):
+        account = self.account
+        return (account.balance_xbt, account.avail_xbt, account.balance_fiat,
+                account.avail_fiat)
+
+    def test_fills_move_the_funds(self):
+        bid = _Order(1, 'bid', '1', '100')
+        self.account.order_submitted(bid)
+        self.assertEqual(self._state(), (10, 10, 1000, Decimal('899.5')))
+        self.account.order_filled(bid)
+        self.assertEqual(self._state(), (11, 11, Decimal('899.5'), Decimal('899.5')))
+
+        ask = _Order(2, 'ask', '2', '100')
+        self.account.order_submitted(ask)
+        self.assertEqual(self._state(), (11, 9, Decimal('899.5'), Decimal('899.5')))
+        self.account.order_filled(ask)
+        self.assertEqual(self._state(), (9, 9, Decimal('1098.5'), Decimal('1098.5')))
+
+        # A fill reported again isn't applied twice
+        self.account.order_filled(ask)
+        self.assertEqual(self._state(), (9, 9, Decimal('1098.5'), Decimal('1098.5')))
+
+    def test_cancel_releases_the_reservation(self):
+        ask = _Order(1, 'ask', '2', '100')
+        self.account.order_submitted(ask)
+        self.account.order_cancelled(ask)
+        self.assertEqual(self._state(), (10, 10, 1000, 1000))
+
+    def test_reconciliation_takes_the_exchange_numbers(self):
+        self.account.order_filled(_Order(1, 'bid', '1', '100'))
+        self.account._fetch_balances = lambda: _balances(xbt='12', fiat='800', fee='0.5')
+        self.account.reconcile()
+        self.assertEqual(self._state(), (12, 12, 800, 800))
+
+if __name__ == '__main__':
+    unittest.main()
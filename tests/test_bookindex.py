@@ -0,0 +1,68 @@
+import random
+import unittest
+from decimal import Decimal
+
+from xbtarbiter.bookindex import BookIndex, IndexedHeap
+from xbtarbiter.replay import SimPlugin
+
+
+def _plugin(name, bid, ask, fee='0'):
+    plugin = SimPlugin(name, fee, '1000', '10')
+    plugin.load_order_book([(Decimal(bid), Decimal('1'))], [(Decimal(ask), Decimal('1'))])
+    return plugin
+
+
+def _pairs(index):
+    return [(bid_plugin.name, ask_plugin.name)
+            for (_, bid_plugin, ask_plugin) in index.candidates()]
+
+
+class IndexedHeapTest(unittest.TestCase):
+    def test_matches_a_sorted_list(self):
+        rand = random.Random(0)
+        heap = IndexedHeap()
+        priorities = {}
+        for _ in range(2000):
+            key = rand.randint(0, 30)
+            if rand.random() < 0.2:
+                heap.remove(key)
+                priorities.pop(key, None)
+            else:
+                priority = rand.randint(-100, 100)
+                heap.set(key, priority)
+                priorities[key] = priority
+            expected = sorted((priority, key) for (key, priority) in priorities.items())
+            self.assertEqual(heap.top(), expected[0] if expected else None)
+        self.assertEqual(list(heap.ordered()), expected)
+
+
+class BookIndexTest(unittest.TestCase):
+    def test_profitable_pairs_best_first(self):
+        index = BookIndex()
+        for plugin in (_plugin('a', '101', '102'), _plugin('b', '99', '100'),
+                _plugin('c', '103', '104')):
+            index.update(plugin)
+        pairs = _pairs(index)
+        self.assertEqual(pairs[0], ('c', 'b'))
+        self.assertEqual(sorted(pairs[1:]), [('a', 'b'), ('c', 'a')])
+
+    def test_fees_and_updates_move_the_markets(self):
+        index = BookIndex()
+        (a, b, c) = (_plugin('a', '101', '102', fee='1'), _plugin('b', '99', '100', fee='1'),
+                _plugin('c', '103', '104', fee='1'))
+        for plugin in (a, b, c):
+            index.update(plugin)
+        self.assertEqual(_pairs(index), [('c', 'b')])
+
+        b.load_order_book([(Decimal('99'), Decimal('1'))], [(Decimal('105'), Decimal('1'))])
+        index.update(b)
+        self.assertEqual(index.best(), None)
+
+        index.remove('c')
+        a.load_order_book([(Decimal('110'), Decimal('1'))], [(Decimal('111'), Decimal('1'))])
+        index.update(a)
+        self.assertEqual(_pairs(index), [('a', 'b')])
+
+
+if __name__ == '__main__':
+    unittest.main()
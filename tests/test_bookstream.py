@@ -0,0 +1,61 @@
+import unittest
+
+from xbtarbiter.bookstream import parse_book
+from xbtarbiter.session import HttpSession
+
+
+# Pretty-printed, with more whitespace after a key than the key's length
+BOOK = '{"timestamp": "1412345678", "bids"  :\n' + ' ' * 40 + \
+        '[["600.00", "1.5"], ["599.00", "2"]],\n "asks"\t:' + ' ' * 40 + \
+        '[["601.00", "1"], ["602.00", "3"]]}'
+
+
+def _chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class _Response(object):
+    """ Streamed response whose connection state is tracked.
+    """
+    status_code = 200
+
+    def __init__(self, text):
+        self._text = text
+        self.closed = False
+
+    def iter_content(self, size):
+        return iter(_chunks(self._text, size))
+
+    def close(self):
+        self.closed = True
+
+
+def _failing_parser(chunks):
+    next(chunks)
+    raise ValueError("Malformed order book")
+
+
+class ParseBookTest(unittest.TestCase):
+    def test_whitespace_around_keys_at_any_chunk_size(self):
+        for size in range(1, 24) + [8192]:
+            (book, _) = parse_book(_chunks(BOOK, size), 1)
+            self.assertEqual(book, {'bids': [[u'600.00', u'1.5']],
+                    'asks': [[u'601.00', u'1']]}, size)
+
+    def test_missing_side(self):
+        self.assertRaises(ValueError, parse_book,
+                _chunks('{"bids": [["600.00", "1.5"]]}', 5), 1)
+
+
+class RequestJsonTest(unittest.TestCase):
+    def test_response_closed_when_parsing_fails(self):
+        session = HttpSession()
+        response = _Response(BOOK)
+        session._request = lambda method, url, kwargs: (response, {'total': 0.0})
+        self.assertRaises(ValueError, session.request_json, 'GET',
+                'http://localhost/order_book', parser=_failing_parser)
+        self.assertTrue(response.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
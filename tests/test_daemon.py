@@ -0,0 +1,60 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from cStringIO import StringIO
+
+from xbtarbiter.daemon import ArbiterDaemon, DaemonUnavailable, send_command
+from xbtarbiter.replay import SimPlugin
+
+
+class _NoisyPlugin(SimPlugin):
+    """ Plugin whose balance lookup races with a background thread printing
+    to sys.stdout.
+    """
+    @property
+    def balance_xbt(self):
+        print "background output"
+        return self.avail_xbt
+
+
+class ArbiterDaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'daemon.sock')
+        plugin = _NoisyPlugin('sim', fee='0.2', usd='100', xbt='1')
+        plugin.plugin_name = 'sim'
+        self.server = ArbiterDaemon(self.path, [plugin], book_timeout=5.0)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_output_of_other_threads_stays_on_stdout(self):
+        stdout = sys.stdout
+        sys.stdout = captured = StringIO()
+        try:
+            output = send_command(self.path, 'balance', plugins=['sim'])
+        finally:
+            sys.stdout = stdout
+        self.assertTrue(output.startswith('sim '))
+        self.assertNotIn('background output', output)
+        self.assertIn('background output', captured.getvalue())
+
+    def test_plugin_not_connected(self):
+        self.assertRaises(DaemonUnavailable, send_command, self.path,
+                'balance', plugins=['sim', 'kraken'])
+
+    def test_other_book_timeout(self):
+        self.assertRaises(DaemonUnavailable, send_command, self.path,
+                'prices', plugins=['sim'], book_timeout=1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import random
+import unittest
+from decimal import Decimal
+
+from xbtarbiter import calc_opportunity
+from xbtarbiter.depth import walk_books
+from xbtarbiter.replay import SimPlugin
+
+
+SATOSHI = Decimal('0.00000001')
+
+
+def _levels(rnd, price, step, count):
+    levels = []
+    for _ in range(count):
+        price += step * rnd.randint(1, 100) / 100
+        levels.append((price, Decimal(rnd.randint(1, 10 ** 9)) * SATOSHI))
+    return levels
+
+
+def _plugin(rnd, name, mid):
+    plugin = SimPlugin(name,
+            fee=rnd.choice(['0', '0.2', '0.25']),
+            usd='{0:.2f}'.format(rnd.uniform(0, 20000)),
+            xbt='{0:.8f}'.format(rnd.uniform(0, 30)))
+    plugin.load_order_book(
+            _levels(rnd, mid, Decimal('-1'), rnd.randint(1, 25)),
+            _levels(rnd, mid + Decimal('0.01'), Decimal('1'), rnd.randint(1, 25)))
+    return plugin
+
+
+def _reference(bid_plugin, ask_plugin, max_volume):
+    mkt = walk_books(bid_plugin._bids, ask_plugin._asks,
+            bid_plugin.trade_fee, ask_plugin.trade_fee)
+    trade = walk_books(bid_plugin._bids, ask_plugin._asks,
+            bid_plugin.trade_fee, ask_plugin.trade_fee,
+            avail_usd=ask_plugin.avail_usd,
+            avail_xbt=bid_plugin.avail_xbt,
+            max_volume=max_volume)
+    return (mkt, trade)
+
+
+class CalcOpportunityTest(unittest.TestCase):
+    """ calc_opportunity() walks the books in fixed-point, walk_books() is
+    the Decimal reference.
+    """
+    def test_same_results_as_decimal_walk(self):
+        rnd = random.Random(0)
+        profitable = 0
+        for _ in range(500):
+            mid = Decimal(rnd.randint(59000, 61000)) / 100
+            bid_plugin = _plugin(rnd, 'bid', mid + rnd.randint(-300, 1500) / Decimal(100))
+            ask_plugin = _plugin(rnd, 'ask', mid)
+            max_volume = Decimal(rnd.choice(['0.01', '1', '100']))
+            (mkt, trade) = _reference(bid_plugin, ask_plugin, max_volume)
+            result = calc_opportunity(bid_plugin, ask_plugin, max_volume)
+            if mkt['profit'] > 0:
+                profitable += 1
+
+            # Without limits by funds, the walks are exact apart from the
+            # fees rounded up
+            self.assertEqual(result['mkt_volume'], mkt['volume'])
+            self.assertEqual(result['mkt_buy_total'], mkt['buy_total'])
+            self.assertEqual(result['mkt_sell_total'], mkt['sell_total'])
+            self.assertTrue(0 <= result['mkt_fees'] - mkt['fees'] < Decimal('1E-15'))
+
+            # The traded volume is rounded down to whole satoshis
+            self.assertTrue(0 <= trade['volume'] - result['volume'] < SATOSHI)
+            if trade['volume']:
+                tolerance = SATOSHI * max(trade['buy_limit'], trade['sell_limit']) * 3
+                for key in ('buy_total', 'sell_total', 'fees', 'profit'):
+                    self.assertTrue(abs(result[key] - trade[key]) <= tolerance,
+                            "{0}: {1} != {2}".format(key, result[key], trade[key]))
+                self.assertEqual(result['buy_limit'], trade['buy_limit'])
+                self.assertEqual(result['sell_limit'], trade['sell_limit'])
+        self.assertTrue(profitable > 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+import json
+import socket
+import threading
+import unittest
+import zlib
+from Queue import Queue
+from decimal import Decimal
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+from xbtarbiter import websocket
+from xbtarbiter.feed import BookFeed, LocalOrderBook
+from xbtarbiter.feedserver import FeedServer
+
+
+class _Plugin(object):
+    name = 'test'
+
+    def feed_depth(self, depth):
+        return depth
+
+    def feed_subscriptions(self, depth):
+        return [{'subscribe': depth}]
+
+    def parse_feed_message(self, message):
+        # Raises KeyError on messages without 'bids'
+        return (True, message['bids'], message['asks'])
+
+    def verify_feed_book(self, message, book):
+        pass
+
+
+class _ScriptedServer(object):
+    """ WebSocket server sending each connection the messages of the next
+    script, after the client has subscribed.
+    """
+    def __init__(self, scripts):
+        self.scripts = scripts
+        self.subscriptions = []
+        self._sock = socket.socket()
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(5)
+        self._connections = []
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return 'ws://127.0.0.1:{0}'.format(self._sock.getsockname()[1])
+
+    def _serve(self):
+        for script in self.scripts:
+            (conn, _) = self._sock.accept()
+            self._connections.append(conn)
+            ws = websocket.accept(conn, conn.makefile('rb'))
+            self.subscriptions.append(json.loads(ws.receive()))
+            for message in script:
+                ws.send(json.dumps(message))
+
+    def close(self):
+        for conn in self._connections:
+            conn.close()
+        self._sock.close()
+
+
+def _start_server(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+class BookFeedTest(unittest.TestCase):
+    def test_malformed_message_reconnects(self):
+        server = _ScriptedServer([
+                [{'unexpected': 1}],
+                [{'bids': [['600.0', '1.0']], 'asks': [['601.0', '2.0']]}],
+            ])
+        events = Queue()
+        feed = BookFeed(_Plugin(), server.url, events, reconnect_delay=0.01)
+        feed.start()
+        try:
+            self.assertTrue(events.get(timeout=5.0) is feed.plugin)
+            self.assertTrue(feed.live)
+            self.assertEqual(server.subscriptions, [{'subscribe': 25}] * 2)
+        finally:
+            feed.stop()
+            server.close()
+
+    def test_levels_beyond_the_stream_depth_are_dropped(self):
+        server = _ScriptedServer([[
+                {'bids': [['600.0', '1'], ['599.0', '1'], ['598.0', '1']],
+                        'asks': [['601.0', '1']]},
+            ]])
+        events = Queue()
+        feed = BookFeed(_Plugin(), server.url, events, depth=2)
+        feed.start()
+        try:
+            events.get(timeout=5.0)
+            self.assertEqual(sorted(feed.book.bids), [Decimal('599.0'), Decimal('600.0')])
+        finally:
+            feed.stop()
+            server.close()
+
+
+class KrakenChecksumTest(unittest.TestCase):
+    def test_decimal_points_and_leading_zeros_are_dropped(self):
+        from xbtarbiter.kraken import book_checksum
+
+        bids = [(Decimal('0.05005'), Decimal('0.00000010'))]
+        asks = [('0.05010', '1.50000000')]
+        self.assertEqual(book_checksum(bids, asks),
+                zlib.crc32('5010' + '150000000' + '5005' + '10') & 0xffffffff)
+
+
+@unittest.skipIf(requests is None, "requests is not installed")
+class ExchangeFeedTest(unittest.TestCase):
+    def setUp(self):
+        from xbtarbiter.bench import connect_mock
+        from xbtarbiter.mockexchange import MockExchangeServer
+
+        self.servers = [MockExchangeServer(('127.0.0.1', 0), seed=0)]
+        _start_server(self.servers[0])
+        (self.bitstamp, self.kraken) = connect_mock(self.servers[0])
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def _stand_in(self, exchange):
+        server = FeedServer(('127.0.0.1', 0), exchange, interval=0.001, seed=0)
+        _start_server(server)
+        self.servers.append(server)
+        return 'ws://127.0.0.1:{0}'.format(server.server_address[1])
+
+    def test_stand_in_streams_stay_in_sync(self):
+        for plugin in (self.bitstamp, self.kraken):
+            events = Queue()
+            feed = BookFeed(plugin, self._stand_in(plugin.name.split('.')[0]),
+                    events)
+            resyncs = []
+            feed._resync = lambda: resyncs.append(1)
+            feed.start()
+            try:
+                for _ in range(200):
+                    events.get(timeout=5.0)
+                self.assertTrue(feed.live)
+                self.assertEqual(resyncs, [])
+                with feed._lock:
+                    (bids, asks) = feed.book.levels(25)
+                self.assertEqual(len(bids), 25)
+                self.assertTrue(bids[0][0] < asks[0][0])
+            finally:
+                feed.stop()
+
+    def test_checksum_mismatch_resyncs_from_rest(self):
+        snapshot = [0, {'bs': [['600.0', '1.0', '0']], 'as': [['601.0', '2.0', '0']]},
+                'book-25', 'XBT/EUR']
+        server = _ScriptedServer([
+                [snapshot, [0, {'b': [['600.5', '1.0', '0']], 'c': '1'}, 'book-25', 'XBT/EUR']],
+                [snapshot],
+            ])
+        fetches = []
+        fetch_book_levels = self.kraken.fetch_book_levels
+        def fetch():
+            fetches.append(fetch_book_levels())
+            return fetches[-1]
+        self.kraken.fetch_book_levels = fetch
+
+        events = Queue()
+        feed = BookFeed(self.kraken, server.url, events)
+        feed.start()
+        try:
+            # Stream snapshot, REST book, stream snapshot again
+            for _ in range(3):
+                events.get(timeout=5.0)
+            self.assertEqual(len(fetches), 1)
+            (rest_bids, _) = fetches[0]
+            self.assertNotEqual(Decimal(rest_bids[0][0]), Decimal('600.0'))
+            with feed._lock:
+                top = feed.book.top()
+            self.assertEqual(top, (Decimal('600.0'), Decimal('1.0'),
+                    Decimal('601.0'), Decimal('2.0')))
+            self.assertEqual(server.subscriptions[1]['subscription'],
+                    {'name': 'book', 'depth': 25})
+        finally:
+            feed.stop()
+            server.close()
+
+
+class LocalOrderBookTest(unittest.TestCase):
+    def test_updates_keep_the_top_of_the_book(self):
+        book = LocalOrderBook()
+        book.apply_snapshot([('600.0', '1'), ('599.0', '2')],
+                [('601.0', '1'), ('602.0', '3')])
+        self.assertEqual(book.top(), (Decimal('600.0'), Decimal('1'),
+                Decimal('601.0'), Decimal('1')))
+
+        # A better bid comes in, the best ask is taken out
+        book.apply_update([('600.5', '0.5')], [('601.0', '0')])
+        self.assertEqual(book.top(), (Decimal('600.5'), Decimal('0.5'),
+                Decimal('602.0'), Decimal('3')))
+
+        # The best bid is taken out, the next one is the best again
+        book.apply_update([('600.5', '0')], [])
+        self.assertEqual(book.levels(5), (
+                [(Decimal('600.0'), Decimal('1')), (Decimal('599.0'), Decimal('2'))],
+                [(Decimal('602.0'), Decimal('3'))]))
+
+    def test_snapshot_replaces_the_book(self):
+        book = LocalOrderBook()
+        book.apply_snapshot([('600.0', '1')], [('601.0', '1')])
+        book.apply_snapshot([('500.0', '1')], [('501.0', '1')])
+        self.assertEqual(book.levels(5), ([(Decimal('500.0'), Decimal('1'))],
+                [(Decimal('501.0'), Decimal('1'))]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+from decimal import Decimal
+
+from xbtarbiter.fixedpoint import FixedLevels, PRICE_SCALE, VOLUME_SCALE, \
+        from_fixed, to_fixed, to_fixed_ceil
+
+
+class FixedPointTest(unittest.TestCase):
+    def test_exchange_strings_convert_exactly(self):
+        self.assertEqual(to_fixed('600.12345678', PRICE_SCALE), 60012345678)
+        self.assertEqual(to_fixed('0.00000001', VOLUME_SCALE), 1)
+        self.assertEqual(to_fixed('-1.5', PRICE_SCALE), -150000000)
+        self.assertEqual(to_fixed(3, VOLUME_SCALE), 300000000)
+        self.assertEqual(to_fixed(Decimal('1E-8'), VOLUME_SCALE), 1)
+
+    def test_extra_digits_are_rounded(self):
+        self.assertEqual(to_fixed('1.123456789', PRICE_SCALE), 112345678)
+        self.assertEqual(to_fixed_ceil('1.123456781', PRICE_SCALE), 112345679)
+
+    def test_round_trip(self):
+        for text in ('600.12345678', '0.00000001', '780.13', '-2.5'):
+            self.assertEqual(from_fixed(to_fixed(text, PRICE_SCALE), PRICE_SCALE),
+                    Decimal(text))
+
+    def test_levels_are_converted_when_first_reached(self):
+        levels = FixedLevels([('600.1', '1'), ('600.0', '2'), ('599.9', '3')])
+        self.assertEqual(levels.top(), (60010000000, 100000000))
+        self.assertEqual(len(levels._fixed), 1)
+        self.assertEqual([price for (price, _) in levels],
+                [60010000000, 60000000000, 59990000000])
+
+
+if __name__ == '__main__':
+    unittest.main()
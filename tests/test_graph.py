@@ -0,0 +1,63 @@
+import unittest
+from cStringIO import StringIO
+from decimal import Decimal
+
+from xbtarbiter import print_prices
+from xbtarbiter.errors import ExchangeError
+from xbtarbiter.graph import CurrencyGraph
+from xbtarbiter.replay import SimPlugin
+
+
+class _NoBookPlugin(SimPlugin):
+    """ Plugin whose first order book refresh failed, like Bitstamp's
+    before it got a book.
+    """
+    _order_book = None
+
+    def refresh_order_book(self):
+        raise ExchangeError('Connection timed out')
+
+    def fixed_book(self):
+        return (self._order_book['bids'], self._order_book['asks'])
+
+
+class PrintPricesTest(unittest.TestCase):
+    def test_plugin_without_book_is_skipped(self):
+        plugin = SimPlugin('sim', fee='0.2', usd='100', xbt='1')
+        plugin.load_order_book([(Decimal('600'), Decimal('1'))],
+                [(Decimal('601'), Decimal('1'))])
+        out = StringIO()
+        print_prices([plugin, _NoBookPlugin('nobook', fee='0.2', usd='100',
+                xbt='1')], out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('nobook '))
+        self.assertIn('refresh failed', lines[0])
+        self.assertTrue(lines[1].startswith('sim '))
+
+
+class CurrencyGraphTest(unittest.TestCase):
+    def test_conversion_fee_is_part_of_the_round_trip(self):
+        graph = CurrencyGraph()
+        graph.update_market('usd', 'XBT', 'USD', 600, 601, 0)
+        graph.update_market('eur', 'XBT', 'EUR', 470, 471, 0)
+        graph.update_market('forex', 'EUR', 'USD', 1.3, 1.3, 0)
+        # Buy for USD, sell for EUR and convert back: 470 * 1.3 / 601
+        best = graph.profitable_cycles()[0]
+        self.assertAlmostEqual(best.rate, 1.0166389, places=6)
+        graph.update_market('forex', 'EUR', 'USD', 1.3, 1.3, 2)
+        self.assertEqual(graph.profitable_cycles(), [])
+
+    def test_prices_label_the_round_trips(self):
+        usd = SimPlugin('usd', fee='0', usd='100', xbt='1')
+        usd.load_order_book([(Decimal('600'), Decimal('1'))],
+                [(Decimal('601'), Decimal('1'))])
+        dear = SimPlugin('dear', fee='0', usd='100', xbt='1')
+        dear.load_order_book([(Decimal('610'), Decimal('1'))],
+                [(Decimal('611'), Decimal('1'))])
+        out = StringIO()
+        print_prices([usd, dear], out)
+        self.assertIn("(not traded)", out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
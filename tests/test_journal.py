@@ -0,0 +1,68 @@
+import errno
+import shutil
+import tempfile
+import time
+import unittest
+
+from xbtarbiter.journal import Journal, read_journal
+
+
+class _FailingFile(object):
+    """ File whose writes fail while `failing` is set, like on a full disk.
+    """
+    def __init__(self, f):
+        self._file = f
+        self.failing = True
+
+    def write(self, data):
+        if self.failing:
+            raise IOError(errno.ENOSPC, 'No space left on device')
+        self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+def _wait_until(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _order_ids(self):
+        return [record['order_id'] for record in read_journal(self.directory)]
+
+    def test_unserializable_event_is_dropped(self):
+        journal = Journal(self.directory)
+        journal.log('order_open', order_id=1)
+        journal.log('order_open', order_id=object())
+        journal.log('order_open', order_id=3)
+        _wait_until(lambda: not journal._events)
+        journal.log('order_open', order_id=4)
+        journal.close()
+        self.assertEqual(self._order_ids(), [1, 3, 4])
+
+    def test_write_errors_are_retried(self):
+        journal = Journal(self.directory)
+        journal.log('order_open', order_id=1)
+        _wait_until(lambda: journal._file is not None and not journal._events)
+        failing = journal._file = _FailingFile(journal._file)
+        journal.log('order_open', order_id=2)
+        _wait_until(lambda: journal._error is not None)
+        journal.log('order_open', order_id=3)
+        self.assertTrue(journal._thread.is_alive())
+
+        failing.failing = False
+        journal.close()
+        self.assertEqual(self._order_ids(), [1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import threading
+import time
+import unittest
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+from xbtarbiter.nonce import NonceAllocator
+
+
+class NonceAllocatorTest(unittest.TestCase):
+    def test_strictly_increasing_across_threads(self):
+        allocator = NonceAllocator(1)
+        nonces = []
+
+        def allocate():
+            for _ in range(1000):
+                nonces.append(allocator.next())
+
+        threads = [threading.Thread(target=allocate) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(nonces)), len(nonces))
+
+    def test_order_is_not_starved_by_background_requests(self):
+        allocator = NonceAllocator(1)
+        acquired = []
+
+        def request(priority):
+            with allocator.ordered(priority):
+                acquired.append(priority)
+
+        ticket = allocator.ordered()
+        threads = [threading.Thread(target=request, args=(3,))
+                for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while len(allocator._order_lock._waiting) < 5:
+            time.sleep(0.001)
+        order = threading.Thread(target=request, args=(0,))
+        order.start()
+        while len(allocator._order_lock._waiting) < 6:
+            time.sleep(0.001)
+        ticket.release()
+        for thread in threads + [order]:
+            thread.join()
+        self.assertEqual(acquired, [0, 3, 3, 3, 3, 3])
+
+
+@unittest.skipIf(requests is None, "requests is not installed")
+class ConcurrentPrivateRequestsTest(unittest.TestCase):
+    def setUp(self):
+        from xbtarbiter.bench import connect_mock
+        from xbtarbiter.mockexchange import MockExchangeServer
+
+        # The jitter makes the server handle requests in a different order
+        # than they were sent in
+        self.server = MockExchangeServer(('127.0.0.1', 0), jitter=0.005, seed=0)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.plugins = connect_mock(self.server)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_no_invalid_nonces(self):
+        errors = []
+
+        def refresh(plugin):
+            try:
+                plugin.refresh_orders()
+            except Exception as e:
+                errors.append((plugin.name, str(e)))
+
+        for _ in range(5):
+            threads = [threading.Thread(target=refresh, args=(plugin,))
+                    for plugin in self.plugins
+                    for _ in range(12)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
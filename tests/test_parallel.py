@@ -0,0 +1,44 @@
+import time
+import unittest
+
+from xbtarbiter import refresh_order_books
+
+
+class _Plugin(object):
+    """ Exchange whose order book refresh takes `delay` seconds and raises
+    `error` if given.
+    """
+    def __init__(self, name, delay=0.0, error=None, book_timeout=1.0):
+        self.name = name
+        self.delay = delay
+        self.error = error
+        self.book_timeout = book_timeout
+        self.refreshed = False
+
+    def refresh_order_book(self):
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        self.refreshed = True
+
+
+class RefreshOrderBooksTest(unittest.TestCase):
+    def test_books_are_refreshed_concurrently(self):
+        plugins = [_Plugin('concurrent-{0}'.format(i), delay=0.3) for i in range(4)]
+        start = time.time()
+        self.assertEqual(refresh_order_books(plugins), plugins)
+        self.assertTrue(time.time() - start < 0.9)
+        self.assertTrue(all(plugin.refreshed for plugin in plugins))
+
+    def test_slow_and_failing_exchanges_are_skipped(self):
+        fast = _Plugin('fast')
+        slow = _Plugin('slow', delay=2.0, book_timeout=0.2)
+        failing = _Plugin('failing', error=ValueError("Exchange is down"))
+        start = time.time()
+        self.assertEqual(refresh_order_books([fast, slow, failing]), [fast])
+        # The slow exchange doesn't hold up the others
+        self.assertTrue(time.time() - start < 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
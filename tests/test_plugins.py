@@ -0,0 +1,69 @@
+import threading
+import unittest
+from decimal import Decimal
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+from xbtarbiter.fixedpoint import from_fixed, PRICE_SCALE
+
+
+@unittest.skipIf(requests is None, "requests is not installed")
+class OrderPriceTest(unittest.TestCase):
+    def setUp(self):
+        from xbtarbiter.bench import connect_mock
+        from xbtarbiter.mockexchange import MockExchangeServer
+
+        self.server = MockExchangeServer(('127.0.0.1', 0), seed=0)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        (self.bitstamp, self.kraken) = connect_mock(self.server,
+                eurusd_rate=Decimal('1.3'))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _posted_prices(self, plugin, price):
+        """ Price fields of a buy and a sell order at the limit price.
+        """
+        posted = []
+        http_post = plugin._http_post
+
+        def record(path, data={}):
+            if 'price' in data:
+                posted.append(data['price'])
+            return http_post(path, data)
+        plugin._http_post = record
+        plugin.create_bid_order(Decimal('0.01'), price)
+        plugin.create_ask_order(Decimal('0.01'), price)
+        return posted
+
+    def test_bitstamp_prices_have_two_decimals(self):
+        # Limits come from the fixed-point walk
+        price = from_fixed(60012000000, PRICE_SCALE)
+        self.assertEqual(self._posted_prices(self.bitstamp, price),
+                ['600.12', '600.12'])
+        price = from_fixed(60012500000, PRICE_SCALE)
+        self.assertEqual(self._posted_prices(self.bitstamp, price),
+                ['600.13', '600.12'])
+
+    def test_kraken_prices_are_rounded_to_the_tick(self):
+        # 600.05 EUR converted to USD
+        price = from_fixed(78006500000, PRICE_SCALE)
+        self.assertEqual(self._posted_prices(self.kraken, price),
+                ['600.1', '600.0'])
+
+    def test_kraken_conversion_costs_the_forex_fee(self):
+        from xbtarbiter.forex import DEFAULT_CONVERSION_FEE
+        self.kraken.refresh_order_book()
+        markets = dict((market[0], market) for market in self.kraken.graph_markets())
+        self.assertEqual(markets['forex EUR/USD'][3:],
+                (Decimal('1.3'), Decimal('1.3'), DEFAULT_CONVERSION_FEE))
+
+
+if __name__ == '__main__':
+    unittest.main()
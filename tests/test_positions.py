@@ -0,0 +1,171 @@
+import unittest
+from decimal import Decimal
+
+from xbtarbiter.account import AccountState
+from xbtarbiter.errors import ExchangeError
+from xbtarbiter.journal import EVENT_ORDER_CLOSE, EVENT_ORDER_CANCEL
+from xbtarbiter.orders import ORDER_OPEN, ORDER_CLOSED, ORDER_CANCELLED, \
+        DEFAULT_MAX_MISSES
+from xbtarbiter.positions import PositionManager
+
+
+class _Order(object):
+    def __init__(self, oid, otype):
+        self.oid = oid
+        self.otype = otype
+        self.volume = Decimal('1')
+        self.price = Decimal('100')
+
+
+class _Plugin(object):
+    """ Exchange whose orders have the statuses in `statuses` - open,
+    closed, cancelled or anything else for an order it doesn't list.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.statuses = {}
+        self.account = AccountState(lambda: {
+                'balance_xbt': Decimal('10'),
+                'balance_fiat': Decimal('1000'),
+                'avail_xbt': Decimal('10'),
+                'avail_fiat': Decimal('1000'),
+                'fee': Decimal('0'),
+            })
+        self.account.reconcile()
+
+    def refresh_open_orders(self):
+        pass
+
+    def refresh_closed_orders(self):
+        pass
+
+    def find_order_status(self, order):
+        status = self.statuses[order.oid]
+        return status if status in (ORDER_OPEN, ORDER_CANCELLED) else None
+
+    def get_order_status(self, order, refresh=True):
+        status = self.statuses[order.oid]
+        if status != ORDER_CLOSED:
+            raise ExchangeError('Order not found')
+        return status
+
+
+class _Journal(object):
+    def __init__(self):
+        self.events = []
+
+    def log(self, event, **fields):
+        self.events.append((event, fields['order_id']))
+
+
+class PositionManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.buyer = _Plugin('buyer')
+        self.seller = _Plugin('seller')
+        self.journal = _Journal()
+        self.positions = PositionManager(1, self.journal)
+
+    def _open(self, buy_oid, sell_oid):
+        buy_order = _Order(buy_oid, 'bid')
+        sell_order = _Order(sell_oid, 'ask')
+        self.buyer.account.order_submitted(buy_order)
+        self.seller.account.order_submitted(sell_order)
+        self.positions.add({
+                'ask_plugin': self.buyer,
+                'bid_plugin': self.seller,
+                'volume': Decimal('1'),
+                'profit': Decimal('1'),
+            }, buy_order, sell_order)
+        return (buy_order, sell_order)
+
+    def test_cancelled_order_frees_the_slot(self):
+        self._open('b1', 's1')
+        self.buyer.statuses['b1'] = ORDER_CANCELLED
+        self.seller.statuses['s1'] = ORDER_OPEN
+        self.assertEqual(self.positions.poll(), [])
+        self.assertFalse(self.positions.has_capacity)
+        # The cancelled order's funds are available again
+        self.assertEqual(self.buyer.account.avail_fiat, Decimal('1000'))
+        self.assertEqual(self.seller.account.avail_xbt, Decimal('9'))
+
+        self.seller.statuses['s1'] = ORDER_CLOSED
+        closed = self.positions.poll()
+        self.assertEqual(len(closed), 1)
+        self.assertEqual(closed[0].cancelled_orders, set([('buyer', 'b1')]))
+        self.assertTrue(self.positions.has_capacity)
+        self.assertEqual(self.journal.events,
+                [(EVENT_ORDER_CANCEL, 'b1'), (EVENT_ORDER_CLOSE, 's1')])
+
+    def test_order_not_listed_yet_keeps_its_funds(self):
+        self._open('b1', 's1')
+        self.buyer.statuses['b1'] = 'not listed'
+        self.seller.statuses['s1'] = ORDER_CLOSED
+        self.assertEqual(self.positions.poll(), [])
+        self.assertEqual(self.buyer.account.avail_fiat, Decimal('900'))
+
+        # It was filled
+        self.buyer.statuses['b1'] = ORDER_CLOSED
+        closed = self.positions.poll()
+        self.assertEqual(len(closed), 1)
+        self.assertEqual(closed[0].cancelled_orders, set())
+        self.assertEqual(self.buyer.account.balance_xbt, Decimal('11'))
+        self.assertEqual(self.buyer.account.avail_fiat, Decimal('900'))
+        self.assertEqual(self.journal.events,
+                [(EVENT_ORDER_CLOSE, 's1'), (EVENT_ORDER_CLOSE, 'b1')])
+
+    def test_missing_order_does_not_block_the_others(self):
+        self._open('b1', 's1')
+        self.positions.max_positions = 2
+        self._open('b2', 's2')
+        self.buyer.statuses.update({'b1': 'gone', 'b2': ORDER_CLOSED})
+        self.seller.statuses.update({'s1': 'gone', 's2': ORDER_CLOSED})
+        closed = self.positions.poll()
+        self.assertEqual([position.pid for position in closed], [2])
+        for _ in range(DEFAULT_MAX_MISSES - 1):
+            closed = self.positions.poll()
+        self.assertEqual([position.pid for position in closed], [1])
+        self.assertEqual(closed[0].missing_orders,
+                set([('buyer', 'b1'), ('seller', 's1')]))
+        self.assertEqual(self.positions.positions, [])
+        # The missing orders are neither released nor journalled
+        self.assertEqual(self.buyer.account.avail_fiat, Decimal('800'))
+        self.assertEqual(self.seller.account.avail_xbt, Decimal('8'))
+        self.assertEqual(self.journal.events,
+                [(EVENT_ORDER_CLOSE, 'b2'), (EVENT_ORDER_CLOSE, 's2')])
+
+
+class PositionFillTest(unittest.TestCase):
+    def test_filled_position_closes_and_frees_its_slot(self):
+        buyer = _Plugin('buyer')
+        seller = _Plugin('seller')
+        journal = _Journal()
+        positions = PositionManager(2, journal)
+        for (buy_oid, sell_oid) in (('b1', 's1'), ('b2', 's2')):
+            buy_order = _Order(buy_oid, 'bid')
+            sell_order = _Order(sell_oid, 'ask')
+            buyer.account.order_submitted(buy_order)
+            seller.account.order_submitted(sell_order)
+            positions.add({
+                    'ask_plugin': buyer,
+                    'bid_plugin': seller,
+                    'volume': Decimal('1'),
+                    'profit': Decimal('1'),
+                }, buy_order, sell_order)
+        self.assertFalse(positions.has_capacity)
+
+        buyer.statuses.update({'b1': ORDER_CLOSED, 'b2': ORDER_OPEN})
+        seller.statuses.update({'s1': ORDER_CLOSED, 's2': ORDER_OPEN})
+        self.assertEqual([position.pid for position in positions.poll()], [1])
+        self.assertTrue(positions.has_capacity)
+        self.assertEqual([position.pid for position in positions.positions], [2])
+        # The filled orders moved their funds, the open ones keep theirs
+        # reserved
+        self.assertEqual((buyer.account.balance_xbt, buyer.account.balance_fiat,
+                buyer.account.avail_fiat), (11, 900, 800))
+        self.assertEqual((seller.account.balance_xbt, seller.account.avail_xbt,
+                seller.account.balance_fiat), (9, 8, 1100))
+        self.assertEqual(sorted(journal.events),
+                [(EVENT_ORDER_CLOSE, 'b1'), (EVENT_ORDER_CLOSE, 's1')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import threading
+import time
+import unittest
+
+from xbtarbiter.kraken import KrakenPlugin
+from xbtarbiter.ratelimit import RequestScheduler, PRIORITY_BOOK, PRIORITY_STATUS
+
+
+def _wait_until(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+class RequestSchedulerTest(unittest.TestCase):
+    def test_kraken_book_refresh_waits_for_status_polls(self):
+        scheduler = RequestScheduler(capacity=1, rate=1.0)
+        scheduler.acquire(PRIORITY_STATUS)
+        sent = []
+
+        def request(priority, cost):
+            scheduler.acquire(priority, cost)
+            sent.append(priority)
+
+        book = threading.Thread(target=request, args=(PRIORITY_BOOK,
+                KrakenPlugin.REQUEST_COSTS['public/Depth']))
+        book.start()
+        _wait_until(lambda: scheduler._waiting)
+        status = threading.Thread(target=request, args=(PRIORITY_STATUS, 0.1))
+        status.start()
+        book.join()
+        status.join()
+        self.assertEqual(sent, [PRIORITY_STATUS, PRIORITY_BOOK])
+        self.assertEqual(scheduler.stats.requests[PRIORITY_BOOK], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import unittest
+from decimal import Decimal
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+from xbtarbiter import recorder
+from xbtarbiter.recorder import BookReader, BookRecorder, BookWriter
+
+
+BIDS = [(Decimal('600'), Decimal('1'))]
+ASKS = [(Decimal('601'), Decimal('2'))]
+
+
+class _Plugin(object):
+    name = 'sim'
+    order_book_ts = 1000.0
+
+    def iter_bids(self):
+        return iter(BIDS)
+
+    def iter_asks(self):
+        return iter(ASKS)
+
+
+class BookWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'sim.xbr')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, count, start=0):
+        writer = BookWriter(self.path)
+        for i in range(start, start + count):
+            writer.append(1000 + i, [(Decimal(600 + i), Decimal('1'))], ASKS)
+        writer.close()
+
+    def test_new_recording_drops_stale_index(self):
+        with open(self.path + '.idx', 'wb') as f:
+            f.write(struct.pack('<qQ', 5000 * 10 ** 6, 1))
+        self._write(3)
+        reader = BookReader(self.path)
+        self.assertEqual(reader._index_pos, [0])
+        self.assertEqual(reader.find(1001), 1)
+
+    def test_append_drops_index_entries_without_records(self):
+        self._write(3)
+        # An index entry written just before the process died
+        with open(self.path + '.idx', 'ab') as f:
+            f.write(struct.pack('<qQ', 9000 * 10 ** 6, 3))
+        self._write(2, start=3)
+        reader = BookReader(self.path)
+        self.assertEqual(len(reader), 5)
+        with open(self.path + '.idx', 'rb') as f:
+            self.assertEqual(len(f.read()), struct.calcsize('<qQ'))
+        self.assertEqual(reader.find(1004), 4)
+
+    def test_older_version_is_not_appended_to(self):
+        with open(self.path, 'wb') as f:
+            f.write(struct.pack('<4sHHII', 'XBTR', 1, recorder.DEFAULT_DEPTH,
+                    10 ** 5, 10 ** 8))
+        self.assertRaises(ValueError, BookWriter, self.path)
+
+    def test_recorder_close_writes_buffered_snapshots(self):
+        books = BookRecorder(self.directory)
+        books.record(_Plugin())
+        books.close()
+        reader = BookReader(recorder.recording_path(self.directory, 'sim'))
+        self.assertEqual(len(reader), 1)
+        self.assertEqual(reader.snapshot(0), (1000.0, BIDS, ASKS))
+
+
+@unittest.skipIf(requests is None, "requests is not installed")
+class KrakenRecordingTest(unittest.TestCase):
+    def setUp(self):
+        from xbtarbiter.bench import connect_mock
+        from xbtarbiter.mockexchange import MockExchangeServer
+
+        self.directory = tempfile.mkdtemp()
+        self.server = MockExchangeServer(('127.0.0.1', 0), seed=0)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        (_, self.kraken) = connect_mock(self.server, eurusd_rate=Decimal('1.36789'))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_converted_price_round_trips(self):
+        plugin = self.kraken
+        plugin.load_order_book([('600.1', '1.5')], [('600.3', '2')])
+        books = BookRecorder(self.directory)
+        books.record(plugin)
+        books.close()
+        reader = BookReader(recorder.recording_path(self.directory, plugin.name))
+        (_, bids, asks) = reader.snapshot(0)
+        self.assertEqual(bids, [(Decimal('820.870789'), Decimal('1.5'))])
+        self.assertEqual(bids, list(plugin.iter_bids()))
+        self.assertEqual(asks, list(plugin.iter_asks()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from xbtarbiter import registry
+
+
+ENTRY_POINTS = """[console_scripts]
+other = other:main
+
+[xbtarbiter.plugins]
+myexchange = myexchange:create_plugin
+"""
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        metadata = os.path.join(self.directory, 'myexchange-1.0.dist-info')
+        os.mkdir(metadata)
+        with open(os.path.join(metadata, 'entry_points.txt'), 'w') as f:
+            f.write(ENTRY_POINTS)
+        sys.path.append(self.directory)
+
+    def tearDown(self):
+        sys.path.remove(self.directory)
+        shutil.rmtree(self.directory)
+
+    def test_names_of_entry_points(self):
+        self.assertEqual(registry.plugin_names(), ['bitstamp', 'kraken', 'myexchange'])
+        self.assertTrue(registry.is_plugin('myexchange'))
+        self.assertFalse(registry.is_plugin('other'))
+
+    def test_names_without_pkg_resources(self):
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = ("import sys; from xbtarbiter.registry import plugin_names; "
+                "plugin_names(); sys.exit('pkg_resources' in sys.modules)")
+        self.assertEqual(subprocess.call([sys.executable, '-c', code],
+                cwd=package_dir), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+from decimal import Decimal
+
+from xbtarbiter import OpportunityFinder
+from xbtarbiter.replay import SimPlugin, replay, synthetic_events
+
+
+def _replay(events):
+    # The defaults of the replay command
+    return replay(events, min_profit=Decimal('0'),
+            max_volume=Decimal('0.01'), fee=Decimal('0.25'),
+            usd=Decimal('10000'), xbt=Decimal('10'))
+
+
+def _summary(result):
+    return (result.cycles, result.opportunities, result.trades,
+            result.theoretical_profit, result.realized_profit)
+
+
+class SyntheticReplayTest(unittest.TestCase):
+    def test_default_fee_trades(self):
+        result = _replay(synthetic_events(200))
+        self.assertGreater(result.opportunities, 0)
+        self.assertGreater(result.trades, 0)
+        self.assertGreater(result.realized_profit, 0)
+
+    def test_runs_are_independent(self):
+        first = _summary(_replay(synthetic_events(300, markets=3)))
+        self.assertEqual(_summary(_replay(synthetic_events(300, markets=3))), first)
+        # A single market can't trade with the markets of the runs before
+        result = _replay(synthetic_events(1))
+        self.assertEqual((result.opportunities, result.trades), (0, 0))
+
+
+class OpportunityFinderTest(unittest.TestCase):
+    def test_markets_left_out_are_dropped(self):
+        cheap = SimPlugin('cheap', fee='0.2', usd='1000', xbt='1')
+        cheap.load_order_book([(Decimal('590'), Decimal('1'))],
+                [(Decimal('591'), Decimal('1'))])
+        dear = SimPlugin('dear', fee='0.2', usd='1000', xbt='1')
+        dear.load_order_book([(Decimal('610'), Decimal('1'))],
+                [(Decimal('611'), Decimal('1'))])
+        finder = OpportunityFinder()
+        self.assertEqual(len(finder.find_opportunities([cheap, dear],
+                Decimal('0.01'), refresh=False)), 1)
+        # e.g. the feed of `dear` disconnected
+        self.assertEqual(finder.find_opportunities([cheap], Decimal('0.01'),
+                refresh=False), [])
+        self.assertEqual(finder.find_best_opportunity([cheap], Decimal('0.01'),
+                Decimal('0'), refresh=False), (None, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
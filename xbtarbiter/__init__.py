@@ -3,51 +3,91 @@ XBT exchange arbiter.
 
 Usage:
   xbtarbiter [--plugins=<plugins>] balance
-  xbtarbiter [--plugins=<plugins>] prices
+  xbtarbiter [--plugins=<plugins>] prices [--book-timeout=<seconds>]
   xbtarbiter [--plugins=<plugins>] orders
-  xbtarbiter [--plugins=<plugins>] trading [--dry-run] [--min-profit=<profit>] [--max-volume=<volume>] [--no-confirm]
+  xbtarbiter [--plugins=<plugins>] stats [--cycles=<n>]
+  xbtarbiter [--plugins=<plugins>] daemon [--book-timeout=<seconds>]
+  xbtarbiter [--plugins=<plugins>] trading [--dry-run] [--min-profit=<profit>] [--max-volume=<volume>] [--max-positions=<n>] [--no-confirm] [--book-timeout=<seconds>] [--stream] [--record=<dir>]
+  xbtarbiter replay [<recording>...] [--synthetic=<cycles>] [--min-profit=<profit>] [--max-volume=<volume>] [--fee=<percent>] [--usd=<amount>] [--xbt=<amount>]
+  xbtarbiter benchmark [--cycles=<n>] [--latency=<seconds>] [--jitter=<seconds>] [--error-rate=<rate>]
+  xbtarbiter mockserver [--listen=<address>] [--latency=<seconds>] [--jitter=<seconds>] [--error-rate=<rate>]
+  xbtarbiter feedserver <exchange> [--listen=<address>] [--interval=<seconds>] [--mid=<price>]
   xbtarbiter (-h | --help)
 
 Commands:
   balance   print account balance
   prices    print current highest-bid and lowest-ask prices
   orders    print open orders for each market
+  stats     time the requests of trading cycles and print latencies per endpoint
+  daemon    keep the plugins connected and serve balance, prices, orders and stats
+            to the commands above (which fall back to running locally without it)
   trading   start interactive trading
+  replay    replay recorded (or synthetic) order books through the trading logic
+  benchmark   measure latencies and requests of the commands against the mock exchange server
+  mockserver  run a local mock of the Bitstamp and Kraken HTTP APIs
+  feedserver  run a local stand-in order book stream of an exchange (bitstamp or kraken)
 
 Options:
   --dry-run               Dry-run operation
   --min-profit=<profit>   Min profit to make a trade (in USD) [default: 0.0]
   --max-volume=<volume>   Max volume to trade in one order (in XBT) [default: 0.01]
+  --max-positions=<n>     Max number of positions (pairs of orders) waiting for fills at a time [default: 1]
   --no-confirm            Trade automatically, do not confirm trades
+  --book-timeout=<seconds>  Max time to wait for an order book, slower exchanges are skipped [default: 5.0]
+  --stream                Trade on order book updates pushed by the exchange feeds
+  --record=<dir>          Record order book snapshots into the directory
   --plugins=<pluginlist>  Comma-separated list of plugins to enable [default: all]
+  --synthetic=<cycles>    Replay the given number of synthetic order book updates
+  --fee=<percent>         Trade fee of the replayed markets [default: 0.25]
+  --usd=<amount>          Initial USD balance of each replayed market [default: 10000]
+  --xbt=<amount>          Initial XBT balance of each replayed market [default: 10]
+  --cycles=<n>            Number of cycles of each benchmark/stats run [default: 20]
+  --latency=<seconds>     Latency added by the mock server to every request [default: 0.0]
+  --jitter=<seconds>      Max random delay added by the mock server [default: 0.0]
+  --error-rate=<rate>     Probability of a mock server request failing [default: 0.0]
+  --listen=<address>      Address for the feed/mock server to listen on [default: localhost:9001]
+  --interval=<seconds>    Time between feed server updates [default: 0.5]
+  --mid=<price>           Initial mid price of the feed server book [default: 600.0]
 
 Available Plugins:
   bitstamp
   kraken
 """
+import atexit
 import os
 import sys
 import time
-import gnupg
-try:
-    import simplejson as json
-except ImportError:
-    import json
 from docopt import docopt
 from decimal import Decimal
 from datetime import datetime
 from getpass import getpass
 
-from bitstamp import BitstampPlugin, BitstampException, BitstampOrder
-from kraken import KrakenPlugin, KrakenException
-from forex import get_eurusd
+# Heavy modules (exchange plugins, requests, gnupg) are imported only
+# by the commands which need them, see registry.py
+from errors import ExchangeError
+from registry import is_plugin, load_plugin_factory, plugin_names
+from parallel import wait_all
+from asyncplugin import AsyncPlugin
+from depth import walk_books_fixed
+from graph import CurrencyGraph, update_from_plugins, remove_from_plugins
+from bookindex import BookIndex
+from fixedpoint import (fixed_book, to_fixed, from_fixed, FEE_SCALE,
+        HUNDRED_PERCENT, MONEY_SCALE, PRICE_SCALE, VOLUME_SCALE)
+from orders import OrderTracker, ORDER_CANCELLED
+from latency import print_latency_stats, format_latency_summary
+from ratelimit import format_budget_summary
+from journal import (EVENT_OPPORTUNITY, EVENT_ORDER_OPEN, EVENT_ORDER_CLOSE,
+        EVENT_ORDER_CANCEL, EVENT_ORDER_FAILED)
 
 
 # Path to the default config file
 DEFAULT_CFG_FILE="~/.xbtarbiter/config.gpg"
 
-# Path to the default config file
-DEFAULT_LOG_FILE="~/.xbtarbiter/orders.log"
+# Directory of the order journal
+DEFAULT_JOURNAL_DIR="~/.xbtarbiter/journal"
+
+# Path to the socket of the daemon
+DEFAULT_SOCKET_FILE="~/.xbtarbiter/daemon.sock"
 
 
 ORDER_OPEN = 'open'
@@ -56,12 +96,22 @@ ORDER_CLOSED = 'closed'
 # Minimum trade volume the exchanges will allow (in XBT)
 MIN_TRADE_VOLUME = Decimal('0.01')
 
-def print_account_balance(plugins):
+# Time between order status polls while waiting for orders to close (in
+# seconds)
+ORDER_POLL_INTERVAL = 2.0
+
+# How far back the journal is checked for unresolved orders (in seconds)
+JOURNAL_LOOKBACK = 7 * 24 * 3600
+
+# Time between request latency summaries while trading (in seconds)
+LATENCY_SUMMARY_INTERVAL = 60.0
+
+def print_account_balance(plugins, out=None):
     total_xbt = 0
     total_usd = 0
 
     for plugin in plugins:
-        print "{market:20}  {bal_xbt: >11.8f} XBT    {bal_usd: >10.5f} USD    [fee {fee:.3}%]".format(
+        print >>out, "{market:20}  {bal_xbt: >11.8f} XBT    {bal_usd: >10.5f} USD    [fee {fee:.3}%]".format(
                 market=plugin.name,
                 bal_xbt=plugin.balance_xbt,
                 bal_usd=plugin.balance_usd,
@@ -69,103 +119,350 @@ def print_account_balance(plugins):
         total_xbt += plugin.balance_xbt
         total_usd += plugin.balance_usd
 
-    print '-' * 80
-    print ' ' * 23 + '{total_xbt: >10.8f} XBT    {total_usd: >10.5f} USD'.format(
+    print >>out, '-' * 80
+    print >>out, ' ' * 23 + '{total_xbt: >10.8f} XBT    {total_usd: >10.5f} USD'.format(
             total_xbt=total_xbt, total_usd=total_usd)
 
 
-def print_prices(plugins):
-    for plugin in plugins:
-        plugin.refresh_order_book()
-        print "{market:20}  BID {bid_vol: >11.8f} @ {bid_price: <10.5f} USD    ASK {ask_vol: >11.8f} @ {ask_price: <10.5f} USD".format(
+def print_prices(plugins, out=None):
+    fresh = refresh_order_books(plugins, out)
+    for plugin in fresh:
+        print >>out, "{market:20}  BID {bid_vol: >11.8f} @ {bid_price: <10.5f} USD    ASK {ask_vol: >11.8f} @ {ask_price: <10.5f} USD".format(
                 market=plugin.name,
                 bid_vol=plugin.highest_bid['volume'],
                 bid_price=plugin.highest_bid['price'],
                 ask_vol=plugin.lowest_ask['volume'],
                 ask_price=plugin.lowest_ask['price'])
 
-
-def print_open_orders(plugins):
+    # Round trips through the markets which are profitable at the top of
+    # the books, for information only - trade() executes two-leg pairs and
+    # never converts currencies. The graph is kept across commands served
+    # by the daemon, so only changed prices are re-evaluated.
+    remove_from_plugins(_currency_graph, [plugin for plugin in plugins
+            if plugin not in fresh])
+    update_from_plugins(_currency_graph, fresh)
+    cycles = _currency_graph.profitable_cycles()
+    if cycles:
+        print >>out, "--"
+        print >>out, "Round trips at the top of the books (not traded):"
+        for cycle in cycles:
+            print >>out, cycle
+
+
+def print_open_orders(plugins, out=None):
     for plugin in plugins:
-        plugin.refresh_orders()
-        print "{market} orders:".format(market=plugin.name)
+        plugin.refresh_open_orders()
+        print >>out, "{market} orders:".format(market=plugin.name)
         if plugin.open_orders:
             for order in plugin.open_orders:
-                print order
+                print >>out, order
                 # print "  {oid}: {otype}".format(oid=order.oid, otype=order.otype)
         else:
-            print "  [none]"
+            print >>out, "  [none]"
 
 
-def calc_opportunity(bid_plugin, ask_plugin, max_volume):
-    """ Determine whether bid/ask order pair is profitable or not. Take
-    transaction fees into account as well.
+def print_request_stats(plugins, cycles, out=None):
+    """ Send the requests of `cycles` trading cycles (order books, orders
+    and balances) and print their latencies and how much of the request
+    budgets they used.
+
+    :param out: File to print to (default is sys.stdout)
     """
-    bid = bid_plugin.highest_bid
-    bid_fee = bid_plugin.trade_fee
-    ask = ask_plugin.lowest_ask
-    ask_fee = ask_plugin.trade_fee
-
-    # Calculate max. available volume on the markets, the max. possible profit
-    # and corresponding fees
-    mkt_volume = min(bid['volume'], ask['volume'])
-    mkt_buy_total = ask['price'] * mkt_volume
-    mkt_buy_fee = ask['price'] * (ask_fee / 100) * mkt_volume
-    mkt_sell_total = bid['price'] * mkt_volume
-    mkt_sell_fee = bid['price'] * (bid_fee / 100) * mkt_volume
-    mkt_fees = mkt_sell_fee + mkt_buy_fee
-    mkt_profit = mkt_sell_total - mkt_buy_total - mkt_fees
-
-    # Calculate the affordable volume
-    can_buy_volume = ask_plugin.avail_usd / (ask['price'] * (1 + (ask_fee / 100)))
-    can_sell_volume = bid_plugin.avail_xbt / (1 + (bid_fee / 100))
-    affordable_volume = min(can_buy_volume, can_sell_volume)
-
-    # Calculate the volume we will eventually trade, the profit and fees
-    volume = min(mkt_volume, affordable_volume, max_volume)
-    buy_total = ask['price'] * volume
-    buy_fee = ask['price'] * (ask_fee / 100) * volume
-    sell_total = bid['price'] * volume
-    sell_fee = bid['price'] * (bid_fee / 100) * volume
-    fees = sell_fee + buy_fee
-    profit = sell_total - buy_total - fees
+    for _ in range(cycles):
+        refresh_order_books(plugins, out)
+        for plugin in plugins:
+            plugin.refresh_orders()
+            plugin.account.reconcile()
+    print_latency_stats(plugins, out)
+    print >>out
+    for plugin in plugins:
+        print >>out, format_budget_summary(plugin)
+
+
+def _fixed_state(plugin):
+    """ Convert the inputs of the opportunity computation of a plugin to
+    fixed-point, once per cycle instead of once per pair.
+    """
+    (bids, asks) = fixed_book(plugin)
+    return {
+            'bids': bids,
+            'asks': asks,
+            'fee': to_fixed(plugin.trade_fee, FEE_SCALE),
+            'avail_usd': to_fixed(plugin.avail_usd, PRICE_SCALE),
+            'avail_xbt': to_fixed(plugin.avail_xbt, VOLUME_SCALE),
+        }
+
+
+def _walk_market(bid_state, ask_state):
+    # Max. available volume on the markets, the max. possible profit and
+    # corresponding fees
+    return walk_books_fixed(bid_state['bids'], ask_state['asks'],
+            bid_state['fee'], ask_state['fee'])
+
+
+def _walk_trade(bid_state, ask_state, max_volume):
+    # The volume we will eventually trade, the profit and fees (limited by
+    # the affordable volume and max. volume, which is in satoshis)
+    return walk_books_fixed(bid_state['bids'], ask_state['asks'],
+            bid_state['fee'], ask_state['fee'],
+            avail_usd=ask_state['avail_usd'],
+            avail_xbt=bid_state['avail_xbt'],
+            max_volume=max_volume)
+
+
+def _opportunity(bid_plugin, ask_plugin, mkt, trade):
+    """ Convert the fixed-point results of a pair to an opportunity.
+    """
+    money = lambda value: from_fixed(value, MONEY_SCALE)
+    price = lambda value: from_fixed(value, PRICE_SCALE) if value is not None else None
+    volume = trade['volume']
+    # Volume-weighted prices, rounded to PRICE_SCALE units
+    buy_price = price(trade['buy_total'] // volume) if volume else None
+    sell_price = price(trade['sell_total'] // volume) if volume else None
 
     return {
             'bid_plugin': bid_plugin,
             'ask_plugin': ask_plugin,
 
-            'mkt_volume': mkt_volume,
-            'mkt_buy_total': mkt_sell_total,
-            'mkt_buy_fee': mkt_sell_fee,
-            'mkt_sell_total': mkt_sell_total,
-            'mkt_sell_fee': mkt_sell_fee,
-            'mkt_fees': mkt_fees,
-            'mkt_profit': mkt_profit,
-
-            'volume': volume,
-            'buy_total': buy_total,
-            'buy_fee': buy_fee,
-            'sell_total': sell_total,
-            'sell_fee': sell_fee,
-            'fees': fees,
-            'profit': profit,
+            'mkt_volume': from_fixed(mkt['volume'], VOLUME_SCALE),
+            'mkt_buy_total': money(mkt['buy_total']),
+            'mkt_buy_fee': money(mkt['buy_fee']),
+            'mkt_sell_total': money(mkt['sell_total']),
+            'mkt_sell_fee': money(mkt['sell_fee']),
+            'mkt_fees': money(mkt['fees']),
+            'mkt_profit': money(mkt['profit']),
+
+            'volume': from_fixed(volume, VOLUME_SCALE),
+            'buy_total': money(trade['buy_total']),
+            'buy_fee': money(trade['buy_fee']),
+            'buy_price': buy_price,
+            'buy_limit': price(trade['buy_limit']),
+            'sell_total': money(trade['sell_total']),
+            'sell_fee': money(trade['sell_fee']),
+            'sell_price': sell_price,
+            'sell_limit': price(trade['sell_limit']),
+            'fees': money(trade['fees']),
+            'profit': money(trade['profit']),
         }
 
 
-def find_opportunities(plugins, max_volume):
-    """ Find profitable opportunities.
+def calc_opportunity(bid_plugin, ask_plugin, max_volume):
+    """ Determine whether bid/ask order pair is profitable or not. Take
+    transaction fees into account as well.
+
+    Both order books are walked level by level, so the opportunity covers
+    every level where the spread is still profitable, not just the best bid
+    and ask. The walk runs in fixed-point integers (see fixedpoint.py), only
+    the results are converted to Decimal.
+    """
+    bid_state = _fixed_state(bid_plugin)
+    ask_state = _fixed_state(ask_plugin)
+    return _opportunity(bid_plugin, ask_plugin,
+            _walk_market(bid_state, ask_state),
+            _walk_trade(bid_state, ask_state, to_fixed(max_volume, VOLUME_SCALE)))
+
+
+# Order book refreshes which timed out and are still running, by plugin name
+_pending_refreshes = {}
+
+# Currency graph of the markets, for the routes printed by print_prices()
+_currency_graph = CurrencyGraph()
+
+def refresh_order_books(plugins, out=None):
+    """ Refresh order books of all plugins concurrently.
+
+    Plugins whose refresh fails or doesn't finish within the plugin's
+    `book_timeout` are dropped from the current cycle, so one slow exchange
+    doesn't hold up the others.
+
+    :param out: File to print the skipped plugins to (default is sys.stdout)
+    :return: List of plugins with a freshly refreshed order book
     """
+    calls = []
     for plugin in plugins:
-        plugin.refresh_order_book()
+        pending = _pending_refreshes.get(plugin.name)
+        if pending is not None and not pending.done:
+            print >>out, "{market:20}  previous order book refresh still running, skipping".format(
+                    market=plugin.name)
+            continue
+        calls.append((plugin, AsyncPlugin(plugin).refresh_order_book()))
+
+    wait_all([result for (plugin, result) in calls],
+            [plugin.book_timeout for (plugin, result) in calls])
+    results = dict(calls)
+
+    fresh = []
+    for plugin in plugins:
+        result = results.get(plugin)
+        if result is None:
+            continue
+        if not result.done:
+            print >>out, "{market:20}  order book refresh timed out after {timeout}s, skipping".format(
+                    market=plugin.name,
+                    timeout=plugin.book_timeout)
+            _pending_refreshes[plugin.name] = result
+        elif result.error is not None:
+            print >>out, "{market:20}  order book refresh failed: {error}".format(
+                    market=plugin.name,
+                    error=result.error)
+        else:
+            fresh.append(plugin)
+    return fresh
+
 
-    result = []
-    for bid_plugin in plugins:
-        for ask_plugin in plugins:
-            if bid_plugin.name != ask_plugin.name:
-                opportunity = calc_opportunity(bid_plugin, ask_plugin, max_volume)
-                if opportunity['mkt_profit'] > 0:
-                    result.append(opportunity)
-    return result
+class OpportunityFinder(object):
+    """ Evaluates the pairs of markets cycle after cycle - the best bids and
+    asks are kept in a book index across cycles, and the last result is
+    kept for when nothing has changed.
+
+    Every caller (the trading loop, a replay) has its own finder, the
+    markets of one never show up in the results of the other.
+    """
+    def __init__(self):
+        self.index = BookIndex()
+        # Last result of find_opportunities() and find_best_opportunity()
+        # with the inputs it was computed from, by method name
+        self._last_results = {}
+
+    def _update_index(self, plugins, refresh):
+        """ Refresh the order books (optionally) and make the book index
+        hold exactly the plugins with a fresh book.
+
+        :return: List of plugins with a fresh book
+        """
+        if refresh:
+            plugins = refresh_order_books(plugins)
+        # Markets left out of this cycle (a failed refresh, a disconnected
+        # feed) sit it out
+        names = set(plugin.name for plugin in plugins)
+        for name in list(self.index.plugins):
+            if name not in names:
+                self.index.remove(name)
+        for plugin in plugins:
+            self.index.update(plugin)
+        return plugins
+
+    def _evaluation_key(self, plugins, *args):
+        """ Inputs of the opportunity computation, equal for two cycles only
+        if nothing has changed in between.
+
+        Plugins cache their fixed-point books and replace them only when the
+        book (or a conversion rate) changes - a refresh which got the same
+        book from the exchange keeps the object, which compares equal to
+        itself.
+        """
+        return tuple((plugin, fixed_book(plugin), plugin.trade_fee,
+                plugin.avail_usd, plugin.avail_xbt) for plugin in plugins) + args
+
+    def _cached_result(self, name, key):
+        """ The last result of `name` if it was computed from the same
+        inputs, else None.
+        """
+        last = self._last_results.get(name)
+        if last is not None and last[0] == key:
+            return last
+        return None
+
+    def find_opportunities(self, plugins, max_volume, refresh=True):
+        """ Find profitable opportunities.
+
+        If no order book, fee or balance has changed since the last call,
+        the last result is returned without evaluating the pairs again.
+
+        :param refresh: Refresh the order books first. Books maintained by
+            streaming feeds are up to date already.
+        """
+        plugins = self._update_index(plugins, refresh)
+        key = self._evaluation_key(plugins, max_volume)
+        cached = self._cached_result('find_opportunities', key)
+        if cached is not None:
+            return cached[1]
+
+        # Only pairs which are profitable at the top of the books can be
+        # profitable deeper in the books - the book index lists them without
+        # looking at the other pairs. The pairs are evaluated like in
+        # calc_opportunity(), but each plugin is converted to fixed-point
+        # once and only profitable pairs are converted back.
+        max_volume = to_fixed(max_volume, VOLUME_SCALE)
+        states = {}
+        result = []
+        for (margin, bid_plugin, ask_plugin) in self.index.candidates():
+            for plugin in (bid_plugin, ask_plugin):
+                if plugin.name not in states:
+                    states[plugin.name] = _fixed_state(plugin)
+            bid_state = states[bid_plugin.name]
+            ask_state = states[ask_plugin.name]
+            mkt = _walk_market(bid_state, ask_state)
+            if mkt['profit'] > 0:
+                result.append(_opportunity(bid_plugin, ask_plugin, mkt,
+                        _walk_trade(bid_state, ask_state, max_volume)))
+        self._last_results['find_opportunities'] = (key, result)
+        return result
+
+    def find_best_opportunity(self, plugins, max_volume, min_profit,
+            refresh=True):
+        """ Find the best opportunity for trading, like find_opportunities()
+        followed by get_best_opportunity(), but only the pairs which can
+        still beat the best one found so far are evaluated.
+
+        The profit of a pair can't be higher than its margin at the top of
+        the books times `max_volume`, and the book index lists the pairs by
+        their margin - once that bound drops below the best profit, the
+        remaining pairs are skipped. Like find_opportunities(), nothing is
+        evaluated if nothing has changed since the last call.
+
+        :return: (opportunity, profitable) tuple - the best opportunity with
+            at least `min_profit` or None, and whether any pair is
+            profitable at all
+        """
+        plugins = self._update_index(plugins, refresh)
+        key = self._evaluation_key(plugins, max_volume, min_profit)
+        cached = self._cached_result('find_best_opportunity', key)
+        if cached is not None:
+            return cached[1]
+
+        max_volume = to_fixed(max_volume, VOLUME_SCALE)
+        # Profits are in MONEY_SCALE units, margins are scaled by 100 percent
+        threshold = to_fixed(min_profit, MONEY_SCALE)
+        states = {}
+        best = None
+        profitable = False
+        for (margin, bid_plugin, ask_plugin) in self.index.candidates():
+            bound = -(-margin * max_volume // HUNDRED_PERCENT)
+            if bound < threshold or (best is not None and bound <= best[2]['profit']):
+                # The pairs left are profitable at the top of the books, but
+                # can't reach min_profit or beat the best one
+                profitable = True
+                break
+            for plugin in (bid_plugin, ask_plugin):
+                if plugin.name not in states:
+                    states[plugin.name] = _fixed_state(plugin)
+            bid_state = states[bid_plugin.name]
+            ask_state = states[ask_plugin.name]
+            mkt = _walk_market(bid_state, ask_state)
+            if mkt['profit'] <= 0:
+                continue
+            profitable = True
+            trade = _walk_trade(bid_state, ask_state, max_volume)
+            if trade['profit'] >= threshold and \
+                    (best is None or trade['profit'] > best[2]['profit']):
+                best = (bid_plugin, ask_plugin, trade, mkt)
+        if best is not None:
+            (bid_plugin, ask_plugin, trade, mkt) = best
+            best = _opportunity(bid_plugin, ask_plugin, mkt, trade)
+        self._last_results['find_best_opportunity'] = (key, (best, profitable))
+        return (best, profitable)
+
+
+def find_opportunities(plugins, max_volume, refresh=True, finder=None):
+    """ Find profitable opportunities, see OpportunityFinder.
+
+    :param finder: OpportunityFinder of the caller's previous cycles
+        (default is a new one)
+    """
+    if finder is None:
+        finder = OpportunityFinder()
+    return finder.find_opportunities(plugins, max_volume, refresh)
 
 
 def get_best_opportunity(opportunities, min_profit):
@@ -179,19 +476,98 @@ def get_best_opportunity(opportunities, min_profit):
     return best
 
 
-def trade(plugins, min_profit, max_volume, logfile, confirm=True, dry_run=False):
+def find_best_opportunity(plugins, max_volume, min_profit, refresh=True,
+        finder=None):
+    """ Find the best opportunity for trading, see OpportunityFinder.
+
+    :param finder: OpportunityFinder of the caller's previous cycles
+        (default is a new one)
+    """
+    if finder is None:
+        finder = OpportunityFinder()
+    return finder.find_best_opportunity(plugins, max_volume, min_profit,
+            refresh)
+
+
+def submit_legs(ask_plugin, bid_plugin, volume, buy_price, sell_price, journal):
+    """ Send the BUY order to the ask market and the SELL order to the bid
+    market concurrently.
+
+    If one of the orders fails, the other one is cancelled and the error is
+    raised.
+
+    :return: (buy_order, sell_order) tuple
+    """
+    buy = AsyncPlugin(ask_plugin).create_bid_order(volume=volume, price=buy_price)
+    sell = AsyncPlugin(bid_plugin).create_ask_order(volume=volume, price=sell_price)
+    wait_all([buy, sell])
+
+    legs = (
+            (buy, ask_plugin, 'BUY', buy_price),
+            (sell, bid_plugin, 'SELL', sell_price),
+        )
+    for (result, plugin, side, price) in legs:
+        if result.error is not None:
+            journal.log(EVENT_ORDER_FAILED, market=plugin.name,
+                    side=side, volume=volume, price=price,
+                    error=str(result.error), latency=result.elapsed)
+            print "{market:20}  {side} order failed after {elapsed:.3f}s: {error}".format(
+                    market=plugin.name,
+                    side=side,
+                    elapsed=result.elapsed,
+                    error=result.error)
+            continue
+        journal.log(EVENT_ORDER_OPEN, market=plugin.name,
+                side=side, order_id=result.value.oid, volume=volume,
+                price=price, latency=result.elapsed)
+        print "{market:20}  {side} order '{order_id}' [submitted in {elapsed:.3f}s]".format(
+                market=plugin.name,
+                side=side,
+                order_id=result.value.oid,
+                elapsed=result.elapsed)
+
+    if buy.error is None and sell.error is None:
+        return (buy.value, sell.value)
+
+    # One leg failed - don't leave the other one hanging
+    for (result, plugin, side, price) in legs:
+        if result.error is None:
+            try:
+                plugin.cancel_order(result.value)
+                journal.log(EVENT_ORDER_CANCEL, market=plugin.name,
+                        side=side, order_id=result.value.oid)
+                print "{market:20}  {side} order '{order_id}' cancelled".format(
+                        market=plugin.name,
+                        side=side,
+                        order_id=result.value.oid)
+            except Exception as e:
+                print "{market:20}  cancelling {side} order '{order_id}' failed: {error}".format(
+                        market=plugin.name,
+                        side=side,
+                        order_id=result.value.oid,
+                        error=e)
+    raise buy.error or sell.error
+
+
+def trade(plugins, min_profit, max_volume, journal, confirm=True, dry_run=False,
+        refresh=True, positions=None, finder=None):
     """ Find a profitable opportunity and perform a trade.
 
     :param plugins: Plugins.
     :param min_profit: Min. profit that must exist before entering trade orders.
     :param max_volume: Max. volume in XBT to trade.
-    :param logfile: File-like object for logging trade orders.
+    :param journal: Journal of the opportunities and orders.
     :param confirm: Confirm trade manually.
     :param dry-run: Dry-run mode.
+    :param refresh: Refresh the order books before looking for opportunities.
+    :param positions: PositionManager to hand the orders over to. Without
+        it, wait here until the orders are closed.
+    :param finder: OpportunityFinder kept across the trading cycles
     """
-    # Find profitable opportunities
-    opportunities = find_opportunities(plugins, max_volume)
-    if not opportunities:
+    # Find the best opportunity
+    (opportunity, profitable) = find_best_opportunity(plugins, max_volume,
+            min_profit, refresh=refresh, finder=finder)
+    if not profitable:
         print "No profitable opportunities exist on the markets."
         print
         if confirm:
@@ -199,8 +575,6 @@ def trade(plugins, min_profit, max_volume, logfile, confirm=True, dry_run=False)
             sys.stdin.readline()
         return
 
-    # Find the best opportunity
-    opportunity = get_best_opportunity(opportunities, min_profit)
     if opportunity is None:
         print "No opportunities with profit greater than {0:.5f} USD were found".format(min_profit)
         print
@@ -225,15 +599,17 @@ def trade(plugins, min_profit, max_volume, logfile, confirm=True, dry_run=False)
 
     # Print what will be bought/sold
     if opportunity['volume'] >= MIN_TRADE_VOLUME:
-        print "{market:20}  BUY  {volume: >11.8f} XBT for {buy_total: >10.5f} USD  [fee {buy_fee:.5} USD]".format(
+        print "{market:20}  BUY  {volume: >11.8f} XBT for {buy_total: >10.5f} USD  [avg {buy_price:.5f}, fee {buy_fee:.5} USD]".format(
                 market=ask_plugin.name,
                 volume=opportunity['volume'],
                 buy_total=opportunity['buy_total'],
+                buy_price=opportunity['buy_price'],
                 buy_fee=opportunity['buy_fee'])
-        print "{market:20}  SELL {volume: >11.8f} XBT for {sell_total: >10.5f} USD  [fee {sell_fee:.5} USD]".format(
+        print "{market:20}  SELL {volume: >11.8f} XBT for {sell_total: >10.5f} USD  [avg {sell_price:.5f}, fee {sell_fee:.5} USD]".format(
                 market=bid_plugin.name,
                 volume=opportunity['volume'],
                 sell_total=opportunity['sell_total'],
+                sell_price=opportunity['sell_price'],
                 sell_fee=opportunity['sell_fee'])
         print " " * 22 + "FEES                     {fees: >10.5f} USD".format(
                 fees=opportunity['fees'])
@@ -247,64 +623,71 @@ def trade(plugins, min_profit, max_volume, logfile, confirm=True, dry_run=False)
             answer = sys.stdin.readline().strip()
         if not confirm or answer in ('', 'y'):
             if not dry_run:
-                # Send BUY order
-                buy_order = ask_plugin.create_bid_order(
-                        volume=opportunity['volume'],
-                        price=ask['price'])
-                print "{market:20}  BUY order {order_id}".format(
-                        market=ask_plugin.name,
-                        order_id=buy_order.oid)
-                logfile.write("{ts}  {market} open BUY order {order_id}: VOLUME {volume:11.8f} XBT  PRICE {price:10.5f} USD\n".format(
-                        ts=datetime.now().isoformat(' '),
-                        market=ask_plugin.name,
-                        order_id=buy_order.oid,
-                        volume=opportunity['volume'],
-                        price=ask['price']))
-
-                # Send SELL order
-                sell_order = bid_plugin.create_ask_order(
+                # Send BUY and SELL orders at the same time
+                (buy_order, sell_order) = submit_legs(ask_plugin, bid_plugin,
                         volume=opportunity['volume'],
-                        price=bid['price'])
-                print "{market:20}  SELL order '{order_id}'".format(
-                        market=bid_plugin.name,
-                        order_id=sell_order.oid)
-                logfile.write("{ts}  {market} open SELL order {order_id}: VOLUME {volume:11.8f} XBT  PRICE {price:10.5f} USD\n".format(
-                        ts=datetime.now().isoformat(' '),
-                        market=bid_plugin.name,
-                        order_id=sell_order.oid,
+                        buy_price=opportunity['buy_limit'],
+                        sell_price=opportunity['sell_limit'],
+                        journal=journal)
+                journal.log(EVENT_OPPORTUNITY,
+                        ask_market=ask_plugin.name,
+                        bid_market=bid_plugin.name,
                         volume=opportunity['volume'],
-                        price=bid['price']))
+                        buy_price=opportunity['buy_price'],
+                        sell_price=opportunity['sell_price'],
+                        fees=opportunity['fees'],
+                        profit=opportunity['profit'],
+                        buy_order_id=buy_order.oid,
+                        sell_order_id=sell_order.oid)
+
+                if positions is not None:
+                    # The fills are watched in the background
+                    position = positions.add(opportunity, buy_order, sell_order)
+                    print "Opened {position} [{count}/{max_positions} open]".format(
+                            position=position,
+                            count=len(positions.positions),
+                            max_positions=positions.max_positions)
+                    print
+                    return
 
                 # Wait until the orders are closed
-                open_buy_orders = [buy_order]
-                open_sell_orders = [sell_order]
-                while open_buy_orders or open_sell_orders:
-                    for buy_order in open_buy_orders:
-                        status = ask_plugin.get_order_status(buy_order)
+                buy_tracker = OrderTracker(ask_plugin)
+                buy_tracker.track(buy_order)
+                sell_tracker = OrderTracker(bid_plugin)
+                sell_tracker.track(sell_order)
+                while True:
+                    for (buy_order, status) in buy_tracker.poll():
                         print "{market:20}  BUY order '{order_id}': {status}".format(
                                 market=ask_plugin.name,
                                 order_id=buy_order.oid,
                                 status=status)
                         if status == ORDER_CLOSED:
-                            logfile.write("{ts}  {market} close BUY order {order_id}\n".format(
-                                    ts=datetime.now().isoformat(' '),
-                                    market=ask_plugin.name,
-                                    order_id=buy_order.oid))
-                            open_buy_orders.remove(buy_order)
-
-                    for sell_order in open_sell_orders:
-                        status = bid_plugin.get_order_status(sell_order)
+                            journal.log(EVENT_ORDER_CLOSE,
+                                    market=ask_plugin.name, side='BUY',
+                                    order_id=buy_order.oid)
+                        elif status == ORDER_CANCELLED:
+                            journal.log(EVENT_ORDER_CANCEL,
+                                    market=ask_plugin.name, side='BUY',
+                                    order_id=buy_order.oid)
+
+                    for (sell_order, status) in sell_tracker.poll():
                         print "{market:20}  SELL order '{order_id}': {status}".format(
                                 market=bid_plugin.name,
                                 order_id=sell_order.oid,
                                 status=status)
                         if status == ORDER_CLOSED:
-                            logfile.write("{ts}  {market} close SELL order {order_id}\n".format(
-                                    ts=datetime.now().isoformat(' '),
-                                    market=bid_plugin.name,
-                                    order_id=sell_order.oid))
-                            open_sell_orders.remove(sell_order)
+                            journal.log(EVENT_ORDER_CLOSE,
+                                    market=bid_plugin.name, side='SELL',
+                                    order_id=sell_order.oid)
+                        elif status == ORDER_CANCELLED:
+                            journal.log(EVENT_ORDER_CANCEL,
+                                    market=bid_plugin.name, side='SELL',
+                                    order_id=sell_order.oid)
                     print
+
+                    if not buy_tracker.orders and not sell_tracker.orders:
+                        break
+                    time.sleep(ORDER_POLL_INTERVAL)
         else:
             print "Skipping."
             print
@@ -326,31 +709,18 @@ def trade(plugins, min_profit, max_volume, logfile, confirm=True, dry_run=False)
 
 
 
-def connect(enabled_plugins, cfg):
+def connect(enabled_plugins, cfg, book_timeout):
     plugins = []
 
-    # Connect to Bitstamp
-    if 'bitstamp' in enabled_plugins:
+    for name in enabled_plugins:
+        create_plugin = load_plugin_factory(name)
         try:
-            print "Connecting to Bitstamp ..."
-            bitstamp_cfg = cfg['plugins']['bitstamp.net']
-            bitstamp = BitstampPlugin(client_id=bitstamp_cfg['client_id'],
-                    key=bitstamp_cfg['key'],
-                    secret=str(bitstamp_cfg['secret']))
-            plugins.append(bitstamp)
-        except BitstampException as e:
-            print "Failed to connect: {0}".format(str(e))
-
-    # Connect to Kraken
-    if 'kraken' in enabled_plugins:
-        try:
-            print "Connecting to Kraken ..."
-            kraken_cfg = cfg['plugins']['kraken.com']
-            kraken = KrakenPlugin(key=kraken_cfg['key'],
-                    secret=kraken_cfg['secret'],
-                    eurusd_rate=get_eurusd())
-            plugins.append(kraken)
-        except KrakenException as e:
+            print "Connecting to {0} ...".format(name)
+            plugin = create_plugin(cfg, book_timeout)
+            # Name the plugin was enabled by, plugin.name is for display
+            plugin.plugin_name = name
+            plugins.append(plugin)
+        except ExchangeError as e:
             print "Failed to connect: {0}".format(str(e))
 
     print
@@ -359,6 +729,12 @@ def connect(enabled_plugins, cfg):
 
 
 def read_config(path):
+    import gnupg
+    try:
+        import simplejson as json
+    except ImportError:
+        import json
+
     gpg = gnupg.GPG()
     with open(os.path.expanduser(path), 'r') as cfgfile:
         data = cfgfile.read()
@@ -371,42 +747,126 @@ def read_config(path):
                 cfg = json.loads(crypt.data)
                 return cfg
 
-def open_logfile(path):
-    return open(os.path.expanduser(path), 'a')
+def open_journal(cfg):
+    """ Open the order journal configured in the optional 'journal' section
+    of the config.
+    """
+    from journal import Journal, FSYNC_INTERVAL, DEFAULT_MAX_SIZE
+    journal_cfg = cfg.get('journal', {})
+    return Journal(journal_cfg.get('path', DEFAULT_JOURNAL_DIR),
+            fsync=journal_cfg.get('fsync', FSYNC_INTERVAL),
+            fsync_interval=float(journal_cfg.get('fsync_interval', 1.0)),
+            max_size=int(journal_cfg.get('max_size', DEFAULT_MAX_SIZE)))
 
 
 
 def main():
-    # TODO: allow opening --max-positions trades. After --max-positions is
-    # reached wait until at least one position is closed.
     # TODO: use logging module to log into file. Or at least encapsulate
     # logging into functions.
     # TODO: Create btc-e.com plugin
     try:
         opts = docopt(__doc__)
 
+        if opts['replay']:
+            # Offline replay, --min-profit and --max-volume may be
+            # comma-separated lists of values to sweep
+            from replay import recorded_events, recording_paths, synthetic_events, replay, print_result
+            if opts['--synthetic']:
+                events = lambda: synthetic_events(int(opts['--synthetic']))
+            elif opts['<recording>']:
+                paths = recording_paths(opts['<recording>'])
+                events = lambda: recorded_events(paths)
+            else:
+                raise ValueError("Specify recordings to replay or --synthetic")
+            for min_profit in opts['--min-profit'].split(','):
+                for max_volume in opts['--max-volume'].split(','):
+                    result = replay(events(),
+                            min_profit=Decimal(min_profit),
+                            max_volume=Decimal(max_volume),
+                            fee=Decimal(opts['--fee']),
+                            usd=Decimal(opts['--usd']),
+                            xbt=Decimal(opts['--xbt']))
+                    print_result(result)
+            return
+
+        if opts['benchmark']:
+            from bench import run_benchmarks, measure_pricing, measure_startup
+            for result in run_benchmarks(cycles=int(opts['--cycles']),
+                    latency=float(opts['--latency']),
+                    jitter=float(opts['--jitter']),
+                    error_rate=float(opts['--error-rate'])):
+                print result
+            print measure_pricing()
+            for result in measure_startup():
+                print result
+            return
+
+        if opts['mockserver']:
+            from feed import parse_address
+            from mockexchange import MockExchangeServer
+            server = MockExchangeServer(parse_address(opts['--listen']),
+                    latency=float(opts['--latency']),
+                    jitter=float(opts['--jitter']),
+                    error_rate=float(opts['--error-rate']))
+            print "Serving mock Bitstamp API on {0}".format(server.url('bitstamp'))
+            print "Serving mock Kraken API on {0}".format(server.url('kraken'))
+            server.serve_forever()
+            return
+
+        if opts['feedserver']:
+            # Serve a synthetic order book stream, no config needed
+            from feed import parse_address
+            from feedserver import FeedServer
+            server = FeedServer(parse_address(opts['--listen']),
+                    exchange=opts['<exchange>'],
+                    interval=float(opts['--interval']),
+                    mid=float(opts['--mid']))
+            print "Serving {exchange} order book stream on ws://{address}".format(
+                    exchange=opts['<exchange>'], address=opts['--listen'])
+            server.serve_forever()
+            return
+
         # Sanity checks
         if Decimal(opts['--min-profit']) < 0:
             raise ValueError("Value of --min-profit must be greater than or equal to 0")
         if Decimal(opts['--max-volume']) < MIN_TRADE_VOLUME:
             raise ValueError("Value of --max-volume must be greater than or equal to {0} XBT".format(
                     MIN_TRADE_VOLUME))
+        if float(opts['--book-timeout']) <= 0:
+            raise ValueError("Value of --book-timeout must be greater than 0")
+        if int(opts['--max-positions']) < 1:
+            raise ValueError("Value of --max-positions must be at least 1")
         if opts['--plugins'] == 'all':
-            enabled_plugins = ['bitstamp', 'kraken']
+            enabled_plugins = plugin_names()
         else:
             enabled_plugins = []
             for plugin in opts['--plugins'].split(','):
-                if plugin in ('bitstamp', 'kraken'):
+                if is_plugin(plugin):
                     enabled_plugins.append(plugin)
                 else:
                     raise ValueError("Unknown plugin: {0}".format(plugin))
 
+        # Let a running daemon answer, it has the config and the plugins
+        # ready
+        from daemon import COMMANDS, DaemonUnavailable, send_command
+        command = [c for c in COMMANDS if opts[c]]
+        if command:
+            # Only these commands wait for the order books
+            book_timeout = float(opts['--book-timeout']) \
+                    if command[0] in ('prices', 'stats') else None
+            try:
+                sys.stdout.write(send_command(DEFAULT_SOCKET_FILE, command[0],
+                        plugins=enabled_plugins, cycles=int(opts['--cycles']),
+                        book_timeout=book_timeout))
+                return
+            except DaemonUnavailable:
+                pass
 
         # Read config
         cfg = read_config(DEFAULT_CFG_FILE)
 
         # Connect to exchanges
-        plugins = connect(enabled_plugins, cfg)
+        plugins = connect(enabled_plugins, cfg, float(opts['--book-timeout']))
 
         if opts['balance']:
             # Print account information for each market
@@ -417,13 +877,32 @@ def main():
         elif opts['orders']:
             # Print open orders for each market
             print_open_orders(plugins)
+        elif opts['stats']:
+            # Print request latencies for each market
+            print_request_stats(plugins, int(opts['--cycles']))
+        elif opts['daemon']:
+            # Serve the commands above over the socket
+            from daemon import ArbiterDaemon
+            for plugin in plugins:
+                plugin.account.start()
+            server = ArbiterDaemon(DEFAULT_SOCKET_FILE, plugins,
+                    float(opts['--book-timeout']))
+            print "Serving on {0}".format(server.path)
+            try:
+                server.serve_forever()
+            finally:
+                server.server_close()
         elif opts['trading']:
             # Interactive trading
             dry_run = opts['--dry-run']
             no_confirm = opts['--no-confirm']
             min_profit = Decimal(opts['--min-profit'])
             max_volume = Decimal(opts['--max-volume'])
-            logfile = open_logfile(DEFAULT_LOG_FILE)
+            max_positions = int(opts['--max-positions'])
+            stream = opts['--stream']
+            journal = open_journal(cfg)
+            # The writer thread is a daemon, write what's queued on exit
+            atexit.register(journal.close)
 
             if dry_run:
                 print "=" * 80
@@ -439,44 +918,106 @@ def main():
 
             print "-" * 80
             print "Max volume is {0} XBT".format(max_volume)
+            print "Max open positions is {0}".format(max_positions)
             print "-" * 80
             print
 
+            # Orders of previous runs which were never seen closed
+            from journal import unresolved_orders
+            unresolved = unresolved_orders(journal.directory,
+                    start=time.time() - JOURNAL_LOOKBACK)
+            if unresolved:
+                print "Orders in the journal without a close or cancel:"
+                for (market, order_id) in sorted(unresolved):
+                    print "{market:20}  {side} order '{order_id}'".format(
+                            market=market,
+                            side=unresolved[(market, order_id)]['side'],
+                            order_id=order_id)
+                print
+
+            # Record the order books
+            recorder = None
+            if opts['--record']:
+                from recorder import BookRecorder
+                recorder = BookRecorder(opts['--record'])
+                # Snapshots are buffered, write them on exit
+                atexit.register(recorder.close)
+                for plugin in plugins:
+                    plugin.recorder = recorder
+
+            # Keep the account balances reconciled with the exchanges
+            for plugin in plugins:
+                plugin.account.start()
+
+            # Streaming mode - books are kept up to date by the feeds and
+            # opportunities are evaluated whenever a book top changes
+            feeds = []
+            if stream:
+                from Queue import Queue
+                from feed import start_feeds, wait_for_update
+                feeds = start_feeds(plugins, Queue())
+
+            # Positions are watched in the background, the scanner keeps
+            # going until --max-positions are open
+            from positions import PositionManager
+            positions = PositionManager(max_positions, journal,
+                    poll_interval=ORDER_POLL_INTERVAL).start()
+
+            # Keeps the book index of the markets across the cycles
+            finder = OpportunityFinder()
+
             ntrade = 1
+            last_summary = time.time()
             while True:
                 try:
+                    if not positions.has_capacity:
+                        print "{0} positions open, waiting for one to close ...".format(
+                                max_positions)
+                        print
+                        while not positions.wait_for_capacity(ORDER_POLL_INTERVAL):
+                            pass
+
+                    active_plugins = plugins
+                    if feeds:
+                        wait_for_update(feeds[0].events)
+                        active_plugins = []
+                        for feed in feeds:
+                            if feed.live:
+                                feed.install()
+                                active_plugins.append(feed.plugin)
+
                     print "{ts} #{ntrade}".format(
                             ts=datetime.now().isoformat(' '),
                             ntrade=ntrade)
                     print "--"
                     ntrade += 1
-                    trade(plugins=plugins,
+                    trade(plugins=active_plugins,
                             min_profit=min_profit,
                             max_volume=max_volume,
-                            logfile=logfile,
+                            journal=journal,
                             confirm=not no_confirm,
-                            dry_run=dry_run)
-
-                    if no_confirm:
+                            dry_run=dry_run,
+                            refresh=not feeds,
+                            positions=positions,
+                            finder=finder)
+
+                    if time.time() - last_summary >= LATENCY_SUMMARY_INTERVAL:
+                        for plugin in plugins:
+                            print format_latency_summary(plugin)
+                            print format_budget_summary(plugin)
+                        print
+                        last_summary = time.time()
+
+                    if no_confirm and not feeds:
                         time.sleep(10)
 
-                except MtgoxException as e:
-                    print "Mtgox.com: {0}".format(e)
-                    print
-                except BitstampException as e:
-                    print "Bitstamp.net: {0}".format(e)
-                    print
-                except KrakenException as e:
-                    print "Kraken.com: {0}".format(e)
+                except ExchangeError as e:
+                    print "{0}: {1}".format(e.exchange, e)
                     print
 
     except KeyboardInterrupt:
         pass
-    except MtgoxException as e:
-        print "Mtgox.com: {0}".format(e)
-    except BitstampException as e:
-        print "Bitstamp.net: {0}".format(e)
-    except KrakenException as e:
-        print "Kraken.com: {0}".format(e)
+    except ExchangeError as e:
+        print "{0}: {1}".format(e.exchange, e)
     except ValueError as e:
         print e
@@ -0,0 +1,203 @@
+""" Locally maintained account state.
+"""
+import threading
+import time
+from decimal import Decimal
+
+
+class AccountState(object):
+    """ Account balances and trade fee of one exchange, kept up to date
+    locally.
+
+    Balances are adjusted when our orders are submitted, filled or
+    cancelled, so they are accurate without asking the exchange every cycle.
+    They are reconciled with the exchange periodically, preferably when no
+    order is in flight. Orders submitted while the balances are being
+    fetched keep their funds reserved, as do the orders still open on
+    exchanges which don't subtract them from the available balances. The
+    trade fee changes rarely, it's refreshed in the background when its TTL
+    expires - reading it never makes a request.
+
+    Fiat amounts are in the exchange's own currency.
+
+    :param fetch_balances: Callable returning a dictionary with
+        'balance_xbt', 'balance_fiat', 'avail_xbt' and 'avail_fiat' and
+        optionally 'fee' (if the exchange reports it together with balances)
+    :param fetch_fee: Callable returning the trade fee (in percent), for
+        exchanges whose fetch_balances() doesn't return it. Without it, the
+        fee is only updated by reconciliations.
+    :param reconcile_interval: Time between reconciliations (in seconds)
+    :param fee_ttl: Max. age of the cached fee (in seconds)
+    :param reserves_orders: Whether the available balances reported by the
+        exchange already exclude the funds of open orders
+    :param fetch_open_orders: Callable returning the IDs of the orders open
+        on the exchange, for exchanges which don't reserve the funds of open
+        orders. Our orders which aren't open anymore are settled by a
+        reconciliation, the balances include their fills.
+    """
+    def __init__(self, fetch_balances, fetch_fee=None, reconcile_interval=60.0,
+            fee_ttl=3600.0, reserves_orders=True, fetch_open_orders=None):
+        self._fetch_balances = fetch_balances
+        self._fetch_fee = fetch_fee
+        self._fetch_open_orders = fetch_open_orders
+        self.reserves_orders = reserves_orders
+        self.reconcile_interval = reconcile_interval
+        self.fee_ttl = fee_ttl
+
+        self.balance_xbt = Decimal('0')
+        self.balance_fiat = Decimal('0')
+        self.avail_xbt = Decimal('0')
+        self.avail_fiat = Decimal('0')
+        self.reconciled_at = None
+        self._fee = None
+        self._fee_fetched_at = None
+        self._pending = {}
+        self._lock = threading.RLock()
+        self._thread = None
+
+        self.reconcile()
+        if self._fee is None and self._fetch_fee is not None:
+            self.refresh_fee()
+
+    @property
+    def trade_fee(self):
+        """ Trade fee (in percent), as of the last refresh.
+        """
+        return self._fee
+
+    def refresh_fee(self):
+        """ Fetch the trade fee from the exchange.
+        """
+        fee = Decimal(self._fetch_fee())
+        with self._lock:
+            self._fee = fee
+            self._fee_fetched_at = time.time()
+
+    def maybe_refresh_fee(self):
+        """ Refresh the trade fee if its TTL has expired.
+        """
+        if self._fetch_fee is None:
+            return False
+        if self._fee_fetched_at is not None and \
+                time.time() - self._fee_fetched_at < self.fee_ttl:
+            return False
+        self.refresh_fee()
+        return True
+
+    def reconcile(self):
+        """ Replace the local state with the balances reported by the
+        exchange.
+        """
+        with self._lock:
+            known = set(self._pending)
+        open_orders = None
+        if not self.reserves_orders and self._fetch_open_orders is not None:
+            # Listed before the balances are fetched - an order which closes
+            # in between is settled by order_filled() instead
+            open_orders = set(self._fetch_open_orders())
+        balances = self._fetch_balances()
+        with self._lock:
+            self.balance_xbt = balances['balance_xbt']
+            self.balance_fiat = balances['balance_fiat']
+            self.avail_xbt = balances['avail_xbt']
+            self.avail_fiat = balances['avail_fiat']
+            if 'fee' in balances:
+                self._fee = balances['fee']
+                self._fee_fetched_at = time.time()
+            if self.reserves_orders:
+                # The exchange accounts for the orders it knew about, orders
+                # submitted during the fetch may be missing from its numbers
+                for oid in known:
+                    self._pending.pop(oid, None)
+            elif open_orders is not None:
+                # Fills of the orders which aren't open anymore are in the
+                # balances already, applying them again would count them
+                # twice
+                for oid in known - open_orders:
+                    self._pending.pop(oid, None)
+            for order in self._pending.values():
+                self._reserve(order)
+            self.reconciled_at = time.time()
+
+    def maybe_reconcile(self):
+        """ Reconcile if it's due and no order is in flight. If orders have
+        been in flight for too long (e.g. we missed a fill or cancellation),
+        reconcile anyway - the orders the exchange doesn't account for keep
+        their funds reserved.
+        """
+        age = time.time() - self.reconciled_at
+        if age < self.reconcile_interval:
+            return False
+        if self._pending and age < 3 * self.reconcile_interval:
+            return False
+        self.reconcile()
+        return True
+
+    def start(self):
+        """ Start reconciling and refreshing the fee periodically in the
+        background.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            time.sleep(self.reconcile_interval / 4)
+            try:
+                self.maybe_reconcile()
+            except Exception as e:
+                print "Failed to reconcile account state: {0}".format(e)
+            try:
+                self.maybe_refresh_fee()
+            except Exception as e:
+                print "Failed to refresh the trade fee: {0}".format(e)
+
+    def _fiat_amount(self, order, fee_sign):
+        return order.volume * order.price * (1 + fee_sign * self.trade_fee / 100)
+
+    def _reserve(self, order):
+        if order.otype == 'bid':
+            self.avail_fiat -= self._fiat_amount(order, 1)
+        else:
+            self.avail_xbt -= order.volume
+
+    def order_submitted(self, order):
+        """ Reserve the funds of a new order. The order must have `otype`
+        ('bid' or 'ask'), `volume` and `price` (in fiat) set.
+        """
+        with self._lock:
+            self._reserve(order)
+            self._pending[order.oid] = order
+
+    def order_filled(self, order):
+        """ Move the funds of a filled order.
+        """
+        with self._lock:
+            if order.oid not in self._pending:
+                # Already accounted for by a reconciliation
+                return
+            if order.otype == 'bid':
+                self.balance_fiat -= self._fiat_amount(order, 1)
+                self.balance_xbt += order.volume
+                self.avail_xbt += order.volume
+            else:
+                self.balance_xbt -= order.volume
+                self.balance_fiat += self._fiat_amount(order, -1)
+                self.avail_fiat += self._fiat_amount(order, -1)
+            self._pending.pop(order.oid, None)
+
+    def order_cancelled(self, order):
+        """ Release the funds reserved by a cancelled order.
+        """
+        with self._lock:
+            if order.oid not in self._pending:
+                # Already accounted for by a reconciliation
+                return
+            if order.otype == 'bid':
+                self.avail_fiat += self._fiat_amount(order, 1)
+            else:
+                self.avail_xbt += order.volume
+            self._pending.pop(order.oid, None)
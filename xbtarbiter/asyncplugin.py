@@ -0,0 +1,68 @@
+""" Asynchronous interface of the exchange plugins.
+
+AsyncPlugin wraps a (blocking) plugin and starts its calls on a WorkerPool -
+every method returns a CallResult right away, which can be waited for or
+given a callback when the request is done:
+
+    kraken = AsyncPlugin(plugin)
+    book = kraken.refresh_order_book()
+    orders = kraken.refresh_orders()
+    wait_all([book, orders])
+
+Anything else is looked up on the wrapped plugin, so an AsyncPlugin can be
+passed wherever a plugin is expected.
+"""
+from parallel import default_pool, wait_all
+
+
+class AsyncPlugin(object):
+    """ Plugin whose requests don't block the caller.
+
+    :param plugin: Plugin to wrap
+    :param pool: WorkerPool to run the requests on (default_pool() by
+        default)
+    """
+    def __init__(self, plugin, pool=None):
+        self.plugin = plugin
+        self.pool = pool or default_pool()
+
+    def _submit(self, name, func, *args, **kwargs):
+        return self.pool.submit((self.plugin.name, name), func, *args, **kwargs)
+
+    def refresh_order_book(self):
+        return self._submit('refresh_order_book', self.plugin.refresh_order_book)
+
+    def refresh_orders(self):
+        return self._submit('refresh_orders', self.plugin.refresh_orders)
+
+    def refresh_account_info(self):
+        return self._submit('refresh_account_info', self.plugin.refresh_account_info)
+
+    def create_bid_order(self, volume, price):
+        return self._submit('create_bid_order', self.plugin.create_bid_order,
+                volume=volume, price=price)
+
+    def create_ask_order(self, volume, price):
+        return self._submit('create_ask_order', self.plugin.create_ask_order,
+                volume=volume, price=price)
+
+    def get_order_status(self, order, refresh=True):
+        return self._submit('get_order_status', self.plugin.get_order_status,
+                order, refresh=refresh)
+
+    def cancel_order(self, order):
+        return self._submit('cancel_order', self.plugin.cancel_order, order)
+
+    def __getattr__(self, name):
+        return getattr(self.plugin, name)
+
+
+def gather(results, timeout=None):
+    """ Wait for the calls and return their values in order.
+
+    :param timeout: Max. time to wait for all of them (in seconds)
+    :raise: The error of the first failed call, RuntimeError if a call
+        didn't finish in time
+    """
+    wait_all(results, [timeout] * len(results))
+    return [result.result(0) for result in results]
@@ -0,0 +1,392 @@
+""" Latency benchmarks against the mock exchange server.
+
+Each benchmark runs the code path of a CLI command against a local
+MockExchangeServer for a number of cycles and reports the cycle latency and
+the number of HTTP requests per cycle.
+"""
+import os
+import subprocess
+import sys
+import threading
+import time
+from decimal import Decimal
+
+from mockexchange import MockExchangeServer, MOCK_CREDENTIALS
+from journal import NullJournal
+
+
+# Max. startup times (in seconds) - the CLI must not import what a command
+# doesn't need. A run exiting with an error fails the check.
+STARTUP_BUDGETS = (
+        ('xbtarbiter -h', 0.1,
+            "import sys; sys.argv = ['xbtarbiter', '-h']; from xbtarbiter import main; main()"),
+        # Everything up to decrypting the config (which waits for the
+        # passphrase), with the default --plugins=all and no daemon running
+        ('xbtarbiter balance', 0.15,
+            "import sys; sys.argv = ['xbtarbiter', 'balance']; import xbtarbiter; "
+            "xbtarbiter.DEFAULT_SOCKET_FILE = '/nonexistent/daemon.sock'; "
+            "xbtarbiter.read_config = lambda path: sys.exit('pkg_resources' in sys.modules); "
+            "xbtarbiter.main()"),
+        ('load bitstamp plugin', 0.4,
+            "from xbtarbiter.registry import load_plugin_factory; load_plugin_factory('bitstamp')"),
+        ('load kraken plugin', 0.4,
+            "from xbtarbiter.registry import load_plugin_factory; load_plugin_factory('kraken')"),
+    )
+
+# The mock server has no request limits, the benchmarks measure the client
+# and not the exchanges' budgets
+MOCK_RATE_LIMIT = {
+        'capacity': 1e6,
+        'rate': 1e6,
+        'reserve': 0,
+    }
+
+# Calls per plugin started at once in the concurrency benchmarks (a private
+# one makes two requests)
+CONCURRENT_CALLS = 12
+
+
+class _NullWriter(object):
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+class BenchmarkResult(object):
+    """ Latencies (in seconds) and request counts of one benchmark.
+
+    :param expect_errors: Whether errors are injected - otherwise any error
+        fails the benchmark
+    """
+    def __init__(self, name, expect_errors=False):
+        self.name = name
+        self.expect_errors = expect_errors
+        self.latencies = []
+        self.requests = 0
+        self.max_in_flight = None
+        self.errors = 0
+        self.first_error = None
+
+    @property
+    def failed(self):
+        return bool(self.errors) and not self.expect_errors
+
+    def percentile(self, p):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))]
+
+    @property
+    def mean(self):
+        return sum(self.latencies) / len(self.latencies) if self.latencies else None
+
+    @property
+    def requests_per_cycle(self):
+        return float(self.requests) / len(self.latencies) if self.latencies else None
+
+    def __str__(self):
+        return "{name:28}  mean {mean:8.2f} ms  p50 {p50:8.2f} ms  p99 {p99:8.2f} ms  {rpc:5.1f} requests/cycle  max. {in_flight} in flight  {errors} errors{verdict}".format(
+                name=self.name,
+                mean=self.mean * 1000,
+                p50=self.percentile(50) * 1000,
+                p99=self.percentile(99) * 1000,
+                rpc=self.requests_per_cycle,
+                in_flight=self.max_in_flight,
+                errors=self.errors,
+                verdict="  FAILED: {0!r}".format(self.first_error) if self.failed else '')
+
+
+class StartupResult(object):
+    """ Startup times (in seconds) of one command, run in a new interpreter.
+    """
+    def __init__(self, name, budget):
+        self.name = name
+        self.budget = budget
+        self.times = []
+        self.failed = False
+
+    @property
+    def best(self):
+        return min(self.times) if self.times else None
+
+    @property
+    def within_budget(self):
+        return self.best is not None and self.best <= self.budget
+
+    def __str__(self):
+        if self.failed:
+            verdict = 'FAILED'
+        elif self.within_budget:
+            verdict = 'ok'
+        else:
+            verdict = 'OVER BUDGET'
+        return "{name:28}  best {best:8.2f} ms  budget {budget:8.2f} ms  {verdict}".format(
+                name=self.name,
+                best=self.best * 1000,
+                budget=self.budget * 1000,
+                verdict=verdict)
+
+
+def measure_startup(runs=5):
+    """ Measure the startup times of STARTUP_BUDGETS. The best of `runs`
+    runs counts, the others are disturbed by a cold disk cache and the like.
+
+    :return: List of StartupResult objects
+    """
+    env = dict(os.environ)
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+            [package_dir] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    with open(os.devnull, 'w') as devnull:
+        results = []
+        for (name, budget, code) in STARTUP_BUDGETS:
+            result = StartupResult(name, budget)
+            for _ in range(runs):
+                start = time.time()
+                if subprocess.call([sys.executable, '-c', code], env=env,
+                        stdout=devnull, stderr=devnull):
+                    result.failed = True
+                result.times.append(time.time() - start)
+            results.append(result)
+    return results
+
+
+def _measure(name, server, cycles, func):
+    result = BenchmarkResult(name, expect_errors=server.error_rate > 0)
+    stdout = sys.stdout
+    requests_before = server.total_requests()
+    server.reset_max_in_flight()
+    sys.stdout = _NullWriter()
+    try:
+        for _ in range(cycles):
+            start = time.time()
+            try:
+                func()
+            except Exception as e:
+                # Counted - without injected errors, any of them fails the
+                # benchmark
+                result.errors += 1
+                if result.first_error is None:
+                    result.first_error = e
+            result.latencies.append(time.time() - start)
+    finally:
+        sys.stdout = stdout
+    result.requests = server.total_requests() - requests_before
+    result.max_in_flight = server.reset_max_in_flight()
+    return result
+
+
+class PricingResult(object):
+    """ Cost per pair of the Decimal and the fixed-point opportunity
+    computation, and the largest difference between their results.
+
+    The fixed-point time covers what the scanner spends per pair - the
+    walks, and the conversion of each plugin's inputs once per cycle.
+    Converting the results back to Decimal only happens for profitable pairs
+    and is reported per profitable pair.
+    """
+    def __init__(self):
+        self.pairs = 0
+        self.profitable = 0
+        self.decimal_time = 0.0
+        self.fixed_time = 0.0
+        self.conversion_time = 0.0
+        self.mismatches = 0
+        self.max_difference = {}
+
+    @property
+    def speedup(self):
+        return self.decimal_time / self.fixed_time if self.fixed_time else None
+
+    def __str__(self):
+        return "{name:28}  Decimal {decimal:6.1f} us/pair  fixed-point {fixed:6.1f} us/pair ({speedup:.1f}x), {conversion:.1f} us/profitable pair  {mismatches} mismatches, max. difference {diff}".format(
+                name='pricing',
+                decimal=self.decimal_time / self.pairs * 1e6,
+                fixed=self.fixed_time / self.pairs * 1e6,
+                speedup=self.speedup,
+                conversion=self.conversion_time / max(1, self.profitable) * 1e6,
+                mismatches=self.mismatches,
+                diff=', '.join("{0} {1:.1E}".format(key, value)
+                        for (key, value) in sorted(self.max_difference.items())))
+
+
+def _decimal_opportunity(bid_plugin, ask_plugin, max_volume):
+    """ The opportunity computation in Decimal arithmetic, as reference.
+    """
+    from depth import walk_books
+
+    mkt = walk_books(bid_plugin.iter_bids(), ask_plugin.iter_asks(),
+            bid_plugin.trade_fee, ask_plugin.trade_fee)
+    trade = walk_books(bid_plugin.iter_bids(), ask_plugin.iter_asks(),
+            bid_plugin.trade_fee, ask_plugin.trade_fee,
+            avail_usd=ask_plugin.avail_usd,
+            avail_xbt=bid_plugin.avail_xbt,
+            max_volume=max_volume)
+    return {
+            'mkt_volume': mkt['volume'],
+            'mkt_profit': mkt['profit'],
+            'volume': trade['volume'],
+            'buy_total': trade['buy_total'],
+            'fees': trade['fees'],
+            'profit': trade['profit'],
+        }
+
+
+def measure_pricing(cycles=50, markets=6, depth=25, seed=0):
+    """ Evaluate all pairs of random order books with Decimal and with
+    fixed-point arithmetic, like find_opportunities() does, and compare the
+    cost and the results.
+
+    :return: PricingResult
+    """
+    import random
+    from xbtarbiter import _fixed_state, _walk_market, _walk_trade, _opportunity
+    from fixedpoint import to_fixed, VOLUME_SCALE
+    from feedserver import SyntheticBook
+    from replay import SimPlugin
+
+    rnd = random.Random(seed)
+    convert = lambda levels: [(Decimal(repr(price)), Decimal(repr(volume)))
+            for (price, volume) in levels]
+    result = PricingResult()
+    for _ in range(cycles):
+        plugins = []
+        for i in range(markets):
+            plugin = SimPlugin('market-{0}'.format(i),
+                    fee=rnd.choice(['0.2', '0.25']),
+                    usd=str(rnd.randint(0, 5000)),
+                    xbt=str(rnd.randint(0, 20)))
+            (bids, asks) = SyntheticBook(mid=rnd.uniform(595, 605), depth=depth,
+                    seed=rnd.random()).snapshot()
+            plugin.load_order_book(convert(bids), convert(asks))
+            plugins.append(plugin)
+        pairs = [(bid_plugin, ask_plugin)
+                for bid_plugin in plugins
+                for ask_plugin in plugins
+                if bid_plugin is not ask_plugin]
+        max_volume = Decimal(rnd.choice(['0.01', '1', '100']))
+        result.pairs += len(pairs)
+
+        start = time.time()
+        expected = [_decimal_opportunity(bid_plugin, ask_plugin, max_volume)
+                for (bid_plugin, ask_plugin) in pairs]
+        result.decimal_time += time.time() - start
+
+        start = time.time()
+        fixed_max_volume = to_fixed(max_volume, VOLUME_SCALE)
+        states = dict((plugin.name, _fixed_state(plugin)) for plugin in plugins)
+        walks = []
+        for (bid_plugin, ask_plugin) in pairs:
+            bid_state = states[bid_plugin.name]
+            ask_state = states[ask_plugin.name]
+            mkt = _walk_market(bid_state, ask_state)
+            if mkt['profit'] > 0:
+                walks.append((bid_plugin, ask_plugin, mkt,
+                        _walk_trade(bid_state, ask_state, fixed_max_volume)))
+            else:
+                walks.append(None)
+        result.fixed_time += time.time() - start
+
+        start = time.time()
+        actual = [_opportunity(*walk) if walk is not None else None for walk in walks]
+        result.conversion_time += time.time() - start
+
+        for (a, b) in zip(expected, actual):
+            if (a['mkt_profit'] > 0) != (b is not None):
+                result.mismatches += 1
+            if b is None:
+                continue
+            result.profitable += 1
+            for key in a:
+                difference = abs(a[key] - b[key])
+                result.max_difference[key] = max(difference, result.max_difference.get(key, 0))
+    return result
+
+
+def connect_mock(server, eurusd_rate=Decimal('1.3')):
+    """ Create plugins talking to the mock server.
+    """
+    from bitstamp import BitstampPlugin
+    from kraken import KrakenPlugin
+
+    bitstamp_creds = MOCK_CREDENTIALS['bitstamp']
+    kraken_creds = MOCK_CREDENTIALS['kraken']
+    return [
+            BitstampPlugin(client_id=bitstamp_creds['client_id'],
+                    key=bitstamp_creds['key'],
+                    secret=bitstamp_creds['secret'],
+                    url=server.url('bitstamp'),
+                    rate_limit=MOCK_RATE_LIMIT),
+            KrakenPlugin(key=kraken_creds['key'],
+                    secret=kraken_creds['secret'],
+                    eurusd_rate=eurusd_rate,
+                    url=server.url('kraken'),
+                    rate_limit=MOCK_RATE_LIMIT),
+        ]
+
+
+def run_benchmarks(cycles=20, latency=0.0, jitter=0.0, error_rate=0.0):
+    """ Run all benchmarks.
+
+    :return: List of BenchmarkResult objects
+    """
+    from xbtarbiter import print_prices, print_open_orders, trade, submit_legs
+    from orders import OrderTracker
+    from asyncplugin import AsyncPlugin, gather
+
+    server = MockExchangeServer(('localhost', 0), latency=latency,
+            jitter=jitter, error_rate=error_rate, fill_delay=3600.0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        plugins = connect_mock(server)
+        (bitstamp, kraken) = plugins
+        journal = NullJournal()
+
+        results = []
+        results.append(_measure('prices', server, cycles,
+                lambda: print_prices(plugins)))
+        results.append(_measure('orders', server, cycles,
+                lambda: print_open_orders(plugins)))
+        results.append(_measure('trading --dry-run', server, cycles,
+                lambda: trade(plugins, min_profit=Decimal('0'),
+                        max_volume=Decimal('0.01'), journal=journal,
+                        confirm=False, dry_run=True)))
+
+        # Orders stay open (see fill_delay), so that they can be polled
+        trackers = [OrderTracker(kraken), OrderTracker(bitstamp)]
+        def submit():
+            (buy_order, sell_order) = submit_legs(kraken, bitstamp,
+                    volume=Decimal('0.01'),
+                    buy_price=kraken.lowest_ask['price'],
+                    sell_price=bitstamp.highest_bid['price'],
+                    journal=journal)
+            trackers[0].track(buy_order)
+            trackers[1].track(sell_order)
+        results.append(_measure('order submission', server, cycles, submit))
+
+        results.append(_measure('order status', server, cycles,
+                lambda: [tracker.poll() for tracker in trackers]))
+
+        # Many calls started at once from several threads. The private
+        # requests of one API key are made one after another (see nonce.py),
+        # at most one per plugin is in flight - only the public ones run in
+        # parallel. None of them may fail.
+        async_plugins = [AsyncPlugin(plugin) for plugin in plugins]
+        results.append(_measure('concurrent private requests', server, cycles,
+                lambda: gather([plugin.refresh_orders()
+                        for plugin in async_plugins
+                        for _ in range(CONCURRENT_CALLS)])))
+        results.append(_measure('concurrent public requests', server, cycles,
+                lambda: gather([plugin.refresh_order_book()
+                        for plugin in async_plugins
+                        for _ in range(CONCURRENT_CALLS)])))
+        return results
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -1,16 +1,27 @@
-import requests
 import hmac
 import hashlib
 import time
 
-from decimal import Decimal
+from decimal import Decimal, ROUND_CEILING, ROUND_FLOOR
+
+from session import HttpSession, ResponseCache, HTTP_NOT_MODIFIED
+from account import AccountState
+from errors import ExchangeError
+from feed import FeedError
+from fixedpoint import FixedLevels
+from bookstream import parse_book
+from nonce import NonceAllocator, nonce_allocator
+from ratelimit import create_scheduler, \
+        PRIORITY_ORDER, PRIORITY_STATUS, PRIORITY_BOOK, PRIORITY_BACKGROUND
 
 
 ORDER_OPEN = 'open'
 ORDER_CLOSED = 'closed'
 
 
-class BitstampException(Exception):
+class BitstampException(ExchangeError):
+    exchange = 'Bitstamp.net'
+
     def __init__(self, msg):
         self.msg = msg
 
@@ -21,9 +32,11 @@ class BitstampException(Exception):
 class BitstampOrder(object):
     """ Bitstamp order.
     """
-    def __init__(self, otype, oid):
+    def __init__(self, otype, oid, volume=None, price=None):
         self.otype = otype
         self.oid = oid
+        self.volume = volume
+        self.price = price
 
 
 class BitstampPlugin(object):
@@ -31,36 +44,202 @@ class BitstampPlugin(object):
 
     API documentation:
         https://www.bitstamp.net/api/
+
+    :param client_id: Bitstamp client ID
+    :param key: API key
+    :param secret: API secret
+    :param book_timeout: max. time to wait for an order book refresh (in
+        seconds)
+    :param book_depth: number of order book levels to parse on each side
+    :param http_options: keyword arguments for the plugin's HttpSession
+        (pool size, timeouts)
+    :param feed_address: URL of the order book stream (default FEED_URL) or
+        'host:port' of a local stand-in
+    :param url: API base URL (default API_URL)
+    :param rate_limit: dict overriding the request budget (RATE_LIMIT)
+    :param nonces: NonceAllocator of the API key (default is one which isn't
+        persisted)
     """
-    def __init__(self, client_id, key, secret):
+    API_URL = 'https://www.bitstamp.net/api'
+    FEED_URL = 'wss://ws.bitstamp.net'
+
+    # Levels on each side of the book channel's snapshots
+    FEED_DEPTH = 100
+
+    # Nonces are in microseconds
+    NONCE_UNIT = 10 ** 6
+
+    # Smallest price step of BTC/USD orders
+    PRICE_TICK = Decimal('0.01')
+
+    # Bitstamp caps the number of requests per 10 minutes - every request
+    # takes one token
+    RATE_LIMIT = {
+            'capacity': 600,
+            'rate': 1.0,
+            'reserve': 5,
+        }
+
+    REQUEST_PRIORITIES = {
+            'buy/': PRIORITY_ORDER,
+            'sell/': PRIORITY_ORDER,
+            'cancel_order/': PRIORITY_ORDER,
+            'open_orders/': PRIORITY_STATUS,
+            'user_transactions/': PRIORITY_STATUS,
+            'order_book/': PRIORITY_BOOK,
+            'balance/': PRIORITY_BACKGROUND,
+        }
+
+    def __init__(self, client_id, key, secret, book_timeout=5.0,
+            book_depth=25, http_options=None, feed_address=None,
+            url=None, rate_limit=None, nonces=None):
         self.name = 'bitstamp.net'
-
-        self._url = 'https://www.bitstamp.net/api'
+        self.book_timeout = book_timeout
+        self.book_depth = book_depth
+        self.order_book_ts = None
+        self.feed_address = feed_address
+        self.recorder = None
+        self._open_orders = []
+        self._open_index = {}
+        self._closed_orders = []
+        self._closed_index = {}
+        self._order_book = None
+        self._fixed_book = None
+        self._book_cache = ResponseCache()
+        self._session = HttpSession(**(http_options or {}))
+        self.scheduler = create_scheduler(self.RATE_LIMIT, rate_limit)
+
+        self._url = url or self.API_URL
         self._client_id = client_id
         self._key = key
         self._secret = secret
+        self._nonces = nonces or NonceAllocator(self.NONCE_UNIT)
 
-        self.refresh_account_info()
+        # The fee comes with the balances, reconciliations keep it up to date
+        self.account = AccountState(self._fetch_balances)
 
     def refresh_account_info(self):
+        """ Reconcile the local account state with the exchange.
+        """
+        self.account.reconcile()
+
+    def _fetch_balances(self):
         path = 'balance/'
-        self._account_info = self._http_post(path)
+        account_info = self._http_post(path)
+        return {
+                'balance_xbt': Decimal(account_info['btc_balance']),
+                'balance_fiat': Decimal(account_info['usd_balance']),
+                'avail_xbt': Decimal(account_info['btc_available']),
+                'avail_fiat': Decimal(account_info['usd_available']),
+                'fee': Decimal(account_info['fee']),
+            }
 
     def refresh_order_book(self):
+        """ Refresh the order book.
+
+        :return: Whether the book has changed since the last refresh
+        """
         path = 'order_book/'
-        self._order_book = self._http_get(path)
+        # Bitstamp sends the whole book - only the top levels are parsed,
+        # and only they are compared with the last book
+        order_book = self._http_get(path, cache=self._book_cache,
+                parser=self._parse_book)
+        self.order_book_ts = time.time()
+        # An unchanged book comes back as the same object, keeping its
+        # fixed-point conversion
+        if order_book is self._order_book:
+            return False
+        self._order_book = order_book
+        self._fixed_book = None
+        if self.recorder is not None:
+            self.recorder.record(self)
+        return True
+
+    def load_order_book(self, bids, asks):
+        """ Replace the order book with levels maintained locally (e.g. by a
+        streaming feed).
+
+        :param bids: List of (price, volume) tuples, highest price first
+        :param asks: List of (price, volume) tuples, lowest price first
+        """
+        self._order_book = {
+                'bids': bids,
+                'asks': asks,
+            }
+        self._fixed_book = None
+        self.order_book_ts = time.time()
+        if self.recorder is not None:
+            self.recorder.record(self)
+
+    def fetch_book_levels(self):
+        """ Fetch the order book without installing it.
+
+        :return: (bids, asks) tuple of (price, volume) lists, best price first
+        """
+        order_book = self._http_get('order_book/', cache=self._book_cache,
+                parser=self._parse_book)
+        return (order_book['bids'], order_book['asks'])
+
+    def feed_depth(self, depth):
+        """ Depth of the book channel, it isn't configurable.
+        """
+        return self.FEED_DEPTH
+
+    def feed_subscriptions(self, depth):
+        """ Messages subscribing to the book channel of Bitstamp's stream.
+        """
+        return [{
+                'event': 'bts:subscribe',
+                'data': {'channel': 'order_book_btcusd'},
+            }]
+
+    def parse_feed_message(self, message):
+        """ Translate a message of Bitstamp's order book stream.
+
+        Every message of the 'order_book' channel is a snapshot of the top
+        of the book - there are no incremental updates which could be
+        missed.
+
+        :return: (snapshot, bids, asks) tuple or None for other messages
+        """
+        if not isinstance(message, dict):
+            return None
+        if message.get('event') == 'bts:request_reconnect':
+            raise FeedError("Bitstamp asked to reconnect")
+        if message.get('event') != 'data' or \
+                not message.get('channel', '').startswith('order_book'):
+            return None
+        data = message['data']
+        return (True, data.get('bids', []), data.get('asks', []))
+
+    def verify_feed_book(self, message, book):
+        """ Nothing to verify, every message is a snapshot.
+        """
 
     def refresh_orders(self):
         """ Refresh my orders.
         """
-        # Refresh open orders
+        self.refresh_open_orders()
+        self.refresh_closed_orders()
+
+    def refresh_open_orders(self):
+        """ Refresh my open orders and index them by order ID.
+        """
         path_open = 'open_orders/'
         self._open_orders = self._http_post(path_open)
+        self._open_index = dict((order['id'], order) for order in self._open_orders)
 
-        # Refresh closed orders. Note that this loads only the last 100 closed
-        # orders in descending order by time - see api docs on how to load more
+    def refresh_closed_orders(self):
+        """ Refresh my closed orders and index them by order ID.
+
+        Note that this loads only the last 100 transactions in descending
+        order by time - see api docs on how to load more
+        """
         path_closed = 'user_transactions/'
         self._closed_orders = self._http_post(path_closed)
+        # Deposits and withdrawals have no order ID
+        self._closed_index = dict((order['order_id'], order)
+                for order in self._closed_orders if order.get('order_id'))
 
     def create_bid_order(self, volume, price):
         """ Create a BID ("I want to buy") order.
@@ -68,12 +247,17 @@ class BitstampPlugin(object):
         :return: Order ID
         """
         path = 'buy/'
+        # Rounded up to the tick, so the order still reaches the level it
+        # was priced for
+        price = Decimal(price).quantize(self.PRICE_TICK, ROUND_CEILING)
         data = {
                 'amount': "{0:.8f}".format(volume),
-                'price': price,
+                'price': str(price),
             }
         response = self._http_post(path, data)
-        order = BitstampOrder(otype='bid', oid=response['id'])
+        order = BitstampOrder(otype='bid', oid=response['id'],
+                volume=volume, price=price)
+        self.account.order_submitted(order)
         return order
 
     def create_ask_order(self, volume, price):
@@ -82,34 +266,46 @@ class BitstampPlugin(object):
         :return: Order ID
         """
         path = 'sell/'
+        # Rounded down to the tick, so the order still reaches the level it
+        # was priced for
+        price = Decimal(price).quantize(self.PRICE_TICK, ROUND_FLOOR)
         data = {
                 'amount': "{0:.8f}".format(volume),
-                'price': price,
+                'price': str(price),
             }
         response = self._http_post(path, data)
-        order = BitstampOrder(otype='ask', oid=response['id'])
+        order = BitstampOrder(otype='ask', oid=response['id'],
+                volume=volume, price=price)
+        self.account.order_submitted(order)
         return order
 
-    def get_order_status(self, order):
-        """ Get order status. Possible values: 'open', 'closed'. Raise exception
-        if the order was not found.
+    def find_order_status(self, order):
+        """ Look the order up in the last fetched orders, without refreshing
+        them.
+
+        :return: 'open', 'closed' or None if the order is not among them
         """
-        # Refresh orders
-        self.refresh_orders()
+        if order.oid in self._open_index:
+            return ORDER_OPEN
+        if order.oid in self._closed_index:
+            return ORDER_CLOSED
+        return None
 
-        # Check open orders
-        for open_order in self._open_orders:
-            if open_order['id'] == order.oid:
-                return ORDER_OPEN
+    def get_order_status(self, order, refresh=True):
+        """ Get order status. Possible values: 'open', 'closed'. Raise exception
+        if the order was not found.
 
-        # Check closed orders
-        for closed_order in self._closed_orders:
-            if closed_order['order_id'] == order.oid:
-                return ORDER_CLOSED
+        :param refresh: Refresh the orders first
+        """
+        if refresh:
+            self.refresh_orders()
 
-        # If the order is not open nor closed it either does not exist or
-        # was cancelled - we raise an exception
-        raise BitstampException('Order not found')
+        status = self.find_order_status(order)
+        if status is None:
+            # If the order is not open nor closed it either does not exist or
+            # was cancelled - we raise an exception
+            raise BitstampException('Order not found')
+        return status
 
     def cancel_order(self, order):
         """ Cancel an open order.
@@ -121,13 +317,22 @@ class BitstampPlugin(object):
         response = self._http_post(path, data)
         if not response:
             raise BitstampException('Cancel order failed')
+        self.account.order_cancelled(order)
 
 
     @property
     def trade_fee(self):
         # Note: Fees are actually paid in USD from the trade value in USD
         # (probably, verify it to be sure)
-        return Decimal(self._account_info['fee'])
+        return self.account.trade_fee
+
+    @property
+    def connection_stats(self):
+        return self._session.stats
+
+    @property
+    def latency_stats(self):
+        return self._session.latencies
 
     @property
     def open_orders(self):
@@ -135,19 +340,19 @@ class BitstampPlugin(object):
 
     @property
     def balance_xbt(self):
-        return Decimal(self._account_info['btc_balance'])
+        return self.account.balance_xbt
 
     @property
     def balance_usd(self):
-        return Decimal(self._account_info['usd_balance'])
+        return self.account.balance_fiat
 
     @property
     def avail_xbt(self):
-        return Decimal(self._account_info['btc_available'])
+        return self.account.avail_xbt
 
     @property
     def avail_usd(self):
-        return Decimal(self._account_info['usd_available'])
+        return self.account.avail_fiat
 
     @property
     def highest_bid(self):
@@ -169,34 +374,87 @@ class BitstampPlugin(object):
                 'volume': Decimal(ask[1]),
             }
 
+    def iter_bids(self):
+        """ Iterate over the bids in the order book as (price, volume) tuples,
+        highest price first.
+        """
+        for (price, volume) in self._order_book['bids']:
+            yield (Decimal(price), Decimal(volume))
+
+    def iter_asks(self):
+        """ Iterate over the asks in the order book as (price, volume) tuples,
+        lowest price first.
+        """
+        for (price, volume) in self._order_book['asks']:
+            yield (Decimal(price), Decimal(volume))
+
+    def fixed_book(self):
+        """ The order book as (bids, asks) of fixed-point (price, volume)
+        tuples, see fixedpoint.py. Converted once per order book.
+        """
+        if self._fixed_book is None:
+            self._fixed_book = (FixedLevels(self._order_book['bids']),
+                    FixedLevels(self._order_book['asks']))
+        return self._fixed_book
+
     def _sign(self, nonce):
         msg = '{0}{1}{2}'.format(nonce, self._client_id, self._key)
         return hmac.new(self._secret, msg, hashlib.sha256).hexdigest().upper()
 
-    def _http_get(self, path):
+    def _parse_book(self, chunks):
+        return parse_book(chunks, self.book_depth)
+
+    def _http_get(self, path, cache=None, parser=None):
         url = '{0}/{1}'.format(self._url, path)
-        response = requests.get(url)
-        if response.status_code != 200:
-            msg = "\n".join(response.json()['error']['__all__'])
+        self.scheduler.acquire(self.REQUEST_PRIORITIES.get(path, PRIORITY_STATUS))
+        (response, result) = self._session.request_json('GET', url,
+                endpoint=path, cache=cache, parser=parser)
+        if response.status_code not in (200, HTTP_NOT_MODIFIED):
+            msg = "\n".join(result['error']['__all__'])
             raise BitstampException(msg)
-        return response.json()
+        return result
 
     def _http_post(self, path, data={}):
         url = '{0}/{1}'.format(self._url, path)
-        nonce = str(int(time.time() * 1e6))
-
-        payload = dict(data)
-        payload['key'] = self._key
-        payload['signature'] = self._sign(nonce)
-        payload['nonce'] = nonce
-
-        response = requests.post(url, data=payload)
+        priority = self.REQUEST_PRIORITIES.get(path, PRIORITY_STATUS)
+        self.scheduler.acquire(priority)
+
+        # Requests must be handled by Bitstamp in the order of their nonces, the
+        # next one is only sent after the response
+        with self._nonces.ordered(priority) as ticket:
+            nonce = str(ticket.nonce)
+            payload = dict(data)
+            payload['key'] = self._key
+            payload['signature'] = self._sign(nonce)
+            payload['nonce'] = nonce
+
+            (response, response_json) = self._session.request_json('POST', url,
+                    endpoint=path, data=payload)
         if response.status_code != 200:
-            msg = "\n".join(response.json()['error']['__all__'])
+            msg = "\n".join(response_json['error']['__all__'])
             raise BitstampException(msg)
 
-        response_json = response.json()
         if hasattr(response_json, 'has_key') and response_json.has_key('error'):
             raise BitstampException(response_json['error'])
 
         return response_json
+
+
+def create_plugin(cfg, book_timeout):
+    """ Create the plugin from the 'bitstamp.net' section of the config.
+
+    :param cfg: Whole config
+    :param book_timeout: Default max. time to wait for an order book refresh
+    """
+    plugin_cfg = cfg['plugins']['bitstamp.net']
+    return BitstampPlugin(client_id=plugin_cfg['client_id'],
+            key=plugin_cfg['key'],
+            secret=str(plugin_cfg['secret']),
+            book_timeout=float(plugin_cfg.get('book_timeout', book_timeout)),
+            book_depth=int(plugin_cfg.get('book_depth', 25)),
+            http_options=plugin_cfg.get('http'),
+            feed_address=plugin_cfg.get('feed'),
+            url=plugin_cfg.get('url'),
+            rate_limit=plugin_cfg.get('rate_limit'),
+            nonces=nonce_allocator('bitstamp', plugin_cfg['key'],
+                BitstampPlugin.NONCE_UNIT))
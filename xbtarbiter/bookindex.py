@@ -0,0 +1,216 @@
+""" Index of the best bid and ask across the exchanges.
+
+Every plugin's best bid and ask are kept after fees, as integers scaled
+like in walk_books_fixed():
+
+    bid value = bid_price * (100% - fee)    (what selling 1 XBT brings)
+    ask value = ask_price * (100% + fee)    (what buying 1 XBT costs)
+
+in two indexed heaps - the highest bid value and the lowest ask value are
+on top, and a refreshed book moves its plugin's entries up or down in
+O(log N) instead of re-evaluating every pair of plugins. A pair of plugins
+is worth walking the books of only if the bid value of one is above the
+ask value of the other; candidates() lists such pairs lazily, best margin
+first, so the caller can stop after the first few.
+"""
+import heapq
+
+from fixedpoint import fixed_book, to_fixed, FEE_SCALE, HUNDRED_PERCENT
+
+
+class IndexedHeap(object):
+    """ Binary min-heap of (priority, key) entries which can change the
+    priority of a key or remove it in O(log N).
+    """
+    def __init__(self):
+        self._heap = []
+        self._pos = {}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, key):
+        return key in self._pos
+
+    def priority(self, key):
+        return self._heap[self._pos[key]][0]
+
+    def top(self):
+        """ The (priority, key) entry of the lowest priority or None.
+        """
+        return self._heap[0] if self._heap else None
+
+    def set(self, key, priority):
+        """ Add the key or change its priority.
+        """
+        heap = self._heap
+        pos = self._pos.get(key)
+        if pos is None:
+            heap.append((priority, key))
+            self._pos[key] = len(heap) - 1
+            self._sift_up(len(heap) - 1)
+        elif heap[pos][0] != priority:
+            old = heap[pos][0]
+            heap[pos] = (priority, key)
+            if priority < old:
+                self._sift_up(pos)
+            else:
+                self._sift_down(pos)
+
+    def remove(self, key):
+        pos = self._pos.pop(key, None)
+        if pos is None:
+            return
+        heap = self._heap
+        last = heap.pop()
+        if pos < len(heap):
+            heap[pos] = last
+            self._pos[last[1]] = pos
+            self._sift_up(pos)
+            self._sift_down(self._pos[last[1]])
+
+    def ordered(self):
+        """ Iterate over the entries in priority order, without modifying
+        the heap - only the entries taken are sorted (O(log K) each). The
+        heap must not change while iterating.
+        """
+        heap = self._heap
+        if not heap:
+            return
+        frontier = [(heap[0], 0)]
+        size = len(heap)
+        while frontier:
+            (entry, pos) = heapq.heappop(frontier)
+            yield entry
+            for child in (2 * pos + 1, 2 * pos + 2):
+                if child < size:
+                    heapq.heappush(frontier, (heap[child], child))
+
+    def _swap(self, i, j):
+        heap = self._heap
+        (heap[i], heap[j]) = (heap[j], heap[i])
+        self._pos[heap[i][1]] = i
+        self._pos[heap[j][1]] = j
+
+    def _sift_up(self, pos):
+        heap = self._heap
+        while pos > 0:
+            parent = (pos - 1) // 2
+            if heap[pos] >= heap[parent]:
+                break
+            self._swap(pos, parent)
+            pos = parent
+
+    def _sift_down(self, pos):
+        heap = self._heap
+        size = len(heap)
+        while True:
+            smallest = pos
+            for child in (2 * pos + 1, 2 * pos + 2):
+                if child < size and heap[child] < heap[smallest]:
+                    smallest = child
+            if smallest == pos:
+                return
+            self._swap(pos, smallest)
+            pos = smallest
+
+
+class BookIndex(object):
+    """ Best fee-adjusted bid and ask of every plugin.
+    """
+    def __init__(self):
+        self.plugins = {}
+        # Book and fee each plugin was last indexed with
+        self._inputs = {}
+        # Bid values are negated, so the highest one is on top
+        self._bids = IndexedHeap()
+        self._asks = IndexedHeap()
+
+    def __len__(self):
+        return len(self.plugins)
+
+    def update(self, plugin):
+        """ Add the plugin or move it according to its current book. Nothing
+        is done if the book (which plugins replace only when it changes) and
+        the fee are the same as last time.
+        """
+        book = fixed_book(plugin)
+        inputs = (book, plugin.trade_fee)
+        if self._inputs.get(plugin.name) == inputs:
+            return
+        self._inputs[plugin.name] = inputs
+        (bids, asks) = book
+        fee = to_fixed(plugin.trade_fee, FEE_SCALE)
+        bid = bids.top()
+        ask = asks.top()
+        self.plugins[plugin.name] = plugin
+        if bid is not None:
+            self._bids.set(plugin.name, -bid[0] * (HUNDRED_PERCENT - fee))
+        else:
+            self._bids.remove(plugin.name)
+        if ask is not None:
+            self._asks.set(plugin.name, ask[0] * (HUNDRED_PERCENT + fee))
+        else:
+            self._asks.remove(plugin.name)
+
+    def remove(self, name):
+        """ Drop the plugin, e.g. when its book is stale.
+        """
+        self.plugins.pop(name, None)
+        self._inputs.pop(name, None)
+        self._bids.remove(name)
+        self._asks.remove(name)
+
+    def candidates(self):
+        """ Iterate over the pairs of different plugins which are profitable
+        at the top of the books, best first.
+
+        The margin is the bid value minus the ask value - the profit per
+        XBT at the top of the books, scaled by PRICE_SCALE and
+        HUNDRED_PERCENT. No level deeper in the books has a higher margin.
+
+        :return: Iterator of (margin, bid_plugin, ask_plugin) tuples
+        """
+        # Both sides are taken from the heaps lazily, and the pairs are
+        # merged in the order of their margins - a pair (i, j) of the i-th
+        # best bid and j-th best ask is only looked at after (i - 1, j)
+        # and (i, j - 1).
+        bids = _LazyList(self._bids.ordered())
+        asks = _LazyList(self._asks.ordered())
+        if bids.get(0) is None or asks.get(0) is None:
+            return
+        frontier = [(bids.get(0)[0] + asks.get(0)[0], 0, 0)]
+        while frontier:
+            (negative_margin, i, j) = heapq.heappop(frontier)
+            if negative_margin >= 0:
+                return
+            bid_name = bids.get(i)[1]
+            ask_name = asks.get(j)[1]
+            if bid_name != ask_name:
+                yield (-negative_margin, self.plugins[bid_name], self.plugins[ask_name])
+            if j == 0 and bids.get(i + 1) is not None:
+                heapq.heappush(frontier, (bids.get(i + 1)[0] + asks.get(0)[0], i + 1, 0))
+            if asks.get(j + 1) is not None:
+                heapq.heappush(frontier, (bids.get(i)[0] + asks.get(j + 1)[0], i, j + 1))
+
+    def best(self):
+        """ The (margin, bid_plugin, ask_plugin) of the best pair or None.
+        """
+        return next(self.candidates(), None)
+
+
+class _LazyList(object):
+    """ Items of an iterator, taken from it when first asked for.
+    """
+    def __init__(self, iterator):
+        self._iterator = iterator
+        self._items = []
+
+    def get(self, i):
+        items = self._items
+        while len(items) <= i:
+            item = next(self._iterator, None)
+            if item is None:
+                return None
+            items.append(item)
+        return items[i]
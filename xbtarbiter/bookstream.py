@@ -0,0 +1,139 @@
+""" Streaming parser of the top levels of a JSON order book.
+
+Exchanges like Bitstamp send the whole book on every request:
+
+    {"timestamp": "1412345678", "bids": [["600.00", "1.5"], ...], "asks": [...]}
+
+with thousands of levels on each side, of which only the top ones are ever
+walked. parse_book() reads the body chunk by chunk and parses the first
+`depth` levels of each side only. The other levels are skipped by searching
+for the next side's key, without parsing them or keeping them in memory -
+both the parse time and the memory needed are given by `depth`, not by the
+size of the book.
+"""
+import re
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+# A level is an array of scalars, followed by ',' or by the ']' of the side
+_LEVEL = re.compile(r'\s*(\[[^\[\]{}]*\])\s*([,\]])')
+_SPACE = re.compile(r'\s*')
+# The end of a chunk which may be the beginning of a side's key
+_PARTIAL_KEY = re.compile(r'"\w*(?:"\s*(?::\s*)?)?\Z')
+
+# A level can't be longer than this, more data without a match is an error
+MAX_LEVEL_SIZE = 1024
+
+
+class _Reader(object):
+    """ Text of the chunks which haven't been consumed yet.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self.text = ''
+        self.pos = 0
+
+    def more(self):
+        """ Append the next chunk, dropping the consumed text.
+
+        :return: False at the end of the stream
+        """
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return False
+        self.text = self.text[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+
+def _find_side(reader, sides):
+    """ Skip to the opening '[' of the next side and return its name, or
+    None at the end of the stream.
+    """
+    pattern = re.compile(r'"({0})"\s*:\s*\['.format('|'.join(sides)))
+    while True:
+        match = pattern.search(reader.text, reader.pos)
+        if match is not None:
+            reader.pos = match.end()
+            return match.group(1)
+        # Keep the tail which may be the beginning of a key, with any amount
+        # of whitespace around its colon - it starts at one of the last two
+        # quotes
+        text = reader.text
+        last = text.rfind('"', reader.pos)
+        keep = len(text)
+        for quote in (last, text.rfind('"', reader.pos, max(last, 0))):
+            if quote >= 0 and _PARTIAL_KEY.match(text, quote):
+                keep = quote
+        reader.pos = keep
+        if not reader.more():
+            return None
+
+
+def _match(reader, pattern):
+    """ Match the pattern at the current position, reading more of the
+    stream if needed.
+    """
+    while True:
+        match = pattern.match(reader.text, reader.pos)
+        if match is not None:
+            return match
+        if len(reader.text) - reader.pos > MAX_LEVEL_SIZE or not reader.more():
+            return None
+
+
+def _peek(reader):
+    """ The next non-whitespace character or None at the end of the stream.
+    """
+    while True:
+        reader.pos = _SPACE.match(reader.text, reader.pos).end()
+        if reader.pos < len(reader.text):
+            return reader.text[reader.pos]
+        if not reader.more():
+            return None
+
+
+def _read_levels(reader, depth, raw):
+    levels = []
+    if _peek(reader) == ']':
+        return levels
+    while len(levels) < depth:
+        match = _match(reader, _LEVEL)
+        if match is None:
+            raise ValueError("Malformed order book level at {0!r}".format(
+                    reader.text[reader.pos:reader.pos + 40]))
+        reader.pos = match.end()
+        raw.append(match.group(1))
+        levels.append(json.loads(match.group(1)))
+        if match.group(2) == ']':
+            break
+    return levels
+
+
+def parse_book(chunks, depth, sides=('bids', 'asks')):
+    """ Parse the first `depth` levels of each side of a JSON order book.
+
+    Reading stops as soon as all sides have been parsed, the rest of the
+    stream is left unread.
+
+    :param chunks: Iterable of the body's chunks (strings)
+    :param depth: Number of levels to parse on each side
+    :param sides: Keys of the sides
+    :return: (book, raw) tuple - dict mapping the sides to lists of levels,
+        and the text of the parsed levels (e.g. for comparing books)
+    :raise ValueError: A side is missing or malformed
+    """
+    reader = _Reader(chunks)
+    book = {}
+    raw = []
+    while len(book) < len(sides):
+        side = _find_side(reader, [side for side in sides if side not in book])
+        if side is None:
+            missing = [side for side in sides if side not in book]
+            raise ValueError("No {0} in the order book".format(', '.join(missing)))
+        raw.append(side)
+        book[side] = _read_levels(reader, depth, raw)
+    return (book, ''.join(raw))
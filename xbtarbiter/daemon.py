@@ -0,0 +1,171 @@
+""" Long-running daemon serving CLI commands over a Unix domain socket.
+
+The daemon decrypts the config once and keeps the plugins connected - the
+HTTP connections stay open and the account state is reconciled in the
+background - so the balance, prices, orders and stats commands don't pay
+for the passphrase prompt, the GPG decryption and the plugin setup on
+every run.
+
+Protocol: the client sends one JSON line
+
+    {"command": "prices", "plugins": ["kraken"], "cycles": 20, "book_timeout": 5.0}
+
+and the daemon answers with one JSON line holding the command's output (or
+an error) and closes the connection. A request the daemon can't answer like
+the command run without it would - for plugins it hasn't connected or with
+another book timeout - is answered with "unavailable", and the client runs
+the command itself.
+"""
+import os
+import socket
+import threading
+from cStringIO import StringIO
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from SocketServer import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+
+from errors import ExchangeError
+
+
+# Commands served by the daemon
+COMMANDS = ('balance', 'prices', 'orders', 'stats')
+
+# Max. time to wait for the daemon's answer (in seconds)
+CLIENT_TIMEOUT = 60.0
+
+
+class DaemonUnavailable(Exception):
+    pass
+
+
+def _run_command(command, plugins, cycles, out):
+    from xbtarbiter import print_account_balance, print_prices, print_open_orders, print_request_stats
+
+    if command == 'balance':
+        print_account_balance(plugins, out)
+    elif command == 'prices':
+        print_prices(plugins, out)
+    elif command == 'orders':
+        print_open_orders(plugins, out)
+    elif command == 'stats':
+        print_request_stats(plugins, cycles, out)
+
+
+class DaemonHandler(StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            response = {'output': self.server.execute(request)}
+        except DaemonUnavailable as e:
+            response = {'unavailable': str(e)}
+        except ExchangeError as e:
+            response = {'error': "{0}: {1}".format(e.exchange, e)}
+        except Exception as e:
+            response = {'error': str(e)}
+        self.wfile.write(json.dumps(response) + '\n')
+
+
+class ArbiterDaemon(ThreadingMixIn, UnixStreamServer):
+    """ Serves commands on the connected plugins.
+
+    :param path: Path of the Unix domain socket
+    :param plugins: Connected plugins
+    :param book_timeout: --book-timeout the plugins were created with
+    """
+    daemon_threads = True
+
+    def __init__(self, path, plugins, book_timeout):
+        self.path = os.path.expanduser(path)
+        self.plugins = plugins
+        self.book_timeout = book_timeout
+        # Commands share the plugins' order books, so they run one at a time
+        self._lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            if is_running(self.path):
+                raise ValueError("A daemon is already listening on {0}".format(self.path))
+            os.unlink(self.path)
+        UnixStreamServer.__init__(self, self.path, DaemonHandler)
+        os.chmod(self.path, 0600)
+
+    def execute(self, request):
+        command = request.get('command')
+        if command not in COMMANDS:
+            raise ValueError("Unknown command: {0}".format(command))
+        if request.get('book_timeout', self.book_timeout) != self.book_timeout:
+            raise DaemonUnavailable("Running with --book-timeout={0}".format(
+                    self.book_timeout))
+        by_name = dict((plugin.plugin_name, plugin) for plugin in self.plugins)
+        names = request.get('plugins')
+        if names is None:
+            names = [plugin.plugin_name for plugin in self.plugins]
+        missing = [name for name in names if name not in by_name]
+        if missing:
+            raise DaemonUnavailable("Not connected to {0}".format(', '.join(missing)))
+        plugins = [by_name[name] for name in names]
+
+        # The output goes to the client only, not to sys.stdout, where the
+        # background threads print
+        output = StringIO()
+        with self._lock:
+            _run_command(command, plugins, int(request.get('cycles', 20)), output)
+        return output.getvalue()
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def is_running(path):
+    """ Whether a daemon accepts connections on the socket.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(os.path.expanduser(path))
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def send_command(path, command, plugins=None, cycles=20, book_timeout=None):
+    """ Run a command in the daemon.
+
+    :param path: Path of the daemon's socket
+    :param plugins: Names of the plugins to run the command on (None = all
+        the daemon is connected to)
+    :param book_timeout: Max. time to wait for an order book (None = the
+        daemon's)
+    :return: Output of the command
+    :raise DaemonUnavailable: No daemon is listening on the socket, or it
+        can't run the command with these plugins and book timeout
+    :raise ValueError: The command failed
+    """
+    path = os.path.expanduser(path)
+    if not os.path.exists(path):
+        raise DaemonUnavailable(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CLIENT_TIMEOUT)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error:
+            raise DaemonUnavailable(path)
+        request = {'command': command, 'plugins': plugins, 'cycles': cycles}
+        if book_timeout is not None:
+            request['book_timeout'] = book_timeout
+        sock.sendall(json.dumps(request) + '\n')
+        data = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+
+    response = json.loads(data)
+    if response.get('unavailable'):
+        raise DaemonUnavailable(response['unavailable'])
+    if response.get('error'):
+        raise ValueError(response['error'])
+    return response['output']
@@ -0,0 +1,193 @@
+""" Order book depth walking.
+"""
+from decimal import Decimal
+
+from fixedpoint import HUNDRED_PERCENT, VOLUME_SCALE
+
+
+def walk_books(bids, asks, bid_fee, ask_fee, avail_usd=None, avail_xbt=None,
+        max_volume=None):
+    """ Find the most profitable volume for buying on one market and selling
+    on another one.
+
+    Both order books are consumed level by level, always taking the volume
+    both current levels can still provide. Bids only get lower and asks only
+    get higher, so the profit per XBT never grows - the walk stops at the
+    first level pair which is not profitable after fees. The cost is linear
+    in the number of levels consumed, levels beyond that are never touched.
+
+    :param bids: Iterable of (price, volume) of the selling market, highest
+        price first. Prices are in USD.
+    :param asks: Iterable of (price, volume) of the buying market, lowest
+        price first. Prices are in USD.
+    :param bid_fee: Trade fee of the selling market (in percent)
+    :param ask_fee: Trade fee of the buying market (in percent)
+    :param avail_usd: Available USD on the buying market (None = unlimited)
+    :param avail_xbt: Available XBT on the selling market (None = unlimited)
+    :param max_volume: Max. volume to trade (None = unlimited)
+    :return: Dictionary with the volume, totals, fees and profit, the
+        volume-weighted buy and sell prices and the worst buy and sell
+        prices reached (usable as limit prices for the orders)
+    """
+    bid_rate = bid_fee / 100
+    ask_rate = ask_fee / 100
+
+    # Volume limit given by max_volume and the available XBT
+    limit = max_volume
+    if avail_xbt is not None:
+        can_sell_volume = avail_xbt / (1 + bid_rate)
+        if limit is None or can_sell_volume < limit:
+            limit = can_sell_volume
+    usd_left = avail_usd
+
+    volume = Decimal('0')
+    buy_total = Decimal('0')
+    sell_total = Decimal('0')
+    buy_limit = None
+    sell_limit = None
+
+    bids = iter(bids)
+    asks = iter(asks)
+    (bid_price, bid_left) = next(bids, (None, None))
+    (ask_price, ask_left) = next(asks, (None, None))
+    while bid_price is not None and ask_price is not None:
+        unit_cost = ask_price * (1 + ask_rate)
+        if bid_price * (1 - bid_rate) <= unit_cost:
+            break
+
+        chunk = min(bid_left, ask_left)
+        if limit is not None:
+            chunk = min(chunk, limit - volume)
+        spent = False
+        if usd_left is not None:
+            affordable = usd_left / unit_cost
+            if affordable <= chunk:
+                # Spending the rest of the money, the division may leave a
+                # tiny remainder which must not be walked any further
+                chunk = affordable
+                spent = True
+            usd_left -= chunk * unit_cost
+        if chunk <= 0:
+            break
+
+        volume += chunk
+        buy_total += ask_price * chunk
+        sell_total += bid_price * chunk
+        buy_limit = ask_price
+        sell_limit = bid_price
+
+        if spent:
+            break
+
+        bid_left -= chunk
+        ask_left -= chunk
+        if bid_left <= 0:
+            (bid_price, bid_left) = next(bids, (None, None))
+        if ask_left <= 0:
+            (ask_price, ask_left) = next(asks, (None, None))
+
+    buy_fee = buy_total * ask_rate
+    sell_fee = sell_total * bid_rate
+    fees = buy_fee + sell_fee
+
+    return {
+            'volume': volume,
+            'buy_total': buy_total,
+            'buy_fee': buy_fee,
+            'sell_total': sell_total,
+            'sell_fee': sell_fee,
+            'fees': fees,
+            'profit': sell_total - buy_total - fees,
+            'buy_price': buy_total / volume if volume else None,
+            'sell_price': sell_total / volume if volume else None,
+            'buy_limit': buy_limit,
+            'sell_limit': sell_limit,
+        }
+
+
+def walk_books_fixed(bids, asks, bid_fee, ask_fee, avail_usd=None,
+        avail_xbt=None, max_volume=None):
+    """ walk_books() in integer fixed-point arithmetic (see fixedpoint.py).
+
+    Prices are in PRICE_SCALE units, volumes in satoshis and fees in
+    FEE_SCALE units. The volume is rounded down to whole satoshis where the
+    available funds limit it, fees are rounded up to whole MONEY_SCALE
+    units - apart from that, the results are exact.
+
+    :return: Dictionary like walk_books(), volume in satoshis, prices in
+        PRICE_SCALE units, totals, fees and profit in MONEY_SCALE units
+    """
+    hundred = HUNDRED_PERCENT
+    # A level pair is profitable if
+    #   bid_price * (1 - bid_fee) > ask_price * (1 + ask_fee)
+    # which is compared as integers scaled by 100 percent
+    bid_keep = hundred - bid_fee
+    ask_pay = hundred + ask_fee
+
+    limit = max_volume
+    if avail_xbt is not None:
+        can_sell_volume = avail_xbt * hundred // (hundred + bid_fee)
+        if limit is None or can_sell_volume < limit:
+            limit = can_sell_volume
+    # Money left, scaled by 100 percent to keep the fee on top exact
+    usd_left = avail_usd * VOLUME_SCALE * hundred if avail_usd is not None else None
+
+    volume = 0
+    buy_total = 0
+    sell_total = 0
+    buy_limit = None
+    sell_limit = None
+
+    bids = iter(bids)
+    asks = iter(asks)
+    (bid_price, bid_left) = next(bids, (None, None))
+    (ask_price, ask_left) = next(asks, (None, None))
+    while bid_price is not None and ask_price is not None:
+        unit_cost = ask_price * ask_pay
+        if bid_price * bid_keep <= unit_cost:
+            break
+
+        chunk = min(bid_left, ask_left)
+        if limit is not None:
+            chunk = min(chunk, limit - volume)
+        spent = False
+        if usd_left is not None:
+            affordable = usd_left // unit_cost
+            if affordable <= chunk:
+                chunk = affordable
+                spent = True
+            usd_left -= chunk * unit_cost
+        if chunk <= 0:
+            break
+
+        volume += chunk
+        buy_total += ask_price * chunk
+        sell_total += bid_price * chunk
+        buy_limit = ask_price
+        sell_limit = bid_price
+
+        if spent:
+            break
+
+        bid_left -= chunk
+        ask_left -= chunk
+        if bid_left <= 0:
+            (bid_price, bid_left) = next(bids, (None, None))
+        if ask_left <= 0:
+            (ask_price, ask_left) = next(asks, (None, None))
+
+    buy_fee = -(-buy_total * ask_fee // hundred)
+    sell_fee = -(-sell_total * bid_fee // hundred)
+    fees = buy_fee + sell_fee
+
+    return {
+            'volume': volume,
+            'buy_total': buy_total,
+            'buy_fee': buy_fee,
+            'sell_total': sell_total,
+            'sell_fee': sell_fee,
+            'fees': fees,
+            'profit': sell_total - buy_total - fees,
+            'buy_limit': buy_limit,
+            'sell_limit': sell_limit,
+        }
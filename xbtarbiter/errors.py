@@ -0,0 +1,10 @@
+""" Exceptions shared by all exchange plugins.
+"""
+
+
+class ExchangeError(Exception):
+    """ Error reported by an exchange (or its plugin).
+
+    Subclasses set `exchange` to the name shown in error messages.
+    """
+    exchange = 'Exchange'
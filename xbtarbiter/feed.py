@@ -0,0 +1,313 @@
+""" Push-driven order books.
+
+A feed connects to the WebSocket stream of an exchange and keeps a local copy
+of the exchange's order book up to date from a snapshot followed by
+incremental updates. The exchange's protocol is spoken by the plugin:
+
+    FEED_URL                           default URL of the stream
+    feed_depth(depth)                  levels the stream keeps on each side
+                                       for the given installed depth
+    feed_subscriptions(depth)          messages sent after connecting
+    parse_feed_message(message)        (snapshot, bids, asks) or None
+    verify_feed_book(message, book)    raises FeedGap if the local book
+                                       doesn't match the message's checksum
+                                       or sequence number
+    fetch_book_levels()                (bids, asks) from the REST API
+
+When an update is found to be missing, the local book is resynced from the
+REST API and the feed reconnects for a new snapshot of the stream.
+"""
+import heapq
+import socket
+import threading
+import time
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from Queue import Empty
+from decimal import Decimal
+
+from websocket import WebSocketError, connect
+
+
+class FeedError(Exception):
+    """ A message of the stream couldn't be applied to the local book.
+    """
+
+
+class FeedGap(FeedError):
+    """ The local book has missed an update of the stream.
+    """
+
+
+def parse_address(address):
+    """ Parse a 'host:port' string.
+
+    :return: (host, port) tuple
+    """
+    (host, _, port) = address.rpartition(':')
+    return (host or 'localhost', int(port))
+
+
+def feed_url(address):
+    """ URL of a stream configured as a ws:// or wss:// URL, or as the
+    'host:port' of a local stand-in (see feedserver.py).
+    """
+    if '://' in address:
+        return address
+    return 'ws://{0}:{1}'.format(*parse_address(address))
+
+
+def _set_level(side, price, volume):
+    price = Decimal(price)
+    volume = Decimal(volume)
+    if volume > 0:
+        side[price] = volume
+    else:
+        side.pop(price, None)
+
+
+class LocalOrderBook(object):
+    """ Order book maintained from a snapshot and incremental updates.
+
+    Levels are kept in dictionaries mapping price to volume, an update with
+    zero volume removes the level. The best bid and ask are cached and only
+    searched for again when the best level is removed.
+    """
+    def __init__(self):
+        self.bids = {}
+        self.asks = {}
+        self.ts = None
+        self._best_bid = None
+        self._best_ask = None
+
+    def apply_snapshot(self, bids, asks):
+        self.bids = {}
+        self.asks = {}
+        self._best_bid = None
+        self._best_ask = None
+        self.apply_update(bids, asks)
+
+    def apply_update(self, bids, asks):
+        for (price, volume) in bids:
+            _set_level(self.bids, price, volume)
+        for (price, volume) in asks:
+            _set_level(self.asks, price, volume)
+
+        # Update the cached best levels
+        if self._best_bid not in self.bids:
+            self._best_bid = max(self.bids) if self.bids else None
+        for (price, _) in bids:
+            price = Decimal(price)
+            if price in self.bids and price > self._best_bid:
+                self._best_bid = price
+        if self._best_ask not in self.asks:
+            self._best_ask = min(self.asks) if self.asks else None
+        for (price, _) in asks:
+            price = Decimal(price)
+            if price in self.asks and price < self._best_ask:
+                self._best_ask = price
+
+        self.ts = time.time()
+
+    def top(self):
+        """ Return the top of the book as a (bid price, bid volume, ask price,
+        ask volume) tuple.
+        """
+        return (self._best_bid, self.bids.get(self._best_bid),
+                self._best_ask, self.asks.get(self._best_ask))
+
+    def truncate(self, depth):
+        """ Drop the levels beyond `depth` on each side - streams of a
+        limited depth don't send removals of the levels falling out of it.
+        """
+        for (side, worst) in ((self.bids, heapq.nsmallest), (self.asks, heapq.nlargest)):
+            if len(side) > depth:
+                for price in worst(len(side) - depth, side):
+                    del side[price]
+
+    def levels(self, depth):
+        """ Return the best `depth` levels of both sides as a (bids, asks)
+        tuple of (price, volume) lists, best price first.
+        """
+        bids = [(price, self.bids[price])
+                for price in heapq.nlargest(depth, self.bids)]
+        asks = [(price, self.asks[price])
+                for price in heapq.nsmallest(depth, self.asks)]
+        return (bids, asks)
+
+
+class BookFeed(object):
+    """ Streaming order book feed of one plugin.
+
+    The feed runs in a background thread. Whenever the top of the book
+    changes, the plugin is put into the `events` queue. The local book is
+    handed over to the plugin by install(), which should be called from the
+    thread evaluating the books.
+
+    :param plugin: plugin which speaks the stream's protocol and receives
+        the book
+    :param url: ws:// or wss:// URL of the stream
+    :param events: Queue receiving plugins whose book top has changed
+    :param depth: number of levels installed into the plugin
+    :param reconnect_delay: time to wait before reconnecting (in seconds)
+    :param timeout: max. time without a message before the connection is
+        considered dead (in seconds)
+    """
+    def __init__(self, plugin, url, events, depth=25, reconnect_delay=1.0,
+            timeout=30.0):
+        self.plugin = plugin
+        self.url = url
+        self.events = events
+        self.depth = depth
+        self.stream_depth = plugin.feed_depth(depth)
+        self.reconnect_delay = reconnect_delay
+        self.timeout = timeout
+        self.book = LocalOrderBook()
+
+        self._live = False
+        self._last_top = None
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def live(self):
+        """ True when the local book is up to date - a snapshot of the
+        stream has been received, or the book has been resynced from the
+        REST API while reconnecting.
+        """
+        return self._live
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+
+    def install(self):
+        """ Load the current local book into the plugin.
+        """
+        with self._lock:
+            (bids, asks) = self.book.levels(self.depth)
+        self.plugin.load_order_book(bids, asks)
+
+    def _run(self):
+        while not self._stopped:
+            delay = self.reconnect_delay
+            try:
+                stream = connect(self.url, self.timeout)
+                try:
+                    for message in self.plugin.feed_subscriptions(self.stream_depth):
+                        stream.send(json.dumps(message))
+                    self._read(stream)
+                finally:
+                    stream.close()
+                self._live = False
+            except FeedGap as e:
+                print "{market:20}  feed out of sync ({error}), resyncing".format(
+                        market=self.plugin.name, error=e)
+                # The REST book bridges the time until the new snapshot
+                self._live = self._resync()
+                delay = 0
+            except (socket.error, WebSocketError, FeedError) as e:
+                print "{market:20}  feed error: {error}".format(
+                        market=self.plugin.name, error=e)
+                self._live = False
+            if not self._stopped and delay:
+                time.sleep(delay)
+
+    def _resync(self):
+        """ Replace the local book with the one from the REST API.
+
+        :return: Whether it succeeded
+        """
+        try:
+            (bids, asks) = self.plugin.fetch_book_levels()
+        except Exception as e:
+            print "{market:20}  resync failed: {error}".format(
+                    market=self.plugin.name, error=e)
+            return False
+        with self._lock:
+            self.book.apply_snapshot(bids, asks)
+            self.book.truncate(self.stream_depth)
+            top = self.book.top()
+        self._notify(top)
+        return True
+
+    def _read(self, stream):
+        while not self._stopped:
+            text = stream.receive()
+            if text is None:
+                return
+            try:
+                self._handle(json.loads(text))
+            except FeedError:
+                raise
+            except Exception as e:
+                # The local book can't be trusted after a lost update - the
+                # caller reconnects and starts over with a new snapshot
+                raise FeedError("malformed message {0!r}: {1!r}".format(
+                        text[:100], e))
+
+    def _handle(self, message):
+        parsed = self.plugin.parse_feed_message(message)
+        if parsed is None:
+            return
+
+        (snapshot, bids, asks) = parsed
+        with self._lock:
+            if snapshot:
+                self.book.apply_snapshot(bids, asks)
+            elif self._live:
+                self.book.apply_update(bids, asks)
+            else:
+                # Updates are meaningless until we have a snapshot
+                return
+            self.book.truncate(self.stream_depth)
+            self.plugin.verify_feed_book(message, self.book)
+            self._live = True
+            top = self.book.top()
+        self._notify(top)
+
+    def _notify(self, top):
+        if top != self._last_top:
+            self._last_top = top
+            self.events.put(self.plugin)
+
+
+def start_feeds(plugins, events, depth=25):
+    """ Start a feed for every plugin, on the stream configured as the
+    plugin's feed address or the exchange's own.
+
+    :return: List of BookFeed objects
+    """
+    feeds = []
+    for plugin in plugins:
+        feed = BookFeed(plugin, feed_url(plugin.feed_address or plugin.FEED_URL),
+                events, depth=depth)
+        feed.start()
+        feeds.append(feed)
+    return feeds
+
+
+def wait_for_update(events):
+    """ Block until at least one book top has changed.
+
+    :return: Set of plugins whose book top has changed
+    """
+    changed = set()
+    while not changed:
+        try:
+            # Waiting with a timeout keeps the wait interruptible by Ctrl-C
+            changed.add(events.get(timeout=1.0))
+        except Empty:
+            continue
+    while True:
+        try:
+            changed.add(events.get_nowait())
+        except Empty:
+            return changed
@@ -0,0 +1,195 @@
+""" Local stand-in for the exchanges' streaming order book endpoints.
+
+The server speaks WebSocket like the exchanges. After a client subscribes,
+it streams a randomly moving synthetic book the way the given exchange
+does: Bitstamp's book channel sends a snapshot of the top of the book every
+time, Kraken's sends a snapshot followed by incremental updates carrying
+checksums. It allows running the event-driven trading loop offline.
+"""
+import random
+import socket
+import time
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from SocketServer import ThreadingTCPServer, StreamRequestHandler
+
+from websocket import WebSocketError, accept
+
+
+# Exchanges whose message format the server can produce
+EXCHANGES = ('bitstamp', 'kraken')
+
+
+class SyntheticBook(object):
+    """ Randomly moving order book.
+
+    :param mid: initial mid price
+    :param depth: number of levels on each side
+    :param tick: price difference between levels
+    :param seed: random seed
+    """
+    def __init__(self, mid=600.0, depth=25, tick=0.05, seed=None):
+        self.depth = depth
+        self.tick = tick
+        self._random = random.Random(seed)
+        self.bids = {}
+        self.asks = {}
+        for i in range(depth):
+            self.bids[round(mid - tick * (i + 1), 2)] = self._volume()
+            self.asks[round(mid + tick * (i + 1), 2)] = self._volume()
+
+    def _volume(self):
+        return round(self._random.uniform(0.01, 5.0), 8)
+
+    def snapshot(self):
+        bids = sorted(self.bids.items(), reverse=True)
+        asks = sorted(self.asks.items())
+        return (bids, asks)
+
+    def step(self):
+        """ Change the book randomly.
+
+        :return: Changed levels as a (bids, asks) tuple of (price, volume)
+            lists, zero volume means the level was removed
+        """
+        if self._random.random() < 0.5:
+            (side, other, sign) = (self.bids, self.asks, -1)
+        else:
+            (side, other, sign) = (self.asks, self.bids, 1)
+        best = max(side) if sign < 0 else min(side)
+        changes = []
+
+        action = self._random.random()
+        if action < 0.4:
+            # Change volume of one of the best levels
+            price = sorted(side, key=lambda p: sign * p)[self._random.randint(0, 2)]
+            side[price] = self._volume()
+            changes.append((price, side[price]))
+        elif action < 0.7:
+            # Take out the best level
+            del side[best]
+            changes.append((best, 0.0))
+        else:
+            # Improve the best price, but never cross the other side
+            new = round(best - sign * self.tick, 2)
+            other_best = min(other) if sign < 0 else max(other)
+            if new not in side and sign * (other_best - new) < 0:
+                side[new] = self._volume()
+                changes.append((new, side[new]))
+
+        # Keep the number of levels constant
+        while len(side) > self.depth:
+            worst = max(side) if sign > 0 else min(side)
+            del side[worst]
+            changes.append((worst, 0.0))
+        while len(side) < self.depth:
+            worst = max(side) if sign > 0 else min(side)
+            price = round(worst + sign * self.tick, 2)
+            side[price] = self._volume()
+            changes.append((price, side[price]))
+
+        if sign < 0:
+            return (changes, [])
+        return ([], changes)
+
+
+def _levels(levels, with_ts=False):
+    result = []
+    for (price, volume) in levels:
+        level = ["{0:.2f}".format(price), "{0:.8f}".format(volume)]
+        if with_ts:
+            level.append("{0:.6f}".format(time.time()))
+        result.append(level)
+    return result
+
+
+def format_message(exchange, snapshot, bids, asks, book):
+    """ Format book levels as a message of the given exchange.
+
+    :param book: SyntheticBook the levels come from (Kraken's updates carry
+        the checksum of its top)
+    """
+    if exchange == 'bitstamp':
+        return {
+                'event': 'data',
+                'channel': 'order_book_btcusd',
+                'data': {
+                        'bids': _levels(bids),
+                        'asks': _levels(asks),
+                    },
+            }
+    elif exchange == 'kraken':
+        if snapshot:
+            data = {'bs': _levels(bids, True), 'as': _levels(asks, True)}
+        else:
+            from kraken import book_checksum, CHECKSUM_DEPTH
+
+            data = {}
+            if bids:
+                data['b'] = _levels(bids, True)
+            if asks:
+                data['a'] = _levels(asks, True)
+            (top_bids, top_asks) = book.snapshot()
+            data['c'] = str(book_checksum(_levels(top_bids[:CHECKSUM_DEPTH]),
+                    _levels(top_asks[:CHECKSUM_DEPTH])))
+        return [0, data, 'book-{0}'.format(book.depth), 'XBT/EUR']
+    raise ValueError("Unknown exchange: {0}".format(exchange))
+
+
+def _subscribed_depth(exchange, message):
+    if exchange == 'kraken':
+        return int(message.get('subscription', {}).get('depth', 10))
+    return 100
+
+
+class FeedHandler(StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        try:
+            self._ws = accept(self.connection, self.rfile)
+            # Nothing is sent before the client subscribes
+            text = self._ws.receive()
+            if text is None:
+                return
+            depth = _subscribed_depth(server.exchange, json.loads(text))
+            book = SyntheticBook(mid=server.mid, depth=depth, seed=server.seed)
+            (bids, asks) = book.snapshot()
+            self._send(format_message(server.exchange, True, bids, asks, book))
+            while True:
+                time.sleep(server.interval)
+                if server.exchange == 'bitstamp':
+                    book.step()
+                    (bids, asks) = book.snapshot()
+                    self._send(format_message(server.exchange, True, bids, asks, book))
+                else:
+                    (bids, asks) = book.step()
+                    self._send(format_message(server.exchange, False, bids, asks, book))
+        except (socket.error, WebSocketError, ValueError):
+            pass
+
+    def _send(self, message):
+        self._ws.send(json.dumps(message))
+
+
+class FeedServer(ThreadingTCPServer):
+    """ Stand-in streaming server of one exchange.
+
+    :param address: (host, port) to listen on
+    :param exchange: message format ('bitstamp' or 'kraken')
+    :param interval: time between updates (in seconds)
+    :param mid: initial mid price of the synthetic book
+    :param seed: random seed of the synthetic book
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, exchange, interval=0.5, mid=600.0, seed=None):
+        if exchange not in EXCHANGES:
+            raise ValueError("Unknown exchange: {0}".format(exchange))
+        self.exchange = exchange
+        self.interval = interval
+        self.mid = mid
+        self.seed = seed
+        ThreadingTCPServer.__init__(self, address, FeedHandler)
@@ -0,0 +1,112 @@
+""" Integer fixed-point amounts for the pricing hot path.
+
+Prices are integers in units of 1/PRICE_SCALE USD, volumes in satoshis
+(1/VOLUME_SCALE XBT), fees in units of 1/FEE_SCALE percent and money
+amounts (price times volume) in units of 1/MONEY_SCALE USD. Amounts are
+converted once, when an order book or balance comes from the exchange, and
+back to Decimal only for the results - the arithmetic in between is plain
+integer arithmetic, which is far cheaper than Decimal's.
+
+Conversion of the exchanges' decimal strings is exact as long as they have
+no more decimal places than the scale.
+"""
+from decimal import Decimal, ROUND_FLOOR, ROUND_CEILING
+
+
+PRICE_SCALE = 10 ** 8
+VOLUME_SCALE = 10 ** 8
+FEE_SCALE = 10 ** 6
+MONEY_SCALE = PRICE_SCALE * VOLUME_SCALE
+
+# 100 percent in fee units
+HUNDRED_PERCENT = 100 * FEE_SCALE
+
+# Number of decimal places of the scales
+_DIGITS = dict((10 ** digits, digits) for digits in range(33))
+
+
+def to_fixed(value, scale, rounding=ROUND_FLOOR):
+    """ Convert a decimal string, Decimal or integer to a fixed-point
+    integer. Digits beyond the scale are rounded down (or as given). The
+    scale must be a power of 10.
+    """
+    if isinstance(value, (int, long)):
+        return value * scale
+    text = value if isinstance(value, basestring) else str(value)
+    if 'e' not in text and 'E' not in text:
+        digits = _DIGITS[scale]
+        (whole, _, frac) = text.strip().partition('.')
+        if len(frac) <= digits:
+            negative = whole.startswith('-')
+            result = int(whole or '0') * scale
+            frac_value = int(frac.ljust(digits, '0')) if digits else 0
+            return result - frac_value if negative else result + frac_value
+    # Exponents and extra digits are left to Decimal
+    return int((Decimal(value) * scale).to_integral_value(rounding))
+
+
+def to_fixed_ceil(value, scale):
+    return to_fixed(value, scale, ROUND_CEILING)
+
+
+def from_fixed(value, scale):
+    """ Convert a fixed-point integer back to a Decimal. The scale must be
+    a power of 10.
+    """
+    # Parsing the exponent is several times faster than dividing Decimals
+    return Decimal('{0}E-{1}'.format(value, _DIGITS[scale]))
+
+
+def fixed_level(level):
+    """ Convert a (price, volume, ...) level with the price in USD.
+    """
+    return (to_fixed(level[0], PRICE_SCALE), to_fixed(level[1], VOLUME_SCALE))
+
+
+class FixedLevels(object):
+    """ Order book levels converted to fixed-point (price, volume) tuples
+    when they are first iterated over. The walk through the books usually
+    stops after a few levels, the rest of a deep book is never converted.
+
+    :param levels: List of levels as received from the exchange
+    :param convert: Function converting one level
+    """
+    def __init__(self, levels, convert=fixed_level):
+        self._levels = levels
+        self._convert = convert
+        self._fixed = []
+
+    def __iter__(self):
+        fixed = self._fixed
+        levels = self._levels
+        i = 0
+        while True:
+            if i < len(fixed):
+                yield fixed[i]
+            elif i < len(levels):
+                level = self._convert(levels[i])
+                fixed.append(level)
+                yield level
+            else:
+                return
+            i += 1
+
+    def __len__(self):
+        return len(self._levels)
+
+    def top(self):
+        """ Best level or None.
+        """
+        return next(iter(self), None)
+
+
+def fixed_book(plugin):
+    """ The plugin's order book as (bids, asks) iterables of fixed-point
+    (price, volume) tuples, prices in USD.
+
+    Plugins cache the converted book in `fixed_book()`, others have their
+    book converted on every call.
+    """
+    if hasattr(plugin, 'fixed_book'):
+        return plugin.fixed_book()
+    return (FixedLevels(list(plugin.iter_bids())), FixedLevels(list(plugin.iter_asks())))
@@ -1,3 +1,6 @@
+import os
+import threading
+import time
 import requests
 from decimal import Decimal
 
@@ -18,3 +21,109 @@ def get_eurusd():
     if response.status_code != 200:
         raise Exception('Failed to get EURUSD exchange rate')
     return Decimal(response.text)
+
+
+class YahooRateSource(object):
+    """ EUR/USD rate from Yahoo Finance.
+    """
+    def fetch(self):
+        return get_eurusd()
+
+
+class FileRateSource(object):
+    """ EUR/USD rate read from a local file containing just the number.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def fetch(self):
+        with open(self.path, 'r') as ratefile:
+            return Decimal(ratefile.read().strip())
+
+
+class StaticRateSource(object):
+    """ Fixed EUR/USD rate.
+    """
+    def __init__(self, rate):
+        self.rate = Decimal(rate)
+
+    def fetch(self):
+        return self.rate
+
+
+# Cost of actually converting between EUR and USD, e.g. the spread of a
+# bank or a forex broker (in percent)
+DEFAULT_CONVERSION_FEE = Decimal('0.5')
+
+
+class RateProvider(object):
+    """ Cached EUR/USD rate.
+
+    The rate is fetched once on creation and then refreshed by a background
+    thread (see start()) whenever it is older than `ttl`, so reading `rate`
+    never blocks on a network call.
+
+    :param source: Object with a fetch() method returning the rate
+    :param ttl: Max. age of the rate before it is refreshed (in seconds)
+    :param retry_interval: Time to wait after a failed refresh (in seconds)
+    :param fee: Cost of converting at the rate (in percent)
+    """
+    def __init__(self, source, ttl=300.0, retry_interval=30.0,
+            fee=DEFAULT_CONVERSION_FEE):
+        self.source = source
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.fee = Decimal(fee)
+        self.rate = source.fetch()
+        self.fetched_at = time.time()
+        self._thread = None
+
+    @property
+    def age(self):
+        """ Age of the current rate (in seconds).
+        """
+        return time.time() - self.fetched_at
+
+    def refresh(self):
+        rate = self.source.fetch()
+        self.rate = rate
+        self.fetched_at = time.time()
+
+    def start(self):
+        """ Start refreshing the rate in the background.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            time.sleep(max(0.0, self.ttl - self.age))
+            try:
+                self.refresh()
+            except Exception as e:
+                print "Failed to refresh EUR/USD rate (current rate is {age:.0f}s old): {error}".format(
+                        age=self.age, error=e)
+                time.sleep(self.retry_interval)
+
+
+def create_rate_provider(cfg):
+    """ Create a rate provider from the "forex" config section.
+
+    Supported sources are "yahoo" (default), "file" (with "path") and
+    "static" (with "rate"). An optional "fee" is the cost of converting at
+    the rate (in percent).
+    """
+    source = cfg.get('source', 'yahoo')
+    if source == 'yahoo':
+        rate_source = YahooRateSource()
+    elif source == 'file':
+        rate_source = FileRateSource(os.path.expanduser(cfg['path']))
+    elif source == 'static':
+        rate_source = StaticRateSource(cfg['rate'])
+    else:
+        raise ValueError("Unknown forex source: {0}".format(source))
+    return RateProvider(rate_source, ttl=float(cfg.get('ttl', 300.0)),
+            fee=cfg.get('fee', DEFAULT_CONVERSION_FEE))
@@ -0,0 +1,229 @@
+""" Currency graph of the markets, for finding arbitrage cycles.
+
+Currencies are the nodes. Every market (e.g. XBT/EUR at Kraken) adds two
+edges: selling the base currency for the quote currency at the best bid,
+and buying it at the best ask, both after fees. An edge of rate r has the
+weight -log(r), so a cycle of edges whose rates multiply to more than 1 -
+a profitable round trip - is a cycle of negative weight.
+
+The cycles of up to `max_legs` edges are enumerated when a market is added,
+each of them once, when the last of its edges appears. Every edge knows the
+cycles it is part of, so a changed price only re-evaluates those cycles
+instead of searching the whole graph again.
+"""
+import math
+from collections import defaultdict
+
+from fixedpoint import fixed_book, PRICE_SCALE
+
+
+SELL = 'sell'
+BUY = 'buy'
+
+DEFAULT_MAX_LEGS = 4
+
+# Cycles whose rate is above 1 - TOLERANCE count as profitable; the rates
+# are floats, the final decision is left to the fixed-point evaluation
+TOLERANCE = 1e-9
+
+
+class Edge(object):
+    """ Converting `source` to `target` currency on a market.
+    """
+    __slots__ = ('market', 'side', 'source', 'target', 'rate', 'weight', 'cycles')
+
+    def __init__(self, market, side, source, target):
+        self.market = market
+        self.side = side
+        self.source = source
+        self.target = target
+        self.rate = None
+        self.weight = float('inf')
+        self.cycles = []
+
+    def __repr__(self):
+        return "<Edge {0} {1} {2}->{3}>".format(self.market, self.side, self.source, self.target)
+
+
+class Cycle(object):
+    """ Round trip through the edges, starting and ending in the source
+    currency of the first one.
+    """
+    __slots__ = ('edges', 'weight')
+
+    def __init__(self, edges):
+        self.edges = edges
+        self.weight = sum(edge.weight for edge in edges)
+
+    @property
+    def rate(self):
+        """ Amount of the starting currency got back for 1 of it.
+        """
+        return math.exp(-self.weight)
+
+    @property
+    def profitable(self):
+        return self.weight < -math.log1p(-TOLERANCE)
+
+    @property
+    def markets(self):
+        return [edge.market for edge in self.edges]
+
+    def __str__(self):
+        route = ' -> '.join([self.edges[0].source] + [
+                "{0} ({1} {2})".format(edge.target, edge.side, edge.market)
+                for edge in self.edges])
+        return "{route}: {profit:+.4f}%".format(route=route,
+                profit=(self.rate - 1) * 100)
+
+
+class CurrencyGraph(object):
+    """ Currency graph with incrementally maintained cycles.
+
+    :param max_legs: Max. number of edges of a cycle
+    """
+    def __init__(self, max_legs=DEFAULT_MAX_LEGS):
+        self.max_legs = max_legs
+        self._edges = {}
+        self._outgoing = defaultdict(list)
+        self._profitable = set()
+        # Markets added by each owner (plugin name)
+        self._owned = defaultdict(set)
+
+    def update_market(self, market, base, quote, bid, ask, fee, owner=None):
+        """ Add a market or update its prices.
+
+        :param market: Unique name of the market
+        :param base: Currency bought and sold (e.g. 'XBT')
+        :param quote: Currency of the prices (e.g. 'EUR')
+        :param bid: Best bid (quote per base) or None
+        :param ask: Best ask (quote per base) or None
+        :param fee: Trade fee in percent
+        :param owner: Name the market can be removed by with remove_owner()
+        """
+        if owner is not None:
+            self._owned[owner].add(market)
+        fee_rate = float(fee) / 100
+        self._set_edge(market, SELL, base, quote,
+                float(bid) * (1 - fee_rate) if bid else None)
+        self._set_edge(market, BUY, quote, base,
+                1 / (float(ask) * (1 + fee_rate)) if ask else None)
+
+    def remove_market(self, market):
+        for side in (SELL, BUY):
+            edge = self._edges.pop((market, side), None)
+            if edge is None:
+                continue
+            self._outgoing[edge.source].remove(edge)
+            for cycle in edge.cycles:
+                self._profitable.discard(cycle)
+                for other in cycle.edges:
+                    if other is not edge:
+                        other.cycles.remove(cycle)
+
+    def remove_owner(self, owner):
+        """ Remove all markets added by the owner.
+        """
+        for market in self._owned.pop(owner, ()):
+            self.remove_market(market)
+
+    def _set_edge(self, market, side, source, target, rate):
+        weight = -math.log(rate) if rate else float('inf')
+        edge = self._edges.get((market, side))
+        if edge is None:
+            edge = Edge(market, side, source, target)
+            edge.rate = rate
+            edge.weight = weight
+            self._edges[(market, side)] = edge
+            self._outgoing[source].append(edge)
+            for cycle in self._find_cycles(edge):
+                for cycle_edge in cycle.edges:
+                    cycle_edge.cycles.append(cycle)
+                self._evaluate(cycle)
+        elif weight != edge.weight:
+            edge.rate = rate
+            edge.weight = weight
+            for cycle in edge.cycles:
+                cycle.weight = sum(cycle_edge.weight for cycle_edge in cycle.edges)
+                self._evaluate(cycle)
+
+    def _evaluate(self, cycle):
+        if cycle.profitable:
+            self._profitable.add(cycle)
+        else:
+            self._profitable.discard(cycle)
+
+    def _find_cycles(self, first):
+        """ Simple cycles through the edge, each market used at most once.
+        """
+        cycles = []
+        path = [first]
+
+        def extend(currency, visited, markets):
+            for edge in self._outgoing[currency]:
+                if edge.market in markets:
+                    continue
+                if edge.target == first.source:
+                    cycles.append(Cycle(path + [edge]))
+                elif edge.target not in visited and len(path) + 1 < self.max_legs:
+                    path.append(edge)
+                    visited.add(edge.target)
+                    markets.add(edge.market)
+                    extend(edge.target, visited, markets)
+                    markets.discard(edge.market)
+                    visited.discard(edge.target)
+                    path.pop()
+
+        extend(first.target, set([first.source, first.target]), set([first.market]))
+        return cycles
+
+    @property
+    def cycles(self):
+        """ All cycles of the graph.
+        """
+        seen = set()
+        for edge in self._edges.values():
+            for cycle in edge.cycles:
+                if cycle not in seen:
+                    seen.add(cycle)
+                    yield cycle
+
+    def profitable_cycles(self):
+        """ Profitable cycles, most profitable first.
+        """
+        return sorted(self._profitable, key=lambda cycle: cycle.weight)
+
+
+def plugin_markets(plugin):
+    """ The markets of a plugin as (market, base, quote, bid, ask, fee)
+    tuples.
+
+    Plugins trading in other currencies than USD list their markets (and
+    the conversion rates they use) in `graph_markets()`, for the others the
+    XBT/USD market is taken from the top of the book.
+    """
+    if hasattr(plugin, 'graph_markets'):
+        return plugin.graph_markets()
+    (bids, asks) = fixed_book(plugin)
+    bid = bids.top()
+    ask = asks.top()
+    return [(plugin.name, 'XBT', 'USD',
+            float(bid[0]) / PRICE_SCALE if bid else None,
+            float(ask[0]) / PRICE_SCALE if ask else None,
+            plugin.trade_fee)]
+
+
+def update_from_plugins(graph, plugins):
+    """ Update the graph with the current books of the plugins.
+    """
+    for plugin in plugins:
+        for market in plugin_markets(plugin):
+            graph.update_market(*market, owner=plugin.name)
+
+
+def remove_from_plugins(graph, plugins):
+    """ Remove the markets of the plugins, e.g. when their books are stale.
+    The books aren't looked at, they may have never been refreshed.
+    """
+    for plugin in plugins:
+        graph.remove_owner(plugin.name)
@@ -0,0 +1,288 @@
+""" Append-only journal of the trading events (opportunities taken, orders
+opened, cancelled, closed or failed).
+
+Journal.log() only appends the event to an in-memory queue - no formatting
+and no I/O on the trading path. A background thread writes the queued
+events in batches as JSON lines:
+
+    {"ts":1412345678.123456,"event":"order_open","market":"kraken.com [EUR]",...}
+
+and syncs the file to disk according to the fsync policy. Files are
+rotated daily (UTC) and when they reach `max_size`:
+
+    orders-2014-10-03.jsonl, orders-2014-10-03.1.jsonl, ...
+
+read_journal() reads the events back, e.g. for reconciling the orders with
+the exchanges.
+"""
+import collections
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+
+# Max. time between an event being logged and written (in seconds)
+FLUSH_INTERVAL = 0.1
+
+DEFAULT_MAX_SIZE = 10 * 1024 * 1024
+
+# Events in the journal
+EVENT_ORDER_OPEN = 'order_open'
+EVENT_ORDER_CLOSE = 'order_close'
+EVENT_ORDER_CANCEL = 'order_cancel'
+EVENT_ORDER_FAILED = 'order_failed'
+EVENT_OPPORTUNITY = 'opportunity'
+
+_FILENAME = re.compile(r'^orders-(\d{4}-\d{2}-\d{2})(?:\.(\d+))?\.jsonl$')
+
+
+def journal_filename(date, seq=0):
+    """ Name of the journal file of a date ('YYYY-MM-DD'), `seq`-th after
+    rotating by size.
+    """
+    if seq:
+        return 'orders-{0}.{1}.jsonl'.format(date, seq)
+    return 'orders-{0}.jsonl'.format(date)
+
+
+def journal_files(directory):
+    """ Journal files in the directory as (date, seq, path) tuples, oldest
+    first.
+    """
+    files = []
+    for name in os.listdir(directory):
+        match = _FILENAME.match(name)
+        if match:
+            files.append((match.group(1), int(match.group(2) or 0),
+                    os.path.join(directory, name)))
+    files.sort()
+    return files
+
+
+def _encode(fields):
+    # Decimals are kept as strings, so amounts are read back exactly
+    for (key, value) in fields.items():
+        if isinstance(value, Decimal):
+            fields[key] = str(value)
+    return fields
+
+
+class Journal(object):
+    """ Journal written by a background thread.
+
+    :param directory: Directory of the journal files
+    :param fsync: When to sync the file to disk - after every batch
+        (FSYNC_ALWAYS), at most every `fsync_interval` seconds
+        (FSYNC_INTERVAL) or never (FSYNC_NEVER, left to the OS)
+    :param fsync_interval: Time between syncs of FSYNC_INTERVAL (in seconds)
+    :param max_size: Size of a file at which it is rotated (in bytes)
+    """
+    def __init__(self, directory, fsync=FSYNC_INTERVAL, fsync_interval=1.0,
+            max_size=DEFAULT_MAX_SIZE):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy: {0}".format(fsync))
+        self.directory = os.path.expanduser(directory)
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.max_size = max_size
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # deque.append is atomic and doesn't take a lock
+        self._events = collections.deque()
+        self._file = None
+        self._date = None
+        self._seq = 0
+        self._size = 0
+        self._synced_at = time.time()
+        self._unwritten = []
+        self._error = None
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def log(self, event, **fields):
+        """ Queue an event for writing. Amounts may be Decimals.
+        """
+        self._events.append((time.time(), event, fields))
+
+    def _open(self, date):
+        files = [(seq, path) for (file_date, seq, path) in journal_files(self.directory)
+                if file_date == date]
+        (self._seq, path) = files[-1] if files else (0, os.path.join(
+                self.directory, journal_filename(date)))
+        self._date = date
+        self._file = open(path, 'a')
+        self._size = self._file.tell()
+
+    def _rotate(self, date):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+        if date != self._date:
+            self._open(date)
+        else:
+            self._seq += 1
+            self._file = open(os.path.join(self.directory,
+                    journal_filename(date, self._seq)), 'a')
+            self._size = 0
+
+    def _sync(self):
+        self._file.flush()
+        if self.fsync != FSYNC_NEVER:
+            os.fsync(self._file.fileno())
+        self._synced_at = time.time()
+
+    def _format(self, ts, event, fields):
+        record = _encode(dict(fields))
+        record['ts'] = ts
+        record['event'] = event
+        try:
+            return json.dumps(record, separators=(',', ':'), sort_keys=True) + '\n'
+        except (TypeError, ValueError) as e:
+            # It would fail again on every retry
+            print "Journal: dropping {event} event which can't be written: {error}".format(
+                    event=event, error=e)
+            return None
+
+    def _write_batch(self):
+        # Lines of a batch whose write failed are written first
+        lines = self._unwritten
+        self._unwritten = []
+        line = None
+        events = self._events
+        try:
+            if lines and self._file is None:
+                self._rotate(datetime.utcnow().strftime('%Y-%m-%d'))
+            while events:
+                (ts, event, fields) = events.popleft()
+                line = self._format(ts, event, fields)
+                if line is None:
+                    continue
+                date = datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d')
+                if date != self._date or self._size >= self.max_size:
+                    if lines:
+                        self._file.write(''.join(lines))
+                        lines = []
+                    self._rotate(date)
+                lines.append(line)
+                line = None
+                self._size += len(lines[-1])
+            written = bool(lines)
+            if lines:
+                self._file.write(''.join(lines))
+                lines = []
+        finally:
+            if line is not None:
+                lines.append(line)
+            self._unwritten = lines
+        if self._file is None:
+            return
+        if self.fsync == FSYNC_ALWAYS and written:
+            self._sync()
+        elif time.time() - self._synced_at >= self.fsync_interval:
+            self._sync()
+
+    def _run(self):
+        while not self._closed.wait(FLUSH_INTERVAL):
+            self._write_or_report()
+        self._write_or_report()
+
+    def _write_or_report(self):
+        """ Write a batch. A failure (e.g. a full disk) is reported once and
+        the batch is retried, the thread keeps running.
+        """
+        try:
+            self._write_batch()
+        except Exception as e:
+            if self._error is None:
+                print "Journal: writing failed, retrying: {0}".format(e)
+            self._error = e
+        else:
+            if self._error is not None:
+                print "Journal: writing works again"
+            self._error = None
+
+    def close(self):
+        """ Write the queued events and close the file.
+        """
+        self._closed.set()
+        self._thread.join()
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._file = None
+
+
+class NullJournal(object):
+    """ Journal discarding the events.
+    """
+    def log(self, event, **fields):
+        pass
+
+    def close(self):
+        pass
+
+
+def read_journal(directory, start=None, end=None, events=None):
+    """ Iterate over the journal's events as dicts, oldest first.
+
+    :param start: Only events at or after this timestamp (in seconds)
+    :param end: Only events before this timestamp (in seconds)
+    :param events: Only these events (list of names)
+    """
+    directory = os.path.expanduser(directory)
+    start_date = datetime.utcfromtimestamp(start).strftime('%Y-%m-%d') \
+            if start is not None else None
+    end_date = datetime.utcfromtimestamp(end).strftime('%Y-%m-%d') \
+            if end is not None else None
+    # Lines of other events are skipped without parsing them
+    markers = ['"event":"{0}"'.format(event) for event in events] if events else None
+
+    for (date, seq, path) in journal_files(directory):
+        if (start_date and date < start_date) or (end_date and date > end_date):
+            continue
+        with open(path) as f:
+            for line in f:
+                if markers and not any(marker in line for marker in markers):
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line of a crashed run
+                    continue
+                if start is not None and record['ts'] < start:
+                    continue
+                if end is not None and record['ts'] >= end:
+                    continue
+                yield record
+
+
+def unresolved_orders(directory, start=None):
+    """ Orders opened in the journal which it has no close or cancel of.
+
+    :return: Dict mapping (market, order ID) to the order_open event
+    """
+    orders = {}
+    for record in read_journal(directory, start=start,
+            events=(EVENT_ORDER_OPEN, EVENT_ORDER_CLOSE, EVENT_ORDER_CANCEL)):
+        key = (record['market'], record['order_id'])
+        if record['event'] == EVENT_ORDER_OPEN:
+            orders[key] = record
+        else:
+            orders.pop(key, None)
+    return orders
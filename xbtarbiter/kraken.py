@@ -1,18 +1,55 @@
-import requests
 import hmac
 import hashlib
 import time
 import base64
 import urllib
+import zlib
 
-from decimal import Decimal
+from decimal import Decimal, ROUND_CEILING, ROUND_FLOOR
+
+from session import HttpSession, ResponseCache, HTTP_NOT_MODIFIED
+from account import AccountState
+from forex import RateProvider, StaticRateSource, create_rate_provider
+from errors import ExchangeError
+from feed import FeedError, FeedGap
+from fixedpoint import FixedLevels, PRICE_SCALE, VOLUME_SCALE, to_fixed
+from nonce import NonceAllocator, nonce_allocator
+from ratelimit import create_scheduler, \
+        PRIORITY_ORDER, PRIORITY_STATUS, PRIORITY_BOOK, PRIORITY_BACKGROUND
 
 
 ORDER_OPEN = 'open'
 ORDER_CLOSED = 'closed'
+ORDER_CANCELLED = 'cancelled'
+
+# Kraken's statuses of orders which ended without being filled
+_CANCELLED_STATUSES = ('canceled', 'cancelled', 'expired')
+
+# Number of levels on each side covered by the stream's checksum
+CHECKSUM_DEPTH = 10
+
+
+def _checksum_field(value):
+    text = value if isinstance(value, basestring) else format(value, 'f')
+    return text.replace('.', '').lstrip('0')
+
+
+def book_checksum(bids, asks):
+    """ Checksum of the top of the book as sent in Kraken's stream updates:
+    CRC32 of the prices and volumes of the best asks, then the best bids,
+    without decimal points and leading zeros.
+
+    :param bids: List of (price, volume), highest price first
+    :param asks: List of (price, volume), lowest price first
+    """
+    text = ''.join(_checksum_field(price) + _checksum_field(volume)
+            for (price, volume) in asks[:CHECKSUM_DEPTH] + bids[:CHECKSUM_DEPTH])
+    return zlib.crc32(text) & 0xffffffff
+
 
+class KrakenException(ExchangeError):
+    exchange = 'Kraken.com'
 
-class KrakenException(Exception):
     def __init__(self, error):
         self.errors = error
 
@@ -23,9 +60,11 @@ class KrakenException(Exception):
 class KrakenOrder(object):
     """ Kraken order.
     """
-    def __init__(self, otype, oid):
+    def __init__(self, otype, oid, volume=None, price=None):
         self.otype = otype
         self.oid = oid
+        self.volume = volume
+        self.price = price
 
 
 class KrakenPlugin(object):
@@ -39,42 +78,250 @@ class KrakenPlugin(object):
 
     :param key: API key
     :param secret: API secret
-    :param eurusd_rate: current EUR/USD exchange rate
+    :param eurusd_rate: RateProvider of the EUR/USD exchange rate (or a fixed
+        rate)
+    :param book_timeout: max. time to wait for an order book refresh (in
+        seconds)
+    :param book_depth: number of order book levels to download
+    :param http_options: keyword arguments for the plugin's HttpSession
+        (pool size, timeouts)
+    :param feed_address: URL of the order book stream (default FEED_URL) or
+        'host:port' of a local stand-in
+    :param url: API base URL (default API_URL)
+    :param rate_limit: dict overriding the request budget (RATE_LIMIT)
+    :param nonces: NonceAllocator of the API key (default is one which isn't
+        persisted)
+    :param nonce_window: Whether the API key has a nonce window set, so
+        Kraken accepts its nonces out of order and the private requests
+        needn't wait for each other
     """
-    def __init__(self, key, secret, eurusd_rate):
+    API_URL = 'https://api.kraken.com'
+    FEED_URL = 'wss://ws.kraken.com'
+
+    # Depths the book channel of the stream can be subscribed with
+    FEED_DEPTHS = (10, 25, 100, 500, 1000)
+
+    # Nonces are in milliseconds
+    NONCE_UNIT = 10 ** 3
+
+    # Smallest price step of XBT/EUR orders
+    PRICE_TICK = Decimal('0.1')
+
+    # Kraken's call counter of the private API - it decays by 0.33 per
+    # second and mustn't exceed 15 (starter tier)
+    RATE_LIMIT = {
+            'capacity': 15,
+            'rate': 0.33,
+            'reserve': 0,
+        }
+
+    REQUEST_PRIORITIES = {
+            'private/AddOrder': PRIORITY_ORDER,
+            'private/CancelOrder': PRIORITY_ORDER,
+            'private/OpenOrders': PRIORITY_STATUS,
+            'private/ClosedOrders': PRIORITY_STATUS,
+            'public/Depth': PRIORITY_BOOK,
+            'private/Balance': PRIORITY_BACKGROUND,
+            'private/TradeVolume': PRIORITY_BACKGROUND,
+        }
+
+    # Counter increase of the requests, 1 if not listed. Orders are limited
+    # by the separate trading counter and don't count here. Public requests
+    # are limited per IP address, they take a small share of the budget so
+    # book refreshes are still paced and wait for the other requests.
+    REQUEST_COSTS = {
+            'private/AddOrder': 0,
+            'private/CancelOrder': 0,
+            'public/Depth': 0.2,
+        }
+
+    def __init__(self, key, secret, eurusd_rate, book_timeout=5.0,
+            book_depth=25, http_options=None, feed_address=None,
+            url=None, rate_limit=None, nonces=None, nonce_window=False):
         self.name = 'kraken.com [EUR]'
-
-        self._url = 'https://api.kraken.com'
+        self.nonce_window = nonce_window
+        self.book_timeout = book_timeout
+        self.order_book_ts = None
+        self.feed_address = feed_address
+        self.recorder = None
+        self._open_orders = {}
+        self._closed_orders = {}
+        self.book_depth = book_depth
+        self._order_book = None
+        self._fixed_book = None
+        self._fixed_book_rate = None
+        self._book_cache = ResponseCache()
+        self._session = HttpSession(**(http_options or {}))
+        self.scheduler = create_scheduler(self.RATE_LIMIT, rate_limit)
+
+        self._url = url or self.API_URL
         self._version = '0'
         self._key = key
         self._secret = secret
-        self._eurusd_rate = eurusd_rate
-        
-        self.refresh_account_info()
+        if not hasattr(eurusd_rate, 'rate'):
+            eurusd_rate = RateProvider(StaticRateSource(eurusd_rate))
+        self._eurusd = eurusd_rate
+        self._nonces = nonces or NonceAllocator(self.NONCE_UNIT)
+
+        # Kraken's balances include the funds of open orders
+        self.account = AccountState(self._fetch_balances, self._fetch_fee,
+                reserves_orders=False,
+                fetch_open_orders=self._fetch_open_order_ids)
 
     def refresh_account_info(self):
+        """ Reconcile the local account state with the exchange.
+        """
+        self.account.reconcile()
+
+    def _fetch_balances(self):
         path_balance = 'private/Balance'
-        self._account_info = self._http_post(path_balance)
+        account_info = self._http_post(path_balance)
+        balance_xbt = Decimal(account_info.get('XXBT', '0.0'))
+        balance_eur = Decimal(account_info.get('ZEUR', '0.0'))
+        return {
+                'balance_xbt': balance_xbt,
+                'balance_fiat': balance_eur,
+                'avail_xbt': balance_xbt,
+                'avail_fiat': balance_eur,
+            }
+
+    def _fetch_open_order_ids(self):
+        path_open = 'private/OpenOrders'
+        return self._http_post(path_open)['open'].keys()
 
+    def _fetch_fee(self):
         path_trade_volume = 'private/TradeVolume'
-        self._trade_volume = self._http_post(path_trade_volume,
+        trade_volume = self._http_post(path_trade_volume,
                 { 'pair': 'XXBTZEUR' })
+        return Decimal(trade_volume['fees']['XXBTZEUR']['fee'])
 
     def refresh_order_book(self):
+        """ Refresh the order book.
+
+        :return: Whether the book has changed since the last refresh
+        """
         path = 'public/Depth'
         result = self._http_get(path, {
                 'pair': 'XXBTZEUR',
-                'count': 1,
-            })
+                'count': self.book_depth,
+            }, cache=self._book_cache)
+        self.order_book_ts = time.time()
+        # An unchanged book comes back as the same object, keeping its
+        # fixed-point conversion
+        if result['XXBTZEUR'] is self._order_book:
+            return False
         self._order_book = result['XXBTZEUR']
+        self._fixed_book = None
+        if self.recorder is not None:
+            self.recorder.record(self)
+        return True
+
+    def load_order_book(self, bids, asks):
+        """ Replace the order book with levels maintained locally (e.g. by a
+        streaming feed).
+
+        :param bids: List of (price, volume) tuples in EUR, highest price first
+        :param asks: List of (price, volume) tuples in EUR, lowest price first
+        """
+        self._order_book = {
+                'bids': [(price, volume, None) for (price, volume) in bids],
+                'asks': [(price, volume, None) for (price, volume) in asks],
+            }
+        self._fixed_book = None
+        self.order_book_ts = time.time()
+        if self.recorder is not None:
+            self.recorder.record(self)
+
+    def fetch_book_levels(self):
+        """ Fetch the order book without installing it.
+
+        :return: (bids, asks) tuple of (price, volume) lists in EUR, best
+            price first
+        """
+        result = self._http_get('public/Depth', {
+                'pair': 'XXBTZEUR',
+                'count': self.book_depth,
+            }, cache=self._book_cache)['XXBTZEUR']
+        return ([level[:2] for level in result['bids']],
+                [level[:2] for level in result['asks']])
+
+    def feed_depth(self, depth):
+        """ Depth of the book channel subscribed for `depth` levels.
+        """
+        return min([d for d in self.FEED_DEPTHS if d >= depth] or [max(self.FEED_DEPTHS)])
+
+    def feed_subscriptions(self, depth):
+        """ Messages subscribing to the book channel of Kraken's stream.
+        """
+        return [{
+                'event': 'subscribe',
+                'pair': ['XBT/EUR'],
+                'subscription': {'name': 'book', 'depth': depth},
+            }]
+
+    def parse_feed_message(self, message):
+        """ Translate a message of Kraken's order book stream.
+
+        Book messages are lists with one or more dictionaries - 'bs'/'as' keys
+        carry a snapshot, 'b'/'a' keys carry changed levels (zero volume =
+        removed level). Levels are [price, volume, timestamp, ...] lists.
+        Other messages are dictionaries with an 'event' key.
+
+        :return: (snapshot, bids, asks) tuple or None for other messages
+        """
+        if isinstance(message, dict):
+            if message.get('event') == 'subscriptionStatus' and \
+                    message.get('status') == 'error':
+                raise FeedError(message.get('errorMessage', 'subscription failed'))
+            return None
+        if not isinstance(message, list):
+            return None
+        snapshot = False
+        bids = []
+        asks = []
+        for data in message:
+            if not isinstance(data, dict):
+                continue
+            if 'bs' in data or 'as' in data:
+                snapshot = True
+            bids.extend((level[0], level[1]) for level in data.get('bs', data.get('b', [])))
+            asks.extend((level[0], level[1]) for level in data.get('as', data.get('a', [])))
+        if not snapshot and not bids and not asks:
+            return None
+        return (snapshot, bids, asks)
+
+    def verify_feed_book(self, message, book):
+        """ Compare the local book with the checksum of a stream update.
+
+        :raise FeedGap: The checksum doesn't match
+        """
+        checksum = None
+        for data in message:
+            if isinstance(data, dict) and 'c' in data:
+                checksum = data['c']
+        if checksum is None:
+            return
+        (bids, asks) = book.levels(CHECKSUM_DEPTH)
+        if book_checksum(bids, asks) != int(checksum):
+            raise FeedGap("checksum mismatch")
 
     def refresh_orders(self):
         """ Refresh my orders.
         """
+        self.refresh_open_orders()
+        self.refresh_closed_orders()
+
+    def refresh_open_orders(self):
+        """ Refresh my open orders. They are keyed by order ID already.
+        """
         path_open = 'private/OpenOrders'
         result = self._http_post(path_open)
         self._open_orders = result['open']
 
+    def refresh_closed_orders(self):
+        """ Refresh my recently closed orders. They are keyed by order ID
+        already.
+        """
         path_closed = 'private/ClosedOrders'
         result = self._http_post(path_closed)
         self._closed_orders = result['closed']
@@ -87,16 +334,20 @@ class KrakenPlugin(object):
         :return: Order ID
         """
         path = 'private/AddOrder'
-        price_eur = price / self._eurusd_rate
+        # Rounded up to the tick, so the order still reaches the level it
+        # was priced for
+        price_eur = (price / self.eurusd_rate).quantize(self.PRICE_TICK, ROUND_CEILING)
         data = {
                 'pair': 'XXBTZEUR',
                 'type': 'buy',
                 'ordertype': 'limit',
-                'price': price_eur,
+                'price': str(price_eur),
                 'volume': "{0:.8f}".format(volume),
             }
         response = self._http_post(path, data)
-        order = KrakenOrder(otype='bid', oid=response['txid'][0])
+        order = KrakenOrder(otype='bid', oid=response['txid'][0],
+                volume=volume, price=price_eur)
+        self.account.order_submitted(order)
         return order
 
     def create_ask_order(self, volume, price):
@@ -107,50 +358,64 @@ class KrakenPlugin(object):
         :return: Order ID
         """
         path = 'private/AddOrder'
-        price_eur = price / self._eurusd_rate
+        # Rounded down to the tick, so the order still reaches the level it
+        # was priced for
+        price_eur = (price / self.eurusd_rate).quantize(self.PRICE_TICK, ROUND_FLOOR)
         data = {
                 'pair': 'XXBTZEUR',
                 'type': 'sell',
                 'ordertype': 'limit',
-                'price': price_eur,
+                'price': str(price_eur),
                 'volume': "{0:.8f}".format(volume),
             }
         response = self._http_post(path, data)
-        order = KrakenOrder(otype='ask', oid=response['txid'][0])
+        order = KrakenOrder(otype='ask', oid=response['txid'][0],
+                volume=volume, price=price_eur)
+        self.account.order_submitted(order)
         return order
 
-    def get_order_status(self, order):
-        """ Get order status. Possible values: 'open', 'closed'. Raise exception
-        if the order was not found.
-        """
-        # Refresh orders
-        self.refresh_orders()
-
-        # Check open orders
-        for oid in self._open_orders.keys():
-            if oid == order.oid:
-                status = self._open_orders[oid]['status']
-                if status in ('open', 'pending'):
-                    return ORDER_OPEN
-                elif status == 'cancelled':
-                    raise BitstampException('Order was cancelled')
-                elif status == 'expired':
-                    raise BitstampException('Order expired')
-                else:
-                    raise BitstampException('Unexpected order status: {0}'.format(status))
-
-        # Check closed orders
-        for oid in self._closed_orders.keys():
-            if oid == order.oid:
-                status = self._closed_orders[oid]['status']
-                if status == 'closed':
-                    return ORDER_CLOSED
-                else:
-                    raise BitstampException('Unexpected order status: {0}'.format(status))
-
-        # If the order is not open nor closed it does not exist - we raise an
-        # exception
-        raise BitstampException('Order not found')
+    def find_order_status(self, order):
+        """ Look the order up in the last fetched orders, without refreshing
+        them.
+
+        :return: 'open', 'closed', 'cancelled' (or expired) or None if the
+            order is not among them
+        """
+        if order.oid in self._open_orders:
+            status = self._open_orders[order.oid]['status']
+            if status in ('open', 'pending'):
+                return ORDER_OPEN
+            elif status in _CANCELLED_STATUSES:
+                return ORDER_CANCELLED
+            else:
+                raise KrakenException(['Unexpected order status: {0}'.format(status)])
+
+        if order.oid in self._closed_orders:
+            status = self._closed_orders[order.oid]['status']
+            if status == 'closed':
+                return ORDER_CLOSED
+            elif status in _CANCELLED_STATUSES:
+                return ORDER_CANCELLED
+            else:
+                raise KrakenException(['Unexpected order status: {0}'.format(status)])
+
+        return None
+
+    def get_order_status(self, order, refresh=True):
+        """ Get order status. Possible values: 'open', 'closed', 'cancelled'.
+        Raise exception if the order was not found.
+
+        :param refresh: Refresh the orders first
+        """
+        if refresh:
+            self.refresh_orders()
+
+        status = self.find_order_status(order)
+        if status is None:
+            # If the order is not open nor closed it does not exist - we raise
+            # an exception
+            raise KrakenException(['Order not found'])
+        return status
 
     def cancel_order(self, order):
         """ Cancel open order.
@@ -160,10 +425,31 @@ class KrakenPlugin(object):
                 'txid': order.oid,
             }
         self._http_post(path, data)
+        self.account.order_cancelled(order)
 
     @property
     def trade_fee(self):
-        return Decimal(self._trade_volume['fees']['XXBTZEUR']['fee'])
+        return self.account.trade_fee
+
+    @property
+    def eurusd_rate(self):
+        """ Current EUR/USD rate, from the cache - never blocks.
+        """
+        return self._eurusd.rate
+
+    @property
+    def eurusd_rate_age(self):
+        """ Age of the EUR/USD rate (in seconds).
+        """
+        return self._eurusd.age
+
+    @property
+    def connection_stats(self):
+        return self._session.stats
+
+    @property
+    def latency_stats(self):
+        return self._session.latencies
 
     @property
     def open_orders(self):
@@ -171,33 +457,26 @@ class KrakenPlugin(object):
 
     @property
     def balance_xbt(self):
-        if self._account_info.has_key('XXBT'):
-            return Decimal(self._account_info['XXBT'])
-        else:
-            return Decimal('0.0')
+        return self.account.balance_xbt
 
     @property
     def balance_usd(self):
-        if self._account_info.has_key('ZEUR'):
-            balance_eur = Decimal(self._account_info['ZEUR'])
-            return balance_eur * self._eurusd_rate
-        else:
-            return Decimal('0.0')
+        return self.account.balance_fiat * self.eurusd_rate
 
     @property
     def avail_xbt(self):
-        return self.balance_xbt
+        return self.account.avail_xbt
 
     @property
     def avail_usd(self):
-        return self.balance_usd
+        return self.account.avail_fiat * self.eurusd_rate
 
     @property
     def highest_bid(self):
         """ Return the highest bid from the order book.
         """
         (price_eur, volume, _) = self._order_book['bids'][0]
-        price_usd = Decimal(price_eur) * self._eurusd_rate
+        price_usd = Decimal(price_eur) * self.eurusd_rate
         return {
                 'price': Decimal(price_usd),
                 'volume': Decimal(volume),
@@ -208,12 +487,64 @@ class KrakenPlugin(object):
         """ Return the lowest ask from the order book.
         """
         (price_eur, volume, _) = self._order_book['asks'][0]
-        price_usd = Decimal(price_eur) * self._eurusd_rate
+        price_usd = Decimal(price_eur) * self.eurusd_rate
         return {
                 'price': Decimal(price_usd),
                 'volume': Decimal(volume),
             }
 
+    def iter_bids(self):
+        """ Iterate over the bids in the order book as (price, volume) tuples,
+        highest price first. Prices are in USD.
+        """
+        rate = self.eurusd_rate
+        for (price_eur, volume, _) in self._order_book['bids']:
+            yield (Decimal(price_eur) * rate, Decimal(volume))
+
+    def iter_asks(self):
+        """ Iterate over the asks in the order book as (price, volume) tuples,
+        lowest price first. Prices are in USD.
+        """
+        rate = self.eurusd_rate
+        for (price_eur, volume, _) in self._order_book['asks']:
+            yield (Decimal(price_eur) * rate, Decimal(volume))
+
+    def fixed_book(self):
+        """ The order book as (bids, asks) of fixed-point (price, volume)
+        tuples with prices in USD, see fixedpoint.py. Converted once per
+        order book and EUR/USD rate.
+
+        The conversion to USD rounds bids down and asks up, so a pair is
+        never considered more profitable than it is.
+        """
+        rate = self.eurusd_rate
+        if self._fixed_book is None or self._fixed_book_rate != rate:
+            rate_fixed = to_fixed(rate, PRICE_SCALE)
+            def bid(level):
+                return (to_fixed(level[0], PRICE_SCALE) * rate_fixed // PRICE_SCALE,
+                        to_fixed(level[1], VOLUME_SCALE))
+            def ask(level):
+                return (-(-to_fixed(level[0], PRICE_SCALE) * rate_fixed // PRICE_SCALE),
+                        to_fixed(level[1], VOLUME_SCALE))
+            self._fixed_book = (FixedLevels(self._order_book['bids'], bid),
+                    FixedLevels(self._order_book['asks'], ask))
+            self._fixed_book_rate = rate
+        return self._fixed_book
+
+    def graph_markets(self):
+        """ The XBT/EUR market and the EUR/USD conversion its prices are
+        compared with, for the currency graph (see graph.py). Converting
+        costs the rate provider's fee.
+        """
+        bids = self._order_book['bids']
+        asks = self._order_book['asks']
+        rate = self.eurusd_rate
+        return [
+                (self.name, 'XBT', 'EUR', bids[0][0] if bids else None,
+                    asks[0][0] if asks else None, self.trade_fee),
+                ('forex EUR/USD', 'EUR', 'USD', rate, rate, self._eurusd.fee),
+            ]
+
     def _sign(self, path, nonce, data):
         """ Create a signature for private requests.
         """
@@ -224,28 +555,63 @@ class KrakenPlugin(object):
                 hashlib.sha512)
         return base64.b64encode(signature.digest())
 
-    def _http_get(self, path, params=None):
+    def _http_get(self, path, params=None, cache=None):
         url = '{0}/{1}/{2}'.format(self._url, self._version, path)
-        response = requests.get(url, params=params)
-        result = response.json()
-        if response.status_code != 200 or result['error']:
+        self.scheduler.acquire(self.REQUEST_PRIORITIES.get(path, PRIORITY_STATUS),
+                self.REQUEST_COSTS.get(path, 1))
+        (response, result) = self._session.request_json('GET', url,
+                endpoint=path, params=params, cache=cache)
+        if response.status_code not in (200, HTTP_NOT_MODIFIED) or result['error']:
             raise KrakenException(result['error'])
-        return response.json()['result']
+        return result['result']
 
     def _http_post(self, path, data={}):
         url = '{0}/{1}/{2}'.format(self._url, self._version, path)
+        priority = self.REQUEST_PRIORITIES.get(path, PRIORITY_STATUS)
+        self.scheduler.acquire(priority, self.REQUEST_COSTS.get(path, 1))
 
-        nonce = int(time.time() * 1e3)
+        if self.nonce_window:
+            # The key accepts nonces out of order, requests run in parallel
+            (response, result) = self._signed_post(path, url, data,
+                    self._nonces.next())
+        else:
+            # Requests must be handled by Kraken in the order of their
+            # nonces, the next one is only sent after the response
+            with self._nonces.ordered(priority) as ticket:
+                (response, result) = self._signed_post(path, url, data,
+                        ticket.nonce)
+        if response.status_code != 200 or result['error']:
+            raise KrakenException(result['error'])
+        return result['result']
+
+    def _signed_post(self, path, url, data, nonce):
         payload = dict(data)
         payload['nonce'] = nonce
-
         headers = {
                 'API-Key': self._key,
                 'API-Sign': self._sign(path, nonce, payload),
             }
+        return self._session.request_json('POST', url, endpoint=path,
+                data=payload, headers=headers)
 
-        response = requests.post(url, data=payload, headers=headers)
-        result = response.json()
-        if response.status_code != 200 or result['error']:
-            raise KrakenException(result['error'])
-        return result['result']
+
+def create_plugin(cfg, book_timeout):
+    """ Create the plugin from the 'kraken.com' section of the config. The
+    EUR/USD rate is configured in the 'forex' section.
+
+    :param cfg: Whole config
+    :param book_timeout: Default max. time to wait for an order book refresh
+    """
+    plugin_cfg = cfg['plugins']['kraken.com']
+    return KrakenPlugin(key=plugin_cfg['key'],
+            secret=plugin_cfg['secret'],
+            eurusd_rate=create_rate_provider(cfg.get('forex', {})).start(),
+            book_depth=int(plugin_cfg.get('book_depth', 25)),
+            book_timeout=float(plugin_cfg.get('book_timeout', book_timeout)),
+            http_options=plugin_cfg.get('http'),
+            feed_address=plugin_cfg.get('feed'),
+            url=plugin_cfg.get('url'),
+            rate_limit=plugin_cfg.get('rate_limit'),
+            nonces=nonce_allocator('kraken', plugin_cfg['key'],
+                KrakenPlugin.NONCE_UNIT),
+            nonce_window=bool(plugin_cfg.get('nonce_window', False)))
@@ -0,0 +1,160 @@
+""" In-process latency histograms of the plugins' HTTP requests.
+
+Durations are counted into fixed logarithmic buckets, so recording a sample
+is a constant-time increment and the memory use doesn't grow with the
+number of requests. Percentiles are accurate to the bucket width (about 5%).
+"""
+import math
+import threading
+
+
+# Phases of a request, in the order they happen
+PHASES = ('connect', 'tls', 'wait', 'transfer', 'parse', 'total')
+
+# Smallest and largest duration told apart (in seconds)
+MIN_LATENCY = 1e-5
+MAX_LATENCY = 100.0
+
+# Ratio of the upper and the lower bound of a bucket
+BUCKET_RATIO = 1.1
+
+_LOG_RATIO = math.log(BUCKET_RATIO)
+_NUM_BUCKETS = int(math.ceil(math.log(MAX_LATENCY / MIN_LATENCY) / _LOG_RATIO)) + 2
+
+
+class LatencyHistogram(object):
+    """ Histogram of durations (in seconds).
+    """
+    def __init__(self):
+        self.buckets = [0] * _NUM_BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        if value < MIN_LATENCY:
+            bucket = 0
+        else:
+            bucket = min(_NUM_BUCKETS - 1,
+                    1 + int(math.log(value / MIN_LATENCY) / _LOG_RATIO))
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def percentile(self, p):
+        """ Upper bound of the bucket holding the p-th percentile.
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * p / 100.0)))
+        seen = 0
+        for (bucket, n) in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(self.max, MIN_LATENCY * BUCKET_RATIO ** bucket)
+        return self.max
+
+
+class EndpointStats(object):
+    """ Latency histograms of the requests to one endpoint.
+    """
+    def __init__(self):
+        self.phases = dict((phase, LatencyHistogram()) for phase in PHASES)
+        self.statuses = {}
+        self.bytes = 0
+
+    @property
+    def requests(self):
+        return self.phases['total'].count
+
+
+class LatencyStats(object):
+    """ Request latencies of one exchange, by endpoint.
+    """
+    def __init__(self):
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, status, size, timings):
+        """ Record a finished request.
+
+        :param endpoint: Endpoint (API path) of the request
+        :param status: HTTP status code
+        :param size: Size of the response body (in bytes)
+        :param timings: Dictionary of durations (in seconds) by phase, phases
+            which didn't happen (e.g. connecting on a reused connection) are
+            left out
+        """
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats()
+            for (phase, elapsed) in timings.items():
+                stats.phases[phase].add(elapsed)
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.bytes += size
+
+    def total(self):
+        """ Histogram of the total request time over all endpoints.
+        """
+        with self._lock:
+            result = LatencyHistogram()
+            for stats in self.endpoints.values():
+                histogram = stats.phases['total']
+                result.buckets = [a + b for (a, b) in zip(result.buckets, histogram.buckets)]
+                result.count += histogram.count
+                result.sum += histogram.sum
+                result.max = max(result.max, histogram.max)
+            return result
+
+
+def _ms(value):
+    return "{0:7.1f}".format(value * 1000) if value is not None else "      -"
+
+
+def print_latency_stats(plugins, out=None):
+    """ Print the p50/p99 of each phase, per exchange and endpoint.
+
+    :param out: File to print to (default is sys.stdout)
+    """
+    print >>out, "{0:20}  {1:24}  {2:>6}  {3}".format('', 'endpoint', 'count',
+            '  '.join("{0:>15}".format(phase + ' p50/p99') for phase in PHASES))
+    for plugin in plugins:
+        latencies = plugin.latency_stats
+        for endpoint in sorted(latencies.endpoints):
+            stats = latencies.endpoints[endpoint]
+            print >>out, "{market:20}  {endpoint:24}  {count:6}  {phases}".format(
+                    market=plugin.name,
+                    endpoint=endpoint,
+                    count=stats.requests,
+                    phases='  '.join("{0}/{1}".format(
+                            _ms(stats.phases[phase].percentile(50)),
+                            _ms(stats.phases[phase].percentile(99)))
+                        for phase in PHASES))
+
+
+def format_latency_summary(plugin):
+    """ One-line summary of the request latencies (in ms) of a plugin.
+    """
+    latencies = plugin.latency_stats
+    total = latencies.total()
+    endpoints = ' '.join("{endpoint} {p50:.0f}/{p99:.0f}".format(
+                endpoint=endpoint,
+                p50=stats.phases['total'].percentile(50) * 1000,
+                p99=stats.phases['total'].percentile(99) * 1000)
+            for (endpoint, stats) in sorted(latencies.endpoints.items())
+            if stats.requests)
+    if not total.count:
+        return "{market:20}  no requests".format(market=plugin.name)
+    return "{market:20}  {count} requests, p50 {p50:.0f} ms, p99 {p99:.0f} ms  [{endpoints}]".format(
+            market=plugin.name,
+            count=total.count,
+            p50=total.percentile(50) * 1000,
+            p99=total.percentile(99) * 1000,
+            endpoints=endpoints)
@@ -0,0 +1,332 @@
+""" Local mock of the Bitstamp and Kraken HTTP APIs.
+
+The server speaks the endpoints used by the plugins, under the '/bitstamp'
+and '/kraken' prefixes. Private requests are checked for a valid signature
+and an increasing nonce using the MOCK_CREDENTIALS. Latency, jitter and
+errors can be injected, and requests are counted per endpoint.
+
+Orders are kept in memory. They stay open for `fill_delay` seconds and are
+closed (filled) afterwards.
+"""
+import base64
+import hashlib
+import hmac
+import itertools
+import random
+import threading
+import time
+import urlparse
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from feedserver import SyntheticBook
+
+
+# Credentials accepted by the mock server
+MOCK_CREDENTIALS = {
+        'bitstamp': {
+            'client_id': 'mock',
+            'key': 'mock-key',
+            'secret': 'mock-secret',
+        },
+        'kraken': {
+            'key': 'mock-key',
+            'secret': base64.b64encode('mock-secret'),
+        },
+    }
+
+
+class MockError(Exception):
+    pass
+
+
+class MockExchange(object):
+    """ State of one mocked exchange - order book, balances and orders.
+    """
+    def __init__(self, mid, depth, fee, seed=None):
+        self.book = SyntheticBook(mid=mid, depth=depth, seed=seed)
+        self.fee = fee
+        self.balance_xbt = 10.0
+        self.balance_fiat = 10000.0
+        self.orders = {}
+        self.last_nonce = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def check_nonce(self, key, nonce):
+        with self._lock:
+            if nonce <= self.last_nonce.get(key, 0):
+                raise MockError('Invalid nonce')
+            self.last_nonce[key] = nonce
+
+    def snapshot(self, depth):
+        with self._lock:
+            self.book.step()
+            (bids, asks) = self.book.snapshot()
+        return (bids[:depth], asks[:depth])
+
+    def add_order(self, otype, volume, price):
+        with self._lock:
+            oid = next(self._ids)
+            self.orders[oid] = {
+                    'type': otype,
+                    'volume': volume,
+                    'price': price,
+                    'created': time.time(),
+                    'cancelled': False,
+                }
+        return oid
+
+    def cancel_order(self, oid):
+        with self._lock:
+            if oid not in self.orders:
+                raise MockError('Order not found')
+            self.orders[oid]['cancelled'] = True
+
+    def order_status(self, oid, fill_delay):
+        order = self.orders[oid]
+        if order['cancelled']:
+            return 'cancelled'
+        if time.time() - order['created'] >= fill_delay:
+            return 'closed'
+        return 'open'
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so that the plugins' connection pools are exercised
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        server = self.server
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        body = ''
+        if method == 'POST':
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server.count(url.path)
+
+        server.request_started()
+        try:
+            delay = server.latency + random.uniform(0, server.jitter)
+            if delay:
+                time.sleep(delay)
+
+            parts = url.path.lstrip('/').split('/', 1)
+            exchange = parts[0]
+            endpoint = parts[1] if len(parts) > 1 else ''
+            if exchange == 'bitstamp':
+                (status, result) = self._bitstamp(method, endpoint, body)
+            elif exchange == 'kraken':
+                (status, result) = self._kraken(method, endpoint, query, body)
+            else:
+                (status, result) = (404, {'error': 'Not found'})
+        finally:
+            server.request_finished()
+        self._respond(status, result, conditional=(method == 'GET'))
+
+    def _respond(self, status, result, conditional=False):
+        data = json.dumps(result)
+        etag = None
+        if conditional and status == 200:
+            # Public data can be fetched conditionally
+            etag = '"{0}"'.format(hashlib.md5(data).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                (status, data) = (304, '')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _inject_error(self):
+        return random.random() < self.server.error_rate
+
+    def _bitstamp(self, method, endpoint, body):
+        server = self.server
+        exchange = server.bitstamp
+        if self._inject_error():
+            return (500, {'error': {'__all__': ['Mock error']}})
+
+        if method == 'GET':
+            if endpoint == 'order_book/':
+                (bids, asks) = exchange.snapshot(server.book_depth)
+                return (200, {
+                        'timestamp': str(int(time.time())),
+                        'bids': [["{0:.2f}".format(p), "{0:.8f}".format(v)] for (p, v) in bids],
+                        'asks': [["{0:.2f}".format(p), "{0:.8f}".format(v)] for (p, v) in asks],
+                    })
+            return (404, {'error': {'__all__': ['Not found']}})
+
+        data = dict(urlparse.parse_qsl(body))
+        creds = MOCK_CREDENTIALS['bitstamp']
+        msg = '{0}{1}{2}'.format(data.get('nonce'), creds['client_id'], creds['key'])
+        signature = hmac.new(creds['secret'], msg, hashlib.sha256).hexdigest().upper()
+        if data.get('key') != creds['key'] or data.get('signature') != signature:
+            return (200, {'error': 'Invalid signature'})
+        try:
+            exchange.check_nonce(data['key'], int(data['nonce']))
+            return (200, self._bitstamp_private(exchange, endpoint, data))
+        except MockError as e:
+            return (200, {'error': str(e)})
+
+    def _bitstamp_private(self, exchange, endpoint, data):
+        fill_delay = self.server.fill_delay
+        if endpoint == 'balance/':
+            return {
+                    'btc_balance': "{0:.8f}".format(exchange.balance_xbt),
+                    'usd_balance': "{0:.2f}".format(exchange.balance_fiat),
+                    'btc_available': "{0:.8f}".format(exchange.balance_xbt),
+                    'usd_available': "{0:.2f}".format(exchange.balance_fiat),
+                    'fee': "{0:.4f}".format(exchange.fee),
+                }
+        elif endpoint in ('buy/', 'sell/'):
+            oid = exchange.add_order(endpoint.rstrip('/'), float(data['amount']), float(data['price']))
+            return {'id': oid, 'price': data['price'], 'amount': data['amount']}
+        elif endpoint == 'open_orders/':
+            return [{'id': oid, 'type': 0 if order['type'] == 'buy' else 1,
+                        'price': order['price'], 'amount': order['volume']}
+                    for (oid, order) in exchange.orders.items()
+                    if exchange.order_status(oid, fill_delay) == 'open']
+        elif endpoint == 'user_transactions/':
+            return [{'order_id': oid, 'type': 2}
+                    for oid in exchange.orders
+                    if exchange.order_status(oid, fill_delay) == 'closed']
+        elif endpoint == 'cancel_order/':
+            exchange.cancel_order(int(data['id']))
+            return True
+        raise MockError('Not found')
+
+    def _kraken(self, method, endpoint, query, body):
+        server = self.server
+        exchange = server.kraken
+        if self._inject_error():
+            return (500, {'error': ['EService:Mock error']})
+
+        if endpoint == '0/public/Depth':
+            depth = int(query.get('count', server.book_depth))
+            (bids, asks) = exchange.snapshot(depth)
+            ts = int(time.time())
+            return (200, {'error': [], 'result': {'XXBTZEUR': {
+                    'bids': [["{0:.2f}".format(p), "{0:.8f}".format(v), ts] for (p, v) in bids],
+                    'asks': [["{0:.2f}".format(p), "{0:.8f}".format(v), ts] for (p, v) in asks],
+                }}})
+        if method != 'POST' or not endpoint.startswith('0/private/'):
+            return (404, {'error': ['EGeneral:Unknown method']})
+
+        data = dict(urlparse.parse_qsl(body))
+        creds = MOCK_CREDENTIALS['kraken']
+        msg = '/' + endpoint + hashlib.sha256(data.get('nonce', '') + body).digest()
+        signature = base64.b64encode(hmac.new(base64.b64decode(creds['secret']),
+                msg, hashlib.sha512).digest())
+        if self.headers.get('API-Key') != creds['key'] or \
+                self.headers.get('API-Sign') != signature:
+            return (200, {'error': ['EAPI:Invalid signature']})
+        try:
+            exchange.check_nonce(creds['key'], int(data['nonce']))
+            result = self._kraken_private(exchange, endpoint[len('0/private/'):], data)
+            return (200, {'error': [], 'result': result})
+        except MockError as e:
+            return (200, {'error': ['EGeneral:{0}'.format(e)]})
+
+    def _kraken_private(self, exchange, endpoint, data):
+        fill_delay = self.server.fill_delay
+        if endpoint == 'Balance':
+            return {
+                    'XXBT': "{0:.10f}".format(exchange.balance_xbt),
+                    'ZEUR': "{0:.4f}".format(exchange.balance_fiat),
+                }
+        elif endpoint == 'TradeVolume':
+            return {'fees': {'XXBTZEUR': {'fee': "{0:.4f}".format(exchange.fee)}}}
+        elif endpoint == 'AddOrder':
+            oid = exchange.add_order(data['type'], float(data['volume']), float(data['price']))
+            return {'txid': ['O{0:06d}'.format(oid)]}
+        elif endpoint in ('OpenOrders', 'ClosedOrders'):
+            wanted = ('open',) if endpoint == 'OpenOrders' else ('closed', 'cancelled')
+            orders = {}
+            for (oid, order) in exchange.orders.items():
+                status = exchange.order_status(oid, fill_delay)
+                if status in wanted:
+                    orders['O{0:06d}'.format(oid)] = {
+                            'status': 'canceled' if status == 'cancelled' else status,
+                            'vol': "{0:.8f}".format(order['volume']),
+                        }
+            return {'open': orders} if endpoint == 'OpenOrders' else {'closed': orders}
+        elif endpoint == 'CancelOrder':
+            exchange.cancel_order(int(data['txid'].lstrip('O')))
+            return {'count': 1}
+        raise MockError('Unknown method')
+
+
+class MockExchangeServer(ThreadingMixIn, HTTPServer):
+    """ Mock HTTP server of Bitstamp and Kraken.
+
+    :param address: (host, port) to listen on, port 0 picks a free port
+    :param latency: Delay added to every request (in seconds)
+    :param jitter: Max. random delay added on top of latency (in seconds)
+    :param error_rate: Probability of a request failing with an error
+    :param fill_delay: Time until an order gets filled (in seconds)
+    :param book_depth: Number of levels of Bitstamp's full order book
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, error_rate=0.0,
+            fill_delay=0.0, book_depth=1000, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.fill_delay = fill_delay
+        self.book_depth = book_depth
+        self.bitstamp = MockExchange(mid=600.0, depth=book_depth, fee=0.25, seed=seed)
+        self.kraken = MockExchange(mid=460.0, depth=500, fee=0.26, seed=seed)
+        self.requests = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        HTTPServer.__init__(self, address, MockHandler)
+
+    def count(self, path):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def total_requests(self):
+        with self._lock:
+            return sum(self.requests.values())
+
+    def request_started(self):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def request_finished(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def reset_max_in_flight(self):
+        """ Return the max. number of requests handled at the same time since
+        the last reset.
+        """
+        with self._lock:
+            (result, self.max_in_flight) = (self.max_in_flight, self.in_flight)
+            return result
+
+    def url(self, exchange):
+        """ Base URL to configure the plugin of the exchange with.
+        """
+        (host, port) = self.server_address[:2]
+        return 'http://{0}:{1}/{2}'.format(host, port, exchange)
@@ -0,0 +1,171 @@
+""" Nonces of the private API requests.
+
+Exchanges reject a private request whose nonce isn't greater than the last
+one they have seen for the API key. Nonces taken from the clock collide
+when two requests are made within the same clock tick and go backwards when
+the clock is adjusted, and even unique nonces fail when the requests reach
+the exchange in a different order than they were allocated in.
+
+NonceAllocator hands out strictly increasing nonces and keeps a high-water
+mark in a file, so they keep increasing after a restart. Its ordering lock
+is held from allocating a nonce until the response to the request carrying
+it has arrived - requests written to the socket in order can still be
+handled by the exchange out of order, so concurrent private requests of an
+API key are made one after another.
+
+That costs parallelism: a request waits for the one in flight, however
+slow. The waiting requests get the lock by priority, so an order placement
+waits for at most one request instead of all queued status polls and
+balance updates. Keys which accept nonces out of order (Kraken's nonce
+window) don't need the lock at all, see next().
+"""
+import hashlib
+import heapq
+import itertools
+import os
+import threading
+import time
+
+
+DEFAULT_NONCE_DIR = '~/.xbtarbiter/nonces'
+
+# How far ahead of the last nonce the high-water mark is stored (in
+# seconds), so the file isn't written on every request
+RESERVE_SECONDS = 10
+
+
+class _PriorityLock(object):
+    """ Lock whose waiters get it by priority (lowest first), in the order
+    they came within a priority.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._locked = False
+        self._waiting = []
+        self._seq = itertools.count()
+
+    def acquire(self, priority=0):
+        with self._cond:
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiting, entry)
+            try:
+                while self._locked or self._waiting[0] != entry:
+                    self._cond.wait()
+                self._locked = True
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self._locked = False
+            self._cond.notify_all()
+
+
+class NonceTicket(object):
+    """ A nonce holding the allocator's ordering lock until the ticket is
+    released.
+    """
+    def __init__(self, nonce, lock):
+        self.nonce = nonce
+        self._lock = lock
+        self._released = False
+
+    def release(self):
+        """ Let the next request through. Can be called more than once.
+        """
+        if not self._released:
+            self._released = True
+            self._lock.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+
+
+class NonceAllocator(object):
+    """ Strictly increasing nonces of one API key.
+
+    :param unit: Nonce units per second (nonces follow the clock when it's
+        ahead of the last nonce)
+    :param path: File keeping the high-water mark, None = not persisted
+    """
+    def __init__(self, unit, path=None):
+        self.unit = unit
+        self.path = os.path.expanduser(path) if path else None
+        self._last = 0
+        self._reserved = 0
+        self._lock = threading.Lock()
+        self._order_lock = _PriorityLock()
+        if self.path and os.path.exists(self.path):
+            with open(self.path) as f:
+                self._last = self._reserved = int(f.read().strip() or 0)
+
+    def _store(self, value):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(value))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+
+    def next(self):
+        """ Allocate a nonce greater than all nonces allocated before, without
+        the ordering lock - for keys which accept nonces out of order.
+        """
+        with self._lock:
+            nonce = max(self._last + 1, int(time.time() * self.unit))
+            if self.path and nonce > self._reserved:
+                reserved = nonce + int(RESERVE_SECONDS * self.unit)
+                self._store(reserved)
+                self._reserved = reserved
+            self._last = nonce
+            return nonce
+
+    def ordered(self, priority=0):
+        """ Allocate a nonce and hold the ordering lock until the ticket is
+        released - make the whole request, response included, within:
+
+            with allocator.ordered(priority) as ticket:
+                session.request_json(..., data={'nonce': ticket.nonce})
+
+        :param priority: Requests waiting for the lock get it by priority,
+            lowest first (e.g. the ratelimit.PRIORITY_* constants)
+        :return: NonceTicket
+        """
+        self._order_lock.acquire(priority)
+        try:
+            return NonceTicket(self.next(), self._order_lock)
+        except:
+            self._order_lock.release()
+            raise
+
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+
+
+def nonce_allocator(exchange, key, unit, directory=DEFAULT_NONCE_DIR):
+    """ The process-wide NonceAllocator of an API key, persisted in
+    `directory` under a hash of the key.
+
+    :param exchange: Exchange name, to tell the files apart
+    :param key: API key
+    :param unit: Nonce units per second
+    :param directory: Directory of the nonce files, None = not persisted
+    """
+    with _allocators_lock:
+        allocator = _allocators.get((exchange, key))
+        if allocator is None:
+            path = None
+            if directory:
+                path = os.path.join(directory, '{0}-{1}'.format(exchange,
+                        hashlib.sha1(key).hexdigest()[:16]))
+            allocator = _allocators[(exchange, key)] = NonceAllocator(unit, path)
+        return allocator
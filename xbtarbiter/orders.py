@@ -0,0 +1,101 @@
+""" Batched order status tracking.
+"""
+from errors import ExchangeError
+
+
+ORDER_OPEN = 'open'
+ORDER_CLOSED = 'closed'
+# Cancelled or expired, as reported by the exchange
+ORDER_CANCELLED = 'cancelled'
+# Not found on the exchange (or its status failed) too many polls in a row
+ORDER_MISSING = 'missing'
+
+# Polls an order may be missing from the exchange's lists before it's
+# given up on - the lists of recent orders may not show a new order yet
+DEFAULT_MAX_MISSES = 5
+
+
+class OrderTracker(object):
+    """ Tracks the status of our orders on one exchange.
+
+    All tracked orders are resolved from a single snapshot per poll(). Open
+    orders are fetched on every poll, closed orders only when a tracked order
+    has disappeared from the open ones - while orders are waiting to be
+    filled, a poll costs one private API request instead of two per order.
+
+    :param plugin: Plugin the orders were created on
+    :param max_misses: Polls an order may be missing (or its status fail)
+        before it's reported as ORDER_MISSING
+    """
+    def __init__(self, plugin, max_misses=DEFAULT_MAX_MISSES):
+        self.plugin = plugin
+        self.max_misses = max_misses
+        # Errors of the orders whose status failed in the last poll(), by
+        # order ID
+        self.errors = {}
+        self._orders = {}
+        self._misses = {}
+
+    @property
+    def orders(self):
+        """ Orders which are still being tracked.
+        """
+        return self._orders.values()
+
+    def track(self, order):
+        self._orders[order.oid] = order
+
+    def untrack(self, order):
+        self._orders.pop(order.oid, None)
+        self._misses.pop(order.oid, None)
+
+    def poll(self):
+        """ Refresh the orders once and get the status of all tracked orders.
+        Orders found closed or cancelled are no longer tracked and their
+        funds are moved (or released) in the plugin's account state.
+
+        An order the exchange doesn't list (the plugin raises for it) is
+        reported as open and looked for again by the next polls, the
+        plugin's exception is kept in `errors`. After `max_misses` polls it
+        is reported as ORDER_MISSING and no longer tracked - its funds stay
+        reserved until the account is reconciled with the exchange. Failing
+        to fetch the orders raises the plugin's exception.
+
+        :return: List of (order, status) tuples
+        """
+        self.errors = {}
+        if not self._orders:
+            return []
+
+        self.plugin.refresh_open_orders()
+        statuses = [(order, self._status(order, self.plugin.find_order_status))
+                for order in self._orders.values()]
+
+        # Orders which are not open anymore must be among the closed ones
+        if [order for (order, status) in statuses if status is None]:
+            self.plugin.refresh_closed_orders()
+            get_status = lambda order: self.plugin.get_order_status(order, refresh=False)
+            statuses = [(order, status or self._status(order, get_status))
+                    for (order, status) in statuses]
+
+        for (order, status) in statuses:
+            if status == ORDER_CLOSED:
+                self.plugin.account.order_filled(order)
+                self.untrack(order)
+            elif status == ORDER_CANCELLED:
+                self.plugin.account.order_cancelled(order)
+                self.untrack(order)
+            elif status == ORDER_MISSING:
+                self.untrack(order)
+        return statuses
+
+    def _status(self, order, get_status):
+        try:
+            status = get_status(order)
+        except ExchangeError as e:
+            self.errors[order.oid] = e
+            misses = self._misses[order.oid] = self._misses.get(order.oid, 0) + 1
+            return ORDER_MISSING if misses >= self.max_misses else ORDER_OPEN
+        if status is not None:
+            self._misses.pop(order.oid, None)
+        return status
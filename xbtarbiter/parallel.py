@@ -0,0 +1,189 @@
+""" Helpers for running blocking plugin calls concurrently.
+
+Calls run on a shared pool of worker threads and are represented by
+CallResult objects, which can be waited for or given callbacks - the
+plugins stay blocking, but one thread can keep many requests to several
+exchanges in flight.
+"""
+import threading
+import time
+import traceback
+from Queue import Queue
+
+
+# Number of worker threads of the default pool - max. number of plugin
+# calls in flight at a time
+DEFAULT_POOL_SIZE = 32
+
+
+class CallResult(object):
+    """ Outcome of one call started on a WorkerPool.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.value = None
+        self.error = None
+        self.started = None
+        self.finished = None
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.finished is not None
+
+    @property
+    def elapsed(self):
+        """ Time the call took (or has taken so far) in seconds.
+        """
+        if self.started is None:
+            return None
+        end = self.finished if self.finished is not None else time.time()
+        return end - self.started
+
+    def wait(self, timeout=None):
+        """ Wait until the call has finished.
+
+        :param timeout: Max. time to wait (in seconds), None = forever
+        :return: Whether the call has finished
+        """
+        self._event.wait(timeout)
+        return self.done
+
+    def result(self, timeout=None):
+        """ Wait for the call and return its value or raise its error.
+
+        :raise RuntimeError: The call didn't finish within the timeout
+        """
+        if not self.wait(timeout):
+            raise RuntimeError("Call {0!r} didn't finish in {1}s".format(self.key, timeout))
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def add_done_callback(self, func):
+        """ Call `func(result)` when the call has finished - right away if it
+        has finished already. Callbacks run in the worker thread.
+        """
+        with self._lock:
+            if not self.done:
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _finish(self):
+        with self._lock:
+            self.finished = time.time()
+            callbacks = self._callbacks
+            self._callbacks = []
+        self._event.set()
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception:
+                # Don't let a broken callback kill the worker
+                traceback.print_exc()
+
+
+def _run(result, func, args, kwargs):
+    result.started = time.time()
+    try:
+        result.value = func(*args, **kwargs)
+    except Exception as e:
+        result.error = e
+    result._finish()
+
+
+class WorkerPool(object):
+    """ Fixed number of daemonic worker threads running submitted calls.
+    Workers are started on demand, up to `size`.
+
+    :param size: Max. number of calls running at a time
+    """
+    def __init__(self, size=DEFAULT_POOL_SIZE):
+        self.size = size
+        self._queue = Queue()
+        self._workers = []
+        self._idle = 0
+        self._lock = threading.Lock()
+
+    def _work(self):
+        while True:
+            (result, func, args, kwargs) = self._queue.get()
+            _run(result, func, args, kwargs)
+            with self._lock:
+                self._idle += 1
+
+    def submit(self, key, func, *args, **kwargs):
+        """ Run `func(*args, **kwargs)` on a worker.
+
+        :param key: Key of the CallResult
+        :return: CallResult
+        """
+        result = CallResult(key)
+        with self._lock:
+            # Each call takes an idle worker or starts a new one, the calls
+            # beyond `size` wait in the queue
+            if self._idle:
+                self._idle -= 1
+            elif len(self._workers) < self.size:
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                self._workers.append(worker)
+                worker.start()
+        self._queue.put((result, func, args, kwargs))
+        return result
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool():
+    """ The process-wide WorkerPool.
+    """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = WorkerPool()
+        return _default_pool
+
+
+def wait_all(results, timeouts=None):
+    """ Wait until all calls have finished or reached their timeout, counted
+    from now.
+
+    :param results: List of CallResult objects
+    :param timeouts: List of timeouts in seconds (None = wait forever), one
+        per result; None = wait for all of them forever
+    """
+    start = time.time()
+    if timeouts is None:
+        timeouts = [None] * len(results)
+    for (result, timeout) in zip(results, timeouts):
+        if timeout is None:
+            result.wait()
+        else:
+            result.wait(max(0.0, start + timeout - time.time()))
+
+
+def run_parallel(calls, pool=None):
+    """ Run the calls concurrently and wait until all of them have finished
+    or reached their timeout.
+
+    Calls which time out are left running in the background and are
+    reported as not done.
+
+    :param calls: List of (key, callable, timeout) tuples. Timeout is in
+        seconds, None means wait forever.
+    :param pool: WorkerPool to run the calls on (default_pool() by default)
+    :return: Dictionary mapping keys to CallResult objects
+    """
+    pool = pool or default_pool()
+    results = {}
+    for (key, func, timeout) in calls:
+        results[key] = pool.submit(key, func)
+    wait_all([results[key] for (key, func, timeout) in calls],
+            [timeout for (key, func, timeout) in calls])
+    return results
@@ -0,0 +1,211 @@
+""" Open arbitrage positions and their fills.
+"""
+import itertools
+import threading
+import time
+from datetime import datetime
+
+from orders import OrderTracker, ORDER_CLOSED, ORDER_CANCELLED, ORDER_MISSING
+from parallel import default_pool
+from journal import EVENT_ORDER_CLOSE, EVENT_ORDER_CANCEL
+
+
+class Position(object):
+    """ An arbitrage position - a BUY order on one market and a SELL order
+    on another one, open until both are filled.
+    """
+    def __init__(self, pid, opportunity, buy_order, sell_order):
+        self.pid = pid
+        self.ask_plugin = opportunity['ask_plugin']
+        self.bid_plugin = opportunity['bid_plugin']
+        self.volume = opportunity['volume']
+        self.profit = opportunity['profit']
+        self.buy_order = buy_order
+        self.sell_order = sell_order
+        self.opened_at = time.time()
+        self.open_orders = set([
+                (self.ask_plugin.name, buy_order.oid),
+                (self.bid_plugin.name, sell_order.oid),
+            ])
+        # Orders which were cancelled instead of filled
+        self.cancelled_orders = set()
+        # Orders which couldn't be found on the exchange
+        self.missing_orders = set()
+
+    @property
+    def closed(self):
+        return not self.open_orders
+
+    def __str__(self):
+        return "position #{pid} ({volume:.8f} XBT {ask} -> {bid}, profit {profit:.5f} USD)".format(
+                pid=self.pid,
+                volume=self.volume,
+                ask=self.ask_plugin.name,
+                bid=self.bid_plugin.name,
+                profit=self.profit)
+
+
+class PositionManager(object):
+    """ Keeps up to `max_positions` positions open and watches their fills
+    in a background thread, so new opportunities can be taken while older
+    orders are still waiting to be filled.
+
+    The funds of a position are reserved in the plugins' account state when
+    its orders are submitted (see AccountState.order_submitted), so the
+    opportunities found while positions are open only use what's left. The
+    orders of all positions on one exchange are polled with a single
+    OrderTracker, the exchanges are polled concurrently. An order which was
+    cancelled or expired on the exchange is dropped from its position and
+    its funds are released, the position closes once its other order is
+    resolved too. An order which can't be found for several polls is
+    dropped as well, but its funds stay reserved until the account is
+    reconciled and the journal keeps it unresolved.
+
+    :param max_positions: Max. number of positions open at the same time
+    :param journal: Journal of the closed orders
+    :param poll_interval: Time between order status polls (in seconds)
+    """
+    def __init__(self, max_positions, journal, poll_interval=2.0):
+        self.max_positions = max_positions
+        self.journal = journal
+        self.poll_interval = poll_interval
+        self._positions = {}
+        self._positions_by_order = {}
+        self._trackers = {}
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._thread = None
+
+    @property
+    def positions(self):
+        """ Positions which are still open.
+        """
+        with self._cond:
+            return self._positions.values()
+
+    @property
+    def has_capacity(self):
+        with self._cond:
+            return len(self._positions) < self.max_positions
+
+    def wait_for_capacity(self, timeout=None):
+        """ Block until fewer than `max_positions` positions are open.
+
+        :return: Whether a position can be opened
+        """
+        with self._cond:
+            if len(self._positions) >= self.max_positions:
+                self._cond.wait(timeout)
+            return len(self._positions) < self.max_positions
+
+    def _tracker(self, plugin):
+        tracker = self._trackers.get(plugin.name)
+        if tracker is None:
+            tracker = self._trackers[plugin.name] = OrderTracker(plugin)
+        return tracker
+
+    def add(self, opportunity, buy_order, sell_order):
+        """ Start watching the orders of a new position.
+
+        :return: Position
+        """
+        with self._cond:
+            position = Position(next(self._ids), opportunity, buy_order, sell_order)
+            self._positions[position.pid] = position
+            self._positions_by_order[(position.ask_plugin.name, buy_order.oid)] = position
+            self._positions_by_order[(position.bid_plugin.name, sell_order.oid)] = position
+            self._tracker(position.ask_plugin).track(buy_order)
+            self._tracker(position.bid_plugin).track(sell_order)
+        return position
+
+    def start(self):
+        """ Start watching the fills in the background.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            self.poll()
+
+    def poll(self):
+        """ Poll the orders of the open positions once.
+
+        :return: List of the positions which were closed
+        """
+        closed = []
+        with self._cond:
+            trackers = [tracker for tracker in self._trackers.values() if tracker.orders]
+        # The exchanges are polled concurrently
+        polls = [(tracker, default_pool().submit(tracker.plugin.name, tracker.poll))
+                for tracker in trackers]
+        for (tracker, result) in polls:
+            result.wait()
+            if result.error is not None:
+                print "{market:20}  order status poll failed: {error}".format(
+                        market=tracker.plugin.name, error=result.error)
+                continue
+            for (order, status) in result.value:
+                if status == ORDER_CLOSED:
+                    closed.extend(self._order_closed(tracker.plugin, order))
+                elif status == ORDER_CANCELLED:
+                    closed.extend(self._order_cancelled(tracker.plugin, order))
+                elif status == ORDER_MISSING:
+                    closed.extend(self._order_missing(tracker.plugin, order,
+                            tracker.errors.get(order.oid)))
+
+        for position in closed:
+            print "{ts}  {position} closed after {elapsed:.0f}s{cancelled}{missing}".format(
+                    ts=datetime.now().isoformat(' '),
+                    position=position,
+                    elapsed=time.time() - position.opened_at,
+                    cancelled=", {0} order(s) cancelled".format(
+                        len(position.cancelled_orders)) if position.cancelled_orders else '',
+                    missing=", {0} order(s) not found".format(
+                        len(position.missing_orders)) if position.missing_orders else '')
+        return closed
+
+    def _order_closed(self, plugin, order):
+        self.journal.log(EVENT_ORDER_CLOSE, market=plugin.name,
+                side='BUY' if order.otype == 'bid' else 'SELL',
+                order_id=order.oid)
+        return self._resolve(plugin, order)
+
+    def _order_cancelled(self, plugin, order):
+        side = 'BUY' if order.otype == 'bid' else 'SELL'
+        print "{market:20}  {side} order '{order_id}' cancelled".format(
+                market=plugin.name, side=side, order_id=order.oid)
+        self.journal.log(EVENT_ORDER_CANCEL, market=plugin.name, side=side,
+                order_id=order.oid)
+        return self._resolve(plugin, order, position_orders='cancelled_orders')
+
+    def _order_missing(self, plugin, order, error):
+        # Neither filled nor cancelled as far as we know, nothing to journal
+        side = 'BUY' if order.otype == 'bid' else 'SELL'
+        print "{market:20}  {side} order '{order_id}' not found, check it on the exchange: {error}".format(
+                market=plugin.name, side=side, order_id=order.oid, error=error)
+        return self._resolve(plugin, order, position_orders='missing_orders')
+
+    def _resolve(self, plugin, order, position_orders=None):
+        """ Remove the order from its position.
+
+        :param position_orders: Name of the position's set the order is
+            added to, if it wasn't filled
+        :return: List with the position if it's closed now
+        """
+        with self._cond:
+            position = self._positions_by_order.pop((plugin.name, order.oid), None)
+            if position is None:
+                return []
+            position.open_orders.discard((plugin.name, order.oid))
+            if position_orders is not None:
+                getattr(position, position_orders).add((plugin.name, order.oid))
+            if not position.closed:
+                return []
+            del self._positions[position.pid]
+            self._cond.notify_all()
+            return [position]
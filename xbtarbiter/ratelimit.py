@@ -0,0 +1,160 @@
+""" Rate-limit aware scheduling of the requests to an exchange.
+
+Every request takes tokens from a token bucket before it is sent. Requests
+waiting for tokens are served by priority - placing and cancelling orders
+first, then order status polls, order book refreshes and finally background
+account reconciliation. Besides, the last `reserve` tokens may only be
+spent on orders, so polling and book refreshes can't use up the budget
+right before an order has to be placed.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+
+PRIORITY_ORDER = 0
+PRIORITY_STATUS = 1
+PRIORITY_BOOK = 2
+PRIORITY_BACKGROUND = 3
+
+PRIORITY_NAMES = {
+        PRIORITY_ORDER: 'order',
+        PRIORITY_STATUS: 'status',
+        PRIORITY_BOOK: 'book',
+        PRIORITY_BACKGROUND: 'background',
+    }
+
+
+class SchedulerStats(object):
+    """ Requests, tokens and waiting time of one RequestScheduler, by
+    priority.
+    """
+    def __init__(self):
+        self.started_at = time.time()
+        self.requests = dict((priority, 0) for priority in PRIORITY_NAMES)
+        self.waits = dict((priority, 0) for priority in PRIORITY_NAMES)
+        self.wait_time = dict((priority, 0.0) for priority in PRIORITY_NAMES)
+        self.tokens = 0.0
+
+
+class RequestScheduler(object):
+    """ Token bucket with a priority queue of the waiting requests.
+
+    :param capacity: Max. number of tokens (the burst the exchange allows)
+    :param rate: Tokens refilled per second
+    :param reserve: Tokens which only order placement and cancelling may use
+    """
+    def __init__(self, capacity, rate, reserve=0):
+        self.capacity = float(capacity)
+        self.rate = float(rate)
+        self.reserve = float(reserve)
+        self.stats = SchedulerStats()
+
+        self._tokens = self.capacity
+        self._updated_at = time.time()
+        self._waiting = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.capacity,
+                self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def _floor(self, priority):
+        return 0.0 if priority == PRIORITY_ORDER else self.reserve
+
+    @property
+    def tokens(self):
+        """ Tokens currently available.
+        """
+        with self._cond:
+            self._refill()
+            return self._tokens
+
+    def acquire(self, priority, cost=1):
+        """ Block until the request may be sent.
+
+        :param priority: One of the PRIORITY_* constants
+        :param cost: Tokens the request takes from the budget
+        """
+        if cost <= 0:
+            # Requests outside of the budget never wait
+            with self._cond:
+                self.stats.requests[priority] += 1
+            return
+
+        start = time.time()
+        with self._cond:
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiting, entry)
+            waited = False
+            try:
+                while True:
+                    self._refill()
+                    if self._waiting[0] == entry:
+                        missing = cost + self._floor(priority) - self._tokens
+                        if missing <= 0:
+                            break
+                        timeout = missing / self.rate
+                    else:
+                        # A request of higher priority goes first
+                        timeout = None
+                    waited = True
+                    self._cond.wait(timeout)
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+            self._tokens -= cost
+            stats = self.stats
+            stats.requests[priority] += 1
+            stats.tokens += cost
+            if waited:
+                stats.waits[priority] += 1
+                stats.wait_time[priority] += time.time() - start
+
+    def __str__(self):
+        stats = self.stats
+        # Short runs are averaged over the time it takes to refill the bucket
+        elapsed = max(time.time() - stats.started_at, self.capacity / self.rate)
+        used = self.capacity - self.tokens
+        return "budget {used:.1f}/{capacity:.0f} used ({used_pct:.0f}%), {rate:.2f}/s of {max_rate:.2f}/s ({rate_pct:.0f}%), waits {waits}".format(
+                used=used,
+                capacity=self.capacity,
+                used_pct=100 * used / self.capacity,
+                rate=stats.tokens / elapsed,
+                max_rate=self.rate,
+                rate_pct=100 * stats.tokens / elapsed / self.rate,
+                waits=' '.join("{name} {count} ({time:.1f}s)".format(
+                        name=PRIORITY_NAMES[priority],
+                        count=stats.waits[priority],
+                        time=stats.wait_time[priority])
+                    for priority in sorted(PRIORITY_NAMES)))
+
+
+def create_scheduler(defaults, options=None):
+    """ Create the RequestScheduler of a plugin.
+
+    :param defaults: Dict with the exchange's 'capacity', 'rate' and
+        'reserve'
+    :param options: Dict overriding the defaults (the plugin's "rate_limit"
+        config)
+    """
+    params = dict(defaults)
+    params.update(options or {})
+    return RequestScheduler(capacity=float(params['capacity']),
+            rate=float(params['rate']),
+            reserve=float(params.get('reserve', 0)))
+
+
+def format_budget_summary(plugin):
+    """ One-line summary of how much of a plugin's request budget is used.
+    """
+    scheduler = getattr(plugin, 'scheduler', None)
+    if scheduler is None:
+        return "{market:20}  no request budget".format(market=plugin.name)
+    return "{market:20}  {scheduler}".format(market=plugin.name, scheduler=scheduler)
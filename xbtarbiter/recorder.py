@@ -0,0 +1,256 @@
+""" Compact recording of order book snapshots.
+
+Every plugin gets its own append-only file of fixed-size records:
+
+    header:  magic 'XBTR', version, depth, price scale, volume scale
+    record:  timestamp (microseconds), `depth` bid levels, `depth` ask levels
+
+Timestamps and levels are little-endian 64-bit integers, prices and volumes
+are stored in the fixed-point units of fixedpoint.py (1/PRICE_SCALE USD and
+satoshis). Missing levels are zero. A snapshot identical to the previous one
+is not written again. Version 1 recordings stored prices in units of 1/10**5
+USD - they are still read, but not appended to.
+
+Next to the data file there is a small index file holding the timestamp of
+every INDEX_INTERVAL-th record, so a time range is located by bisecting the
+index and then the records of one block of the memory-mapped data file.
+"""
+import bisect
+import mmap
+import os
+import re
+import struct
+import threading
+from itertools import islice
+
+from fixedpoint import PRICE_SCALE, VOLUME_SCALE, to_fixed, from_fixed
+
+
+MAGIC = 'XBTR'
+VERSION = 2
+
+# Number of levels recorded on each side of the book
+DEFAULT_DEPTH = 5
+
+# Every INDEX_INTERVAL-th record is put into the index
+INDEX_INTERVAL = 1024
+
+_HEADER = struct.Struct('<4sHHII')
+_INDEX_ENTRY = struct.Struct('<qQ')
+_TIMESTAMP = struct.Struct('<q')
+
+
+def _record_struct(depth):
+    return struct.Struct('<q{0}q'.format(4 * depth))
+
+
+class BookWriter(object):
+    """ Appends snapshots of one order book to a recording file.
+
+    :param path: Path of the data file, the index is stored at path + '.idx'
+    :param depth: Number of levels recorded on each side
+    """
+    def __init__(self, path, depth=DEFAULT_DEPTH):
+        self.path = path
+        self.depth = depth
+        self._record = _record_struct(depth)
+        self._last_levels = None
+
+        if os.path.exists(path) and os.path.getsize(path) >= _HEADER.size:
+            with open(path, 'rb') as datafile:
+                header = _HEADER.unpack(datafile.read(_HEADER.size))
+            if header[0] != MAGIC or header[2] != depth:
+                raise ValueError("{0} is not a recording of depth {1}".format(path, depth))
+            if header[1] != VERSION or header[3:] != (PRICE_SCALE, VOLUME_SCALE):
+                raise ValueError("{0} is a version {1} recording, record into a new "
+                        "file".format(path, header[1]))
+            size = os.path.getsize(path) - _HEADER.size
+            self.count = size // self._record.size
+            # Drop a partially written record
+            self._data = open(path, 'r+b')
+            self._data.truncate(_HEADER.size + self.count * self._record.size)
+            self._data.seek(0, os.SEEK_END)
+            # The index entry of a block is written before its first record,
+            # drop the entries of records which never made it
+            index_path = path + '.idx'
+            self._index = open(index_path, 'r+b' if os.path.exists(index_path) else 'wb')
+            entries = (self.count + INDEX_INTERVAL - 1) // INDEX_INTERVAL
+            self._index.seek(0, os.SEEK_END)
+            self._index.truncate(min(self._index.tell(), entries * _INDEX_ENTRY.size))
+            self._index.seek(0, os.SEEK_END)
+        else:
+            self.count = 0
+            self._data = open(path, 'wb')
+            self._data.write(_HEADER.pack(MAGIC, VERSION, depth, PRICE_SCALE, VOLUME_SCALE))
+            self._index = open(path + '.idx', 'wb')
+
+    def _fixed_levels(self, levels):
+        result = []
+        for (price, volume) in islice(levels, self.depth):
+            result.append(to_fixed(price, PRICE_SCALE))
+            result.append(to_fixed(volume, VOLUME_SCALE))
+        result.extend([0] * (2 * self.depth - len(result)))
+        return result
+
+    def append(self, ts, bids, asks):
+        """ Append a snapshot.
+
+        :param ts: Timestamp (in seconds since the epoch)
+        :param bids: Iterable of (price, volume), highest price first
+        :param asks: Iterable of (price, volume), lowest price first
+        """
+        levels = self._fixed_levels(bids) + self._fixed_levels(asks)
+        if levels == self._last_levels:
+            return
+        self._last_levels = levels
+
+        ts_us = int(ts * 1e6)
+        if self.count % INDEX_INTERVAL == 0:
+            self._index.write(_INDEX_ENTRY.pack(ts_us, self.count))
+            self._index.flush()
+        self._data.write(self._record.pack(ts_us, *levels))
+        self.count += 1
+
+    def flush(self):
+        self._data.flush()
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+
+class BookReader(object):
+    """ Reads a recording file through a memory map.
+
+    :param path: Path of the data file
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as datafile:
+            (magic, _, self.depth, self.price_scale, self.volume_scale) = \
+                    _HEADER.unpack(datafile.read(_HEADER.size))
+            if magic != MAGIC:
+                raise ValueError("{0} is not a recording".format(path))
+            self._record = _record_struct(self.depth)
+            size = os.path.getsize(path) - _HEADER.size
+            self.count = size // self._record.size
+            self._map = mmap.mmap(datafile.fileno(), 0, access=mmap.ACCESS_READ) \
+                    if self.count else None
+
+        self._index_ts = []
+        self._index_pos = []
+        if os.path.exists(path + '.idx'):
+            with open(path + '.idx', 'rb') as indexfile:
+                data = indexfile.read()
+            for offset in range(0, len(data) - _INDEX_ENTRY.size + 1, _INDEX_ENTRY.size):
+                (ts, pos) = _INDEX_ENTRY.unpack_from(data, offset)
+                if pos < self.count:
+                    self._index_ts.append(ts)
+                    self._index_pos.append(pos)
+
+    def __len__(self):
+        return self.count
+
+    def timestamp(self, pos):
+        """ Timestamp of the record at the given position (in microseconds).
+        """
+        return _TIMESTAMP.unpack_from(self._map, _HEADER.size + pos * self._record.size)[0]
+
+    def raw(self, pos):
+        """ Record at the given position as a (timestamp, bids, asks) tuple
+        of integers, in microseconds and fixed-point units.
+        """
+        values = self._record.unpack_from(self._map, _HEADER.size + pos * self._record.size)
+        depth = self.depth
+        bids = [(values[1 + 2 * i], values[2 + 2 * i])
+                for i in range(depth) if values[2 + 2 * i]]
+        asks = [(values[1 + 2 * (depth + i)], values[2 + 2 * (depth + i)])
+                for i in range(depth) if values[2 + 2 * (depth + i)]]
+        return (values[0], bids, asks)
+
+    def snapshot(self, pos):
+        """ Record at the given position as a (timestamp, bids, asks) tuple,
+        timestamp in seconds, prices and volumes as Decimals.
+        """
+        (ts, bids, asks) = self.raw(pos)
+        convert = lambda levels: [
+                (from_fixed(price, self.price_scale), from_fixed(volume, self.volume_scale))
+                for (price, volume) in levels]
+        return (ts / 1e6, convert(bids), convert(asks))
+
+    def find(self, ts):
+        """ Position of the first record at or after the timestamp (in
+        seconds).
+        """
+        ts_us = int(ts * 1e6)
+        # Narrow the search to one index block, then bisect the records
+        block = bisect.bisect_right(self._index_ts, ts_us) - 1
+        lo = self._index_pos[block] if block >= 0 else 0
+        hi = self._index_pos[block + 1] if block + 1 < len(self._index_pos) else self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) < ts_us:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def iter_range(self, start=None, end=None):
+        """ Iterate over snapshots with start <= timestamp < end (in seconds).
+        """
+        pos = self.find(start) if start is not None else 0
+        end_pos = self.find(end) if end is not None else self.count
+        for pos in xrange(pos, end_pos):
+            yield self.snapshot(pos)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+
+
+def recording_path(directory, name):
+    """ Path of the recording file of a plugin.
+    """
+    slug = re.sub(r'[^a-zA-Z0-9.]+', '_', name).strip('_')
+    return os.path.join(directory, slug + '.xbr')
+
+
+class BookRecorder(object):
+    """ Records the order books of plugins, one file per plugin.
+
+    Assign it to `plugin.recorder` and the plugin records a snapshot of the
+    top levels of its book on every refresh.
+
+    :param directory: Directory of the recording files
+    :param depth: Number of levels recorded on each side
+    """
+    def __init__(self, directory, depth=DEFAULT_DEPTH):
+        self.directory = os.path.expanduser(directory)
+        self.depth = depth
+        self._writers = {}
+        self._closed = False
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def record(self, plugin):
+        if self._closed:
+            return
+        writer = self._writers.get(plugin.name)
+        if writer is None:
+            with self._lock:
+                writer = self._writers.get(plugin.name)
+                if writer is None:
+                    writer = BookWriter(recording_path(self.directory, plugin.name),
+                            self.depth)
+                    self._writers[plugin.name] = writer
+        writer.append(plugin.order_book_ts, plugin.iter_bids(), plugin.iter_asks())
+
+    def close(self):
+        """ Write the buffered snapshots and close the files. Snapshots
+        recorded afterwards are dropped.
+        """
+        with self._lock:
+            self._closed = True
+            for writer in self._writers.values():
+                writer.close()
@@ -0,0 +1,102 @@
+""" Registry of the exchange plugins.
+
+A plugin is registered by name with a factory `create_plugin(cfg,
+book_timeout)` returning the plugin object. The built-in plugins are listed
+in BUILTIN_PLUGINS, other packages register theirs as entry points of the
+ENTRY_POINT_GROUP group:
+
+    entry_points={
+        'xbtarbiter.plugins': [
+            'myexchange = mypackage.myexchange:create_plugin',
+        ],
+    }
+
+A plugin module is only imported when the plugin gets enabled. The names
+of third-party plugins are read from the entry_points.txt files of the
+installed distributions, pkg_resources is only imported to load such a
+plugin - importing it alone takes longer than starting the whole CLI.
+"""
+import importlib
+import os
+import sys
+
+
+ENTRY_POINT_GROUP = 'xbtarbiter.plugins'
+
+# Factories of the built-in plugins as 'module:function'
+BUILTIN_PLUGINS = {
+        'bitstamp': 'xbtarbiter.bitstamp:create_plugin',
+        'kraken': 'xbtarbiter.kraken:create_plugin',
+    }
+
+
+def _entry_points():
+    try:
+        import pkg_resources
+    except ImportError:
+        return {}
+    return dict((entry_point.name, entry_point)
+            for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP))
+
+
+def _metadata_files():
+    """ Paths of the entry_points.txt files of the distributions on sys.path.
+    """
+    for directory in sys.path:
+        directory = directory or os.curdir
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        for name in names:
+            if name.endswith('.egg-info') or name.endswith('.dist-info'):
+                yield os.path.join(directory, name, 'entry_points.txt')
+            elif name.endswith('.egg'):
+                yield os.path.join(directory, name, 'EGG-INFO', 'entry_points.txt')
+
+
+def _entry_point_names():
+    """ Names registered in ENTRY_POINT_GROUP, without importing
+    pkg_resources.
+    """
+    names = set()
+    for path in _metadata_files():
+        try:
+            with open(path) as f:
+                lines = f.readlines()
+        except IOError:
+            continue
+        section = None
+        for line in lines:
+            line = line.strip()
+            if line.startswith('['):
+                section = line.strip('[]').strip()
+            elif section == ENTRY_POINT_GROUP and '=' in line:
+                names.add(line.split('=', 1)[0].strip())
+    return names
+
+
+def plugin_names():
+    """ Names of all available plugins, built-in ones first.
+    """
+    names = sorted(BUILTIN_PLUGINS)
+    names.extend(sorted(name for name in _entry_point_names() if name not in BUILTIN_PLUGINS))
+    return names
+
+
+def is_plugin(name):
+    return name in BUILTIN_PLUGINS or name in _entry_point_names()
+
+
+def load_plugin_factory(name):
+    """ Import the plugin's module and return its factory.
+
+    :raise ValueError: Unknown plugin
+    """
+    if name in BUILTIN_PLUGINS:
+        (module_name, function) = BUILTIN_PLUGINS[name].split(':')
+        return getattr(importlib.import_module(module_name), function)
+    entry_point = _entry_points().get(name)
+    if entry_point is None:
+        raise ValueError("Unknown plugin: {0}".format(name))
+    return entry_point.load()
@@ -0,0 +1,245 @@
+""" Offline replay of order book streams through the trading logic.
+
+Recorded (see recorder.py) or synthetic order books are fed into simulated
+plugins, and every book update runs a cycle of find_opportunities() and
+get_best_opportunity(), which pick the same opportunity as trading's
+find_best_opportunity() but also count all of them. The best opportunity
+is traded on simulated balances. Its realized profit is determined at the
+next cycle against the books at that time - the orders only fill as far as
+the next books still allow at the orders' limit prices.
+"""
+import glob
+import heapq
+import os
+import time
+from decimal import Decimal
+from itertools import takewhile
+
+from depth import walk_books
+from fixedpoint import FixedLevels
+from feedserver import SyntheticBook
+from recorder import BookReader
+
+
+class SimPlugin(object):
+    """ Simulated exchange with a replayed order book and simulated
+    balances. Prices are in USD.
+
+    :param name: Market name
+    :param fee: Trade fee (in percent)
+    :param usd: Initial USD balance
+    :param xbt: Initial XBT balance
+    """
+    def __init__(self, name, fee, usd, xbt):
+        self.name = name
+        self.trade_fee = Decimal(fee)
+        self.avail_usd = Decimal(usd)
+        self.avail_xbt = Decimal(xbt)
+        self.book_timeout = None
+        self.order_book_ts = None
+        self._bids = []
+        self._asks = []
+        self._fixed_book = None
+
+    def load_order_book(self, bids, asks):
+        self._bids = bids
+        self._asks = asks
+        self._fixed_book = None
+
+    def fixed_book(self):
+        if self._fixed_book is None:
+            self._fixed_book = (FixedLevels(self._bids), FixedLevels(self._asks))
+        return self._fixed_book
+
+    def refresh_order_book(self):
+        pass
+
+    @property
+    def balance_usd(self):
+        return self.avail_usd
+
+    @property
+    def balance_xbt(self):
+        return self.avail_xbt
+
+    @property
+    def highest_bid(self):
+        (price, volume) = self._bids[0]
+        return {'price': price, 'volume': volume}
+
+    @property
+    def lowest_ask(self):
+        (price, volume) = self._asks[0]
+        return {'price': price, 'volume': volume}
+
+    def iter_bids(self):
+        return iter(self._bids)
+
+    def iter_asks(self):
+        return iter(self._asks)
+
+    def has_book(self):
+        return bool(self._bids) and bool(self._asks)
+
+
+def recorded_events(paths):
+    """ Merge the snapshots of recording files by time.
+
+    :return: Iterator of (timestamp, name, bids, asks) tuples. The market
+        name is the file name without extension.
+    """
+    streams = []
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        reader = BookReader(path)
+        streams.append(((ts, name, bids, asks)
+                for (ts, bids, asks) in reader.iter_range()))
+    return heapq.merge(*streams)
+
+
+def recording_paths(arguments):
+    """ Expand directories among the arguments to the recordings in them.
+    """
+    paths = []
+    for argument in arguments:
+        argument = os.path.expanduser(argument)
+        if os.path.isdir(argument):
+            paths.extend(sorted(glob.glob(os.path.join(argument, '*.xbr'))))
+        else:
+            paths.append(argument)
+    return paths
+
+
+def synthetic_events(cycles, markets=2, interval=1.0, depth=10, seed=0,
+        spread=1.0):
+    """ Generate random order book updates of several markets.
+
+    :param spread: Difference between the initial mid prices of consecutive
+        markets (in percent) - more than the fees of buying on one and
+        selling on the other, so the replay finds opportunities
+    :return: Iterator of (timestamp, name, bids, asks) tuples
+    """
+    books = [SyntheticBook(mid=600.0 * (1 + spread / 100.0 * i), depth=depth,
+            seed=seed + i) for i in range(markets)]
+    names = ['synthetic-{0}'.format(i) for i in range(markets)]
+    convert = lambda levels: [(Decimal(repr(price)), Decimal(repr(volume)))
+            for (price, volume) in levels]
+    ts = 0.0
+    for cycle in xrange(cycles):
+        i = cycle % markets
+        books[i].step()
+        (bids, asks) = books[i].snapshot()
+        yield (ts, names[i], convert(bids), convert(asks))
+        ts += interval / markets
+
+
+def _fill(opportunity):
+    """ Realized part of a simulated trade against the current books.
+    """
+    ask_plugin = opportunity['ask_plugin']
+    bid_plugin = opportunity['bid_plugin']
+    buy_limit = opportunity['buy_limit']
+    sell_limit = opportunity['sell_limit']
+    bids = takewhile(lambda level: level[0] >= sell_limit, bid_plugin.iter_bids())
+    asks = takewhile(lambda level: level[0] <= buy_limit, ask_plugin.iter_asks())
+    # The walk stops at the first unprofitable level pair, the limit prices
+    # of an opportunity are profitable by construction
+    return walk_books(bids, asks, bid_plugin.trade_fee, ask_plugin.trade_fee,
+            max_volume=opportunity['volume'])
+
+
+class ReplayResult(object):
+    def __init__(self, min_profit, max_volume):
+        self.min_profit = min_profit
+        self.max_volume = max_volume
+        self.cycles = 0
+        self.opportunities = 0
+        self.trades = 0
+        self.theoretical_profit = Decimal('0')
+        self.realized_profit = Decimal('0')
+        self.first_ts = None
+        self.last_ts = None
+        self.elapsed = 0.0
+
+    @property
+    def cycles_per_second(self):
+        return self.cycles / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def speedup(self):
+        """ How many times faster than real time the replay ran.
+        """
+        if not self.elapsed or self.first_ts is None:
+            return 0.0
+        return (self.last_ts - self.first_ts) / self.elapsed
+
+
+def replay(events, min_profit, max_volume, fee, usd, xbt):
+    """ Run the trading logic over a stream of order book events.
+
+    :param events: Iterable of (timestamp, name, bids, asks) tuples, prices
+        in USD
+    :param min_profit: Min. profit to make a trade (in USD)
+    :param max_volume: Max. volume to trade (in XBT)
+    :param fee: Trade fee of the simulated markets (in percent)
+    :param usd: Initial USD balance of each simulated market
+    :param xbt: Initial XBT balance of each simulated market
+    :return: ReplayResult
+    """
+    # The trading logic lives in the package itself
+    from xbtarbiter import OpportunityFinder, get_best_opportunity, MIN_TRADE_VOLUME
+
+    result = ReplayResult(min_profit, max_volume)
+    # A run never sees the markets of another one
+    finder = OpportunityFinder()
+    plugins = {}
+    pending = None
+    start = time.time()
+    for (ts, name, bids, asks) in events:
+        plugin = plugins.get(name)
+        if plugin is None:
+            plugin = plugins[name] = SimPlugin(name, fee, usd, xbt)
+        plugin.load_order_book(bids, asks)
+        plugin.order_book_ts = ts
+        if result.first_ts is None:
+            result.first_ts = ts
+        result.last_ts = ts
+        result.cycles += 1
+
+        # Settle the trade made in the previous cycle
+        if pending is not None:
+            filled = _fill(pending)
+            pending['ask_plugin'].avail_usd -= filled['buy_total'] + filled['buy_fee']
+            pending['ask_plugin'].avail_xbt += filled['volume']
+            pending['bid_plugin'].avail_xbt -= filled['volume']
+            pending['bid_plugin'].avail_usd += filled['sell_total'] - filled['sell_fee']
+            result.realized_profit += filled['profit']
+            pending = None
+
+        active = [p for p in plugins.values() if p.has_book()]
+        opportunities = finder.find_opportunities(active, max_volume,
+                refresh=False)
+        result.opportunities += len(opportunities)
+        opportunity = get_best_opportunity(opportunities, min_profit)
+        if opportunity is not None and opportunity['volume'] >= MIN_TRADE_VOLUME:
+            result.trades += 1
+            result.theoretical_profit += opportunity['profit']
+            pending = opportunity
+
+    result.elapsed = time.time() - start
+    return result
+
+
+def print_result(result):
+    print "min-profit {min_profit:>8} USD  max-volume {max_volume:>8} XBT".format(
+            min_profit=result.min_profit, max_volume=result.max_volume)
+    print "  cycles {cycles}, opportunities {opportunities}, trades {trades}".format(
+            cycles=result.cycles,
+            opportunities=result.opportunities,
+            trades=result.trades)
+    print "  profit: theoretical {theoretical: >10.5f} USD, realized {realized: >10.5f} USD".format(
+            theoretical=result.theoretical_profit,
+            realized=result.realized_profit)
+    print "  {cps:.0f} cycles/s, {speedup:.0f}x faster than real time".format(
+            cps=result.cycles_per_second,
+            speedup=result.speedup)
@@ -0,0 +1,355 @@
+""" Pooled keep-alive HTTP sessions for the exchange plugins.
+"""
+import hashlib
+import threading
+import time
+import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.packages.urllib3.util.retry import Retry
+
+from latency import LatencyStats
+
+
+HTTP_NOT_MODIFIED = 304
+
+# Size of the chunks streamed responses are read in (in bytes)
+STREAM_CHUNK_SIZE = 8192
+
+
+# Timings of the request which is currently being sent by this thread. The
+# connection classes below don't know which session they belong to, so they
+# report through this thread-local.
+_current = threading.local()
+
+
+def _record(name, elapsed):
+    timings = getattr(_current, 'timings', None)
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + elapsed
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def _new_conn(self):
+        # Name resolution and the TCP connect happen in one call
+        start = time.time()
+        conn = HTTPConnection._new_conn(self)
+        _record('connect', time.time() - start)
+        return conn
+
+    def connect(self):
+        start = time.time()
+        HTTPConnection.connect(self)
+        _record('handshake', time.time() - start)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def _new_conn(self):
+        start = time.time()
+        conn = HTTPSConnection._new_conn(self)
+        self._connect_time = time.time() - start
+        _record('connect', self._connect_time)
+        return conn
+
+    def connect(self):
+        self._connect_time = 0.0
+        start = time.time()
+        HTTPSConnection.connect(self)
+        elapsed = time.time() - start
+        _record('handshake', elapsed)
+        _record('tls', elapsed - self._connect_time)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _PooledAdapter(HTTPAdapter):
+    """ Transport adapter whose connection pools report handshake times.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+                'http': _TimedHTTPConnectionPool,
+                'https': _TimedHTTPSConnectionPool,
+            }
+
+
+class ConnectionStats(object):
+    """ Connection statistics of one HttpSession.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.reconnects = 0
+        self.handshake_time = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def reused(self):
+        """ Number of requests sent over an already open connection.
+        """
+        return self.requests - self.connections
+
+    @property
+    def avg_handshake_time(self):
+        """ Average time (in seconds) needed to open a new connection,
+        including the TLS handshake.
+        """
+        if not self.connections:
+            return None
+        return self.handshake_time / self.connections
+
+    def update(self, timings):
+        with self._lock:
+            self.requests += 1
+            if 'handshake' in timings:
+                self.connections += 1
+                self.handshake_time += timings['handshake']
+
+    def __str__(self):
+        return "{requests} requests, {connections} connections, {reused} reused, {reconnects} reconnects".format(
+                requests=self.requests,
+                connections=self.connections,
+                reused=self.reused,
+                reconnects=self.reconnects)
+
+
+class ResponseCache(object):
+    """ Last response of a polled endpoint, for skipping unchanged ones.
+
+    The validators (ETag, Last-Modified) are sent back with the next request,
+    so an exchange supporting conditional requests can answer 304 Not
+    Modified without a body. Other exchanges send the body again, its hash
+    is compared with the last one and an identical body isn't parsed again.
+
+    After a request, `changed` tells whether `result` is new.
+    """
+    def __init__(self):
+        self.etag = None
+        self.last_modified = None
+        self.digest = None
+        self.result = None
+        self.changed = True
+
+    def headers(self):
+        """ Conditional request headers.
+        """
+        headers = {}
+        if self.result is None:
+            return headers
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class _CountedChunks(object):
+    """ Iterator over the chunks of a streamed body, counting its size.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self.size = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        chunk = next(self._chunks)
+        self.size += len(chunk)
+        return chunk
+
+
+class HttpSession(object):
+    """ Long-lived HTTP session keeping a pool of keep-alive connections, so
+    that requests don't pay for a new TCP and TLS handshake every time.
+
+    :param pool_size: max. number of connections kept open to a host
+    :param connect_timeout: timeout for establishing a connection (in seconds)
+    :param read_timeout: timeout for reading the response (in seconds)
+    :param retries: how many times to retry establishing a connection
+
+    Every request is timed. The connection statistics are kept in `stats`,
+    the latencies of the request phases by endpoint in `latencies`.
+    """
+    def __init__(self, pool_size=4, connect_timeout=3.05, read_timeout=10.0,
+            retries=2):
+        self.pool_size = int(pool_size)
+        self.connect_timeout = float(connect_timeout)
+        self.read_timeout = float(read_timeout)
+        self.retries = int(retries)
+        self.stats = ConnectionStats()
+        self.latencies = LatencyStats()
+
+        self._lock = threading.Lock()
+        self._session = self._create_session()
+
+    def _create_session(self):
+        # Only connection errors are retried - the request wasn't sent yet at
+        # that point, so it's safe even for placing orders
+        retry = Retry(total=self.retries, connect=self.retries, read=0,
+                redirect=0)
+        adapter = _PooledAdapter(pool_connections=self.pool_size,
+                pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def reconnect(self):
+        """ Drop all pooled connections and start over with a new pool.
+        """
+        with self._lock:
+            old_session = self._session
+            self._session = self._create_session()
+            self.stats.reconnects += 1
+        old_session.close()
+
+    def close(self):
+        self._session.close()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """ Send a request over a pooled connection.
+
+        If the connection breaks, the pool is recreated. GET requests are
+        then sent once more, other requests are not repeated because they
+        might have reached the exchange already.
+        """
+        (response, timings) = self._request(method, url, kwargs)
+        self._record(urlparse.urlparse(url).path, response, timings,
+                len(response.content))
+        return response
+
+    def request_json(self, method, url, endpoint=None, cache=None,
+            parser=None, **kwargs):
+        """ Send a request like request() and parse the JSON response.
+
+        :param endpoint: Name the request's latencies are recorded under
+            (default is the URL path)
+        :param cache: ResponseCache of the endpoint. If the response is 304
+            Not Modified or has the same body as the last one, the last
+            result is returned without parsing and `cache.changed` is False.
+        :param parser: Function parsing a successful response from an
+            iterator of its chunks, for reading only a part of a large body.
+            It returns a (result, text) tuple, the text (the part of the
+            body it used) is what `cache` compares. The rest of the body is
+            read and dropped, so the connection can be reused.
+        :return: (response, parsed JSON) tuple
+        """
+        if parser is not None:
+            kwargs['stream'] = True
+        if cache is not None:
+            headers = cache.headers()
+            if headers:
+                headers.update(kwargs.get('headers') or {})
+                kwargs['headers'] = headers
+        (response, timings) = self._request(method, url, kwargs)
+        start = time.time()
+        size = None
+        try:
+            (result, size) = self._parse(response, cache, parser)
+        finally:
+            # The parse time of streamed responses includes reading them
+            timings['parse'] = time.time() - start
+            timings['total'] += timings['parse']
+            if size is None:
+                size = 0 if parser is not None else len(response.content)
+            self._record(endpoint or urlparse.urlparse(url).path, response,
+                    timings, size)
+            # A fully read response gives its connection back to the pool, one
+            # whose parsing failed midway closes it
+            response.close()
+        return (response, result)
+
+    def _parse(self, response, cache, parser):
+        """ Parse the response, or take the result from the cache if it's
+        unchanged.
+
+        :return: (result, size of the body) tuple
+        """
+        if cache is not None and response.status_code == HTTP_NOT_MODIFIED \
+                and cache.result is not None:
+            cache.changed = False
+            return (cache.result, len(response.content))
+        if response.status_code != 200 or (cache is None and parser is None):
+            # Errors are neither streamed, cached nor compared
+            if cache is not None:
+                cache.changed = True
+            return (response.json(), len(response.content))
+
+        result = None
+        if parser is not None:
+            chunks = _CountedChunks(response.iter_content(STREAM_CHUNK_SIZE))
+            (result, content) = parser(chunks)
+            for _ in chunks:
+                pass
+            size = chunks.size
+            if cache is None:
+                return (result, size)
+        else:
+            content = response.content
+            size = len(content)
+
+        # Hashing is far cheaper than parsing the JSON
+        digest = hashlib.sha1(content).digest()
+        if digest == cache.digest:
+            cache.changed = False
+            return (cache.result, size)
+        if result is None:
+            result = response.json()
+        cache.etag = response.headers.get('ETag')
+        cache.last_modified = response.headers.get('Last-Modified')
+        cache.digest = digest
+        cache.result = result
+        cache.changed = True
+        return (result, size)
+
+    def _request(self, method, url, kwargs):
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        try:
+            return self._send(method, url, kwargs)
+        except requests.exceptions.ConnectionError:
+            self.reconnect()
+            if method != 'GET':
+                raise
+            return self._send(method, url, kwargs)
+
+    def _send(self, method, url, kwargs):
+        _current.timings = timings = {}
+        start = time.time()
+        try:
+            response = self._session.request(method, url, **kwargs)
+        finally:
+            _current.timings = None
+        total = time.time() - start
+        self.stats.update(timings)
+
+        # requests measures the time until the response headers were read,
+        # the body is read afterwards
+        headers = response.elapsed.total_seconds()
+        phases = {
+                'wait': max(0.0, headers - timings.get('handshake', 0.0)),
+                'transfer': max(0.0, total - headers),
+                'total': total,
+            }
+        for phase in ('connect', 'tls'):
+            if phase in timings:
+                phases[phase] = timings[phase]
+        return (response, phases)
+
+    def _record(self, endpoint, response, timings, size):
+        self.latencies.record(endpoint, response.status_code, size, timings)
@@ -0,0 +1,234 @@
+""" Minimal WebSocket (RFC 6455) connections for the order book streams.
+
+Only what the streams need is supported: text messages, fragmented
+messages, ping/pong and closing. Clients connect with connect(), the local
+stand-in servers take over an accepted connection with accept().
+"""
+import base64
+import hashlib
+import os
+import socket
+import ssl
+import struct
+import urlparse
+
+
+# Appended to the client's key by the server (see RFC 6455, section 1.3)
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+
+# Larger frames are refused rather than buffered
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class WebSocketError(Exception):
+    """ The peer doesn't follow the WebSocket protocol.
+    """
+
+
+def accept_key(key):
+    """ The server's answer to the client's Sec-WebSocket-Key.
+    """
+    return base64.b64encode(hashlib.sha1(key + GUID).digest())
+
+
+def _mask(data, key):
+    data = bytearray(data)
+    key = bytearray(key)
+    for i in xrange(len(data)):
+        data[i] ^= key[i % 4]
+    return str(data)
+
+
+def _read_head(reader):
+    """ Read the first line and the headers of an HTTP request or response.
+
+    :return: (first line, dictionary of headers with lowercase names)
+    """
+    first_line = reader.readline(65537).strip()
+    headers = {}
+    while True:
+        line = reader.readline(65537)
+        if not line:
+            raise WebSocketError("Connection closed during the handshake")
+        line = line.strip()
+        if not line:
+            return (first_line, headers)
+        (name, _, value) = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+
+class WebSocket(object):
+    """ An open WebSocket connection.
+
+    :param sock: Connected socket
+    :param reader: File object reading from the socket, it may have buffered
+        data past the handshake
+    :param client: Whether this is the client end (which masks its frames)
+    """
+    def __init__(self, sock, reader, client):
+        self._sock = sock
+        self._reader = reader
+        self._client = client
+        self._closed = False
+
+    def _read(self, size):
+        data = self._reader.read(size)
+        if len(data) < size:
+            raise WebSocketError("Connection closed in the middle of a frame")
+        return data
+
+    def _read_frame(self):
+        """ :return: (fin, opcode, payload) tuple or None if the connection
+            was closed between frames
+        """
+        head = self._reader.read(2)
+        if not head:
+            return None
+        if len(head) < 2:
+            head += self._read(1)
+        (first, second) = struct.unpack('!BB', head)
+        length = second & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self._read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._read(8))[0]
+        if length > MAX_FRAME_SIZE:
+            raise WebSocketError("Frame of {0} bytes is too large".format(length))
+        key = self._read(4) if second & 0x80 else None
+        payload = self._read(length)
+        if key is not None:
+            payload = _mask(payload, key)
+        return (bool(first & 0x80), first & 0x0f, payload)
+
+    def _send_frame(self, opcode, payload):
+        length = len(payload)
+        mask_bit = 0x80 if self._client else 0
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, mask_bit | length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, mask_bit | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, mask_bit | 127, length)
+        if self._client:
+            key = os.urandom(4)
+            header += key
+            payload = _mask(payload, key)
+        self._sock.sendall(header + payload)
+
+    def send(self, text):
+        """ Send a text message.
+        """
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self._send_frame(OP_TEXT, text)
+
+    def receive(self):
+        """ Wait for the next message, answering pings on the way.
+
+        :return: Text of the message, or None when the connection was closed
+        """
+        fragments = []
+        while True:
+            frame = self._read_frame()
+            if frame is None:
+                return None
+            (fin, opcode, payload) = frame
+            if opcode == OP_PING:
+                self._send_frame(OP_PONG, payload)
+            elif opcode == OP_PONG:
+                continue
+            elif opcode == OP_CLOSE:
+                # Echo the status code back
+                self._close(payload[:2])
+                return None
+            elif opcode in (OP_TEXT, OP_BINARY, OP_CONTINUATION):
+                if (opcode == OP_CONTINUATION) != bool(fragments):
+                    raise WebSocketError("Unexpected frame of opcode {0}".format(opcode))
+                fragments.append(payload)
+                if fin:
+                    return ''.join(fragments)
+            else:
+                raise WebSocketError("Unknown opcode {0}".format(opcode))
+
+    def _close(self, payload):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._send_frame(OP_CLOSE, payload)
+        except socket.error:
+            pass
+
+    def close(self):
+        """ Close the connection (status 1000, normal closure).
+        """
+        self._close(struct.pack('!H', 1000))
+        self._sock.close()
+
+
+def connect(url, timeout=None):
+    """ Open a WebSocket connection.
+
+    :param url: ws:// or wss:// URL
+    :param timeout: Max. time to wait for the handshake or a frame (in
+        seconds), socket.timeout is raised when it runs out
+    :return: WebSocket
+    """
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme not in ('ws', 'wss'):
+        raise ValueError("Not a WebSocket URL: {0}".format(url))
+    secure = parsed.scheme == 'wss'
+    sock = socket.create_connection(
+            (parsed.hostname, parsed.port or (443 if secure else 80)), timeout)
+    try:
+        if secure:
+            sock = ssl.create_default_context().wrap_socket(sock,
+                    server_hostname=parsed.hostname)
+        key = base64.b64encode(os.urandom(16))
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        sock.sendall('GET {path} HTTP/1.1\r\n'
+                'Host: {host}\r\n'
+                'Upgrade: websocket\r\n'
+                'Connection: Upgrade\r\n'
+                'Sec-WebSocket-Key: {key}\r\n'
+                'Sec-WebSocket-Version: 13\r\n'
+                '\r\n'.format(path=path, host=parsed.netloc, key=key))
+        reader = sock.makefile('rb')
+        (status, headers) = _read_head(reader)
+        if status.split(' ', 2)[1:2] != ['101']:
+            raise WebSocketError("Handshake refused: {0}".format(status))
+        if headers.get('sec-websocket-accept') != accept_key(key):
+            raise WebSocketError("Handshake answered with a wrong key")
+    except:
+        sock.close()
+        raise
+    return WebSocket(sock, reader, client=True)
+
+
+def accept(sock, reader):
+    """ Answer the handshake of a client connected to a server.
+
+    :param sock: Accepted socket
+    :param reader: File object reading from the socket
+    :return: WebSocket
+    """
+    (request, headers) = _read_head(reader)
+    key = headers.get('sec-websocket-key')
+    if headers.get('upgrade', '').lower() != 'websocket' or not key:
+        sock.sendall('HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+        raise WebSocketError("Not a WebSocket handshake: {0}".format(request))
+    sock.sendall('HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Accept: {0}\r\n'
+            '\r\n'.format(accept_key(key)))
+    return WebSocket(sock, reader, client=False)